@@ -6,6 +6,8 @@ set -o errexit
 pip install -r requirements.txt
 
 # Build commands
+# 本番に必須の設定（MAHJONG_ROOM_CODE_KEY など）を確認
+python manage.py check --deploy --fail-level ERROR
 python manage.py collectstatic --noinput
 python manage.py migrate
 
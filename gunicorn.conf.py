@@ -0,0 +1,32 @@
+"""
+Gunicornの設定（本番環境）
+
+mahjong_project.asgi をUvicornのワーカーで動かす。非同期ビュー（ダッシュボード・
+部分テンプレート・SSE）は1つのワーカーで多数の接続を同時に扱えるため、
+遅いクライアントや保持中のSSE接続がポーリングを止めない。
+
+    gunicorn mahjong_project.asgi:application -c gunicorn.conf.py
+
+WSGIと比較する場合は MAHJONG_WORKER_CLASS=sync で mahjong_project.wsgi を起動する
+（python manage.py bench_concurrency を参照）。
+
+/metrics（mahjong/metrics.py）の各ワーカーのファイルは、起動時に空にする
+MAHJONG_METRICS_DIR に書き出される。
+"""
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', f'0.0.0.0:{os.environ.get("PORT", "8080")}')
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_class = os.environ.get('MAHJONG_WORKER_CLASS', 'uvicorn_worker.UvicornWorker')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+# SSEの接続はワーカーの再起動まで保持されるため、終了時は短く待って切断する
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '20'))
+keepalive = 5
+
+
+def on_starting(server):
+    """前回の起動のワーカーのメトリクスを消す（カウンターは新しいマスターの起動から数え直す）"""
+    metrics_dir = os.environ.get('MAHJONG_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'mahjong_metrics'))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -10,7 +10,7 @@ class RoomAdmin(admin.ModelAdmin):
 
 @admin.register(Player)
 class PlayerAdmin(admin.ModelAdmin):
-    list_display = ['name', 'room', 'order']
+    list_display = ['name', 'room', 'order', 'total_points', 'total_chips']
     list_filter = ['room']
 
 
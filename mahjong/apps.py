@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class MahjongConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mahjong'
+
+    def ready(self):
+        # システムチェック（check --deploy）の登録
+        from . import checks  # noqa: F401
+        from .metrics import install_execute_wrapper as install_metrics_wrapper
+        from .sqlite import apply_sqlite_profile
+        from .timing import install_execute_wrapper, instrument_templates
+        connection_created.connect(apply_sqlite_profile, dispatch_uid='mahjong_sqlite_profile')
+        connection_created.connect(install_execute_wrapper, dispatch_uid='mahjong_timing')
+        connection_created.connect(install_metrics_wrapper, dispatch_uid='mahjong_metrics')
+        instrument_templates()
@@ -0,0 +1,170 @@
+"""
+ベンチマーク用の共通処理
+
+管理コマンド（bench_*）から使う。計測値の集計と、計測用の一時データベースの
+切り替えを提供する。
+"""
+import contextlib
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from django.core.management import call_command
+from django.db import connections, transaction
+
+
+def percentile(sorted_samples, fraction):
+    """ソート済みの計測値のパーセンタイル（最近傍法）"""
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples):
+    """計測値（秒）を集計してミリ秒の辞書で返す"""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000 if ordered else 0.0,
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p95_ms': percentile(ordered, 0.95) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+    }
+
+
+def format_summary(label, summary):
+    """集計結果を1行の文字列に整形"""
+    return (
+        f'{label:<28} n={summary["count"]:<6} '
+        f'mean={summary["mean_ms"]:8.3f}ms  p50={summary["p50_ms"]:8.3f}ms  '
+        f'p95={summary["p95_ms"]:8.3f}ms  p99={summary["p99_ms"]:8.3f}ms'
+    )
+
+
+def timed(func, repeat):
+    """funcをrepeat回実行し、1回ごとの所要時間（秒）のリストを返す"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def timed_for(func, min_seconds, min_repeat=5, max_repeat=10000):
+    """funcを合計min_seconds以上（かつmin_repeat回以上）実行し、1回ごとの所要時間のリストを返す"""
+    samples = []
+    total = 0.0
+    while len(samples) < max_repeat and (len(samples) < min_repeat or total < min_seconds):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        samples.append(elapsed)
+        total += elapsed
+    return samples
+
+
+def seed_room(games, batch_size=5000, seed=0):
+    """
+    計測用の部屋を作り、games半荘分のゲームとスコア記録をまとめて挿入する
+
+    record_gameを1半荘ずつ呼ぶと10万半荘では時間がかかりすぎるため、
+    ポイントは scoring.score_games で一括計算し、bulk_createで挿入する。
+    プレイヤーの累計成績とRoom.versionも記録後の状態にそろえる。
+    """
+    from .models import Game, Player, Room, ScoreRecord
+    from .scoring import compile_rules, score_games
+    from .services import recalculate_player_totals
+
+    rng = np.random.default_rng(seed)
+    with transaction.atomic():
+        room = Room.objects.create()
+        players = [Player.objects.create(room=room, name=f'P{i}', order=i) for i in range(1, 5)]
+        rules = compile_rules(room)
+        for start in range(0, games, batch_size):
+            count = min(batch_size, games - start)
+            # 合計が持ち点×4になる持ち点（100点単位）
+            total = room.starting_points * 4 // 100
+            cuts = np.sort(rng.integers(0, total, size=(count, 3)), axis=1)
+            scores = np.diff(cuts, prepend=0, append=total, axis=1) * 100
+            ranks, points = score_games(rules, scores)
+            created = Game.objects.bulk_create([
+                Game(room=room, game_number=start + index + 1) for index in range(count)
+            ])
+            if created[0].pk is None:
+                created = list(Game.objects.filter(room=room, game_number__gt=start).order_by('game_number'))
+            ScoreRecord.objects.bulk_create([
+                ScoreRecord(
+                    game=game, player=player, score=int(scores[row, column]),
+                    rank=int(ranks[row, column]), points=float(points[row, column]),
+                )
+                for row, game in enumerate(created)
+                for column, player in enumerate(players)
+            ], batch_size=batch_size)
+        recalculate_player_totals(Player.objects.filter(room=room))
+        Room.objects.filter(pk=room.pk).update(version=games)
+    room.refresh_from_db()
+    return room, list(Player.objects.filter(room=room).order_by('order'))
+
+
+@dataclass(frozen=True)
+class BaselineComparison:
+    """基準値との比較結果（1ケース・1サイズ分）"""
+    name: str
+    size: str
+    baseline_ms: float
+    current_ms: float
+
+    @property
+    def ratio(self):
+        return self.current_ms / self.baseline_ms if self.baseline_ms else float('inf')
+
+    def regressed(self, threshold, min_delta_ms=0.0):
+        """
+        基準値より threshold（0.25なら25%）を超えて遅くなったか
+
+        差が min_delta_ms 未満なら、計測の揺らぎとみなして回帰にしない。
+        """
+        return self.ratio > 1 + threshold and self.current_ms - self.baseline_ms >= min_delta_ms
+
+
+def compare_to_baseline(results, baseline):
+    """
+    {ケース名: {サイズ: ミリ秒}} の計測結果を基準値と比較する
+
+    基準値にないケース・サイズは比較しない（新しく追加したケースなど）。
+    """
+    comparisons = []
+    for name, sizes in results.items():
+        for size, current_ms in sizes.items():
+            baseline_ms = baseline.get(name, {}).get(str(size))
+            if baseline_ms is not None:
+                comparisons.append(BaselineComparison(name, str(size), baseline_ms, current_ms))
+    return comparisons
+
+
+@contextlib.contextmanager
+def temporary_database(directory=None, **overrides):
+    """
+    defaultのデータベースを一時ファイルのSQLiteに切り替えてマイグレーションする
+
+    本番のデータベースに触れずに計測するためのもの。directoryを指定すると
+    そのディレクトリに一時ファイルを作る（fsyncのコストは本番と同じディスクで測る）。
+    overridesはDATABASESのエントリに上書きする値（例: PRAGMAS={} で接続設定を無効化）。
+    """
+    connection = connections['default']
+    original = dict(connection.settings_dict)
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        connection.close()
+        connection.settings_dict.update(NAME=str(Path(workdir) / 'bench.sqlite3'), **overrides)
+        try:
+            call_command('migrate', verbosity=0)
+            yield connection
+        finally:
+            connection.close()
+            connection.settings_dict.clear()
+            connection.settings_dict.update(original)
@@ -0,0 +1,152 @@
+"""
+部屋単位のキャッシュ
+
+- Roomのインスタンス: 部屋コードをキーに MAHJONG_CACHE_ROOM_SECONDS だけ保持し、
+  書き込み（bump_room_version・部屋の削除）のたびに削除する
+- プレイヤー一覧・累計成績・描画済みの部分テンプレート: 部屋コードとバージョンをキーにする。
+  書き込みでバージョンが変わればキーも変わるため、古い値を削除する必要はない
+  （MAHJONG_CACHE_VERSION_SECONDS で期限切れになる）
+- 描画済みのゲームの行: ゲームIDと Room.rows_version をキーにする。記録済みのゲームの行は
+  プレイヤー編集・再計算（rows_versionが変わる）かゲームの削除までは変わらないため、
+  新しいゲームが追加されても既存の行は描画し直さない
+
+キャッシュのバックエンドは settings.CACHES で選ぶ（MAHJONG_CACHE_BACKEND）。
+locmem はワーカーごとのキャッシュなので、他のワーカーの書き込みが反映されるまで
+最大 MAHJONG_CACHE_ROOM_SECONDS かかる。複数ワーカーでは file か redis を使う。
+
+取得の関数は非同期ビューから使うコルーチン（aget_*）。
+キャッシュにない値の計算は mahjong.singleflight で同時実行をまとめる。
+ヒット・ミスの回数はワーカーごとに数え、stats.snapshot() で取得できる
+（single-flight のヒットは、他のリクエストの計算結果を使った回数）。
+"""
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.safestring import mark_safe
+
+from .models import Player, Room
+from .singleflight import acompute_once, flight
+
+KEY_PREFIX = 'mahjong:room'
+_MISSING = object()
+
+
+def _cache():
+    return caches[getattr(settings, 'MAHJONG_CACHE_ALIAS', 'default')]
+
+
+def _room_seconds():
+    return getattr(settings, 'MAHJONG_CACHE_ROOM_SECONDS', 5)
+
+
+def _version_seconds():
+    return getattr(settings, 'MAHJONG_CACHE_VERSION_SECONDS', 3600)
+
+
+class CacheStats:
+    """種類ごとのヒット・ミスの回数（ワーカー内）"""
+
+    def __init__(self):
+        self._counts = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self._lock = threading.Lock()
+
+    def record(self, kind, hit):
+        self.add(kind, hits=int(hit), misses=int(not hit))
+
+    def add(self, kind, hits=0, misses=0):
+        with self._lock:
+            counts = self._counts[kind]
+            counts['hits'] += hits
+            counts['misses'] += misses
+
+    def snapshot(self):
+        with self._lock:
+            return {kind: dict(counts) for kind, counts in self._counts.items()}
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = CacheStats()
+
+
+def room_key(room_code):
+    return f'{KEY_PREFIX}:{room_code}'
+
+
+def version_key(room, name):
+    return f'{KEY_PREFIX}:{room.code}:v{room.version}:{name}'
+
+
+async def aget_room(room_code):
+    """部屋コードからRoomを取得（なければ Room.DoesNotExist）"""
+    key = room_key(room_code)
+    room = await _cache().aget(key)
+    stats.record('room', room is not None)
+    if room is None:
+        room = await Room.objects.aget(code=room_code)
+        await _cache().aset(key, room, _room_seconds())
+    return room
+
+
+async def aget_or_set(room, name, compute):
+    """部屋のバージョンごとの値を取得し、なければ await compute() の結果を保存"""
+    key = version_key(room, name)
+    value = await _cache().aget(key, _MISSING)
+    stats.record(name, value is not _MISSING)
+    if value is _MISSING:
+        # 同じ値を計算中のリクエストがあればその結果を使う（ワーカー間は add() がアトミックなバックエンドだけ）
+        (value, from_other_worker), shared = await flight.do(
+            key, lambda: acompute_once(_cache(), key, compute, _version_seconds())
+        )
+        stats.record('single-flight', shared or from_other_worker)
+    return value
+
+
+async def aget_players(room):
+    """部屋のプレイヤー一覧（順番どおり）"""
+    async def load():
+        return [player async for player in Player.objects.filter(room=room).order_by('order')]
+    return await aget_or_set(room, 'players', load)
+
+
+async def aget_rendered(room, name, render):
+    """描画済みの部分テンプレート（renderは文字列を返すコルーチン関数）"""
+    async def render_str():
+        return str(await render())
+    return mark_safe(await aget_or_set(room, f'partial:{name}', render_str))
+
+
+def game_row_key(room, game_id):
+    return f'{KEY_PREFIX}:{room.code}:r{room.rows_version}:game:{game_id}'
+
+
+async def aget_fragments(keys, render_missing, kind='game-row'):
+    """
+    keysの順に描画済みのHTMLを連結して返す
+
+    キャッシュにないキーは await render_missing(キーのリスト) で {キー: HTML} を作り、保存する。
+    """
+    cached = await _cache().aget_many(keys)
+    missing = [key for key in keys if key not in cached]
+    stats.add(kind, hits=len(keys) - len(missing), misses=len(missing))
+    if missing:
+        rendered = {key: str(html) for key, html in (await render_missing(missing)).items()}
+        await _cache().aset_many(rendered, _version_seconds())
+        cached.update(rendered)
+    return mark_safe(''.join(cached[key] for key in keys))
+
+
+def invalidate_room(room_code):
+    """
+    部屋のキャッシュを削除
+
+    すぐに削除したうえで、コミット後にもう一度削除する（コミット前に他のリクエストが
+    古い状態をキャッシュした場合に備える）。
+    """
+    _cache().delete(room_key(room_code))
+    transaction.on_commit(lambda: _cache().delete(room_key(room_code)))
@@ -0,0 +1,17 @@
+"""
+システムチェック（python manage.py check --deploy）
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+@register(Tags.security, deploy=True)
+def check_room_code_key(app_configs, **kwargs):
+    """本番では部屋コードの置換の鍵（MAHJONG_ROOM_CODE_KEY）を必須にする"""
+    if settings.DEBUG or getattr(settings, 'MAHJONG_ROOM_CODE_KEY', ''):
+        return []
+    return [Error(
+        'MAHJONG_ROOM_CODE_KEY が設定されていません。',
+        hint='すべてのワーカーで同じ値を設定し、運用開始後は変えないでください（未設定では開発用の固定の鍵を使います）。',
+        id='mahjong.E001',
+    )]
@@ -0,0 +1,137 @@
+"""
+部屋の変更通知（Server-Sent Events）
+
+ワーカープロセスごとに、接続中のクライアントがいる部屋1つにつき1つの監視タスクが
+SQLiteの Room.version を一定間隔で確認し、変化があれば全接続に通知する。
+接続数が増えても確認のクエリは部屋ごとに1本のままで、待機中の接続は
+コルーチンが止まっているだけなので負荷にならない。
+
+書き込みは別のワーカーで行われることがあるため、プロセス内の通知ではなく
+データベースのバージョンを共有の通知元として使う。
+"""
+import asyncio
+
+from django.conf import settings
+
+from .models import Room
+
+# 部屋が削除された場合のバージョン
+ROOM_DELETED = -1
+
+
+def _poll_seconds():
+    return getattr(settings, 'MAHJONG_EVENTS_POLL_SECONDS', 2.0)
+
+
+def _keepalive_seconds():
+    return getattr(settings, 'MAHJONG_EVENTS_KEEPALIVE_SECONDS', 15.0)
+
+
+async def fetch_room_version(room_code):
+    """部屋の現在のバージョン（部屋がなければNone）"""
+    return await (
+        Room.objects.filter(code=room_code)
+        .values_list('version', flat=True)
+        .afirst()
+    )
+
+
+class RoomWatcher:
+    """1部屋分のバージョン監視（同じ部屋の全接続で共有）"""
+
+    def __init__(self, room_code, version):
+        self.room_code = room_code
+        self.version = version
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._poll())
+
+    async def wait_for_change(self, seen_version, timeout):
+        """seen_versionから変わるまで待ち、新しいバージョンを返す（timeout時はNone）"""
+        if self.version != seen_version:
+            return self.version
+        changed = self._changed
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.version
+
+    def _notify(self, version):
+        self.version = version
+        # 待機中の全接続を起こし、次の変化用に新しいEventに差し替える
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _poll(self):
+        while self.subscribers > 0:
+            await asyncio.sleep(_poll_seconds())
+            version = await fetch_room_version(self.room_code)
+            if version is None:
+                self._notify(ROOM_DELETED)
+                return
+            if version != self.version:
+                self._notify(version)
+
+
+class RoomEventBroker:
+    """ワーカープロセス内の部屋監視の登録簿"""
+
+    def __init__(self):
+        self._watchers = {}
+
+    def subscribe(self, room_code, version):
+        watcher = self._watchers.get(room_code)
+        if watcher is None:
+            watcher = self._watchers[room_code] = RoomWatcher(room_code, version)
+        watcher.subscribers += 1
+        watcher.start()
+        return watcher
+
+    def unsubscribe(self, watcher):
+        watcher.subscribers -= 1
+        if watcher.subscribers <= 0 and self._watchers.get(watcher.room_code) is watcher:
+            del self._watchers[watcher.room_code]
+
+
+broker = RoomEventBroker()
+
+
+def format_event(event, data='', event_id=None):
+    """SSEのイベント1件分の文字列"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
+
+
+async def room_event_stream(room_code, current_version, seen_version):
+    """
+    部屋の変更イベントを送り続ける非同期ジェネレータ
+
+    seen_version はクライアントが表示しているバージョン。接続前に変更が
+    あった場合は、接続直後に room-changed を送る。
+    """
+    watcher = broker.subscribe(room_code, current_version)
+    try:
+        # 切断時の再接続間隔（ミリ秒）
+        yield 'retry: 5000\n\n'
+        while True:
+            version = await watcher.wait_for_change(seen_version, _keepalive_seconds())
+            if version is None:
+                # プロキシに接続を切られないようにコメント行を送る
+                yield ': keepalive\n\n'
+                continue
+            if version == ROOM_DELETED:
+                yield format_event('room-deleted')
+                return
+            seen_version = version
+            yield format_event('room-changed', version, event_id=version)
+    finally:
+        broker.unsubscribe(watcher)
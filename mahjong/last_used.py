@@ -0,0 +1,128 @@
+"""
+部屋の最終使用時刻（Room.last_used_at）の記録
+
+ダッシュボードの表示やHTMXのポーリングのたびに UPDATE すると、読み取りの
+リクエストがSQLiteの書き込みロックを取り合うことになる。そこで
+
+1. 保存済みの値が MAHJONG_LAST_USED_GRANULARITY_SECONDS より新しければ何もしない
+2. 古い場合もワーカー内に溜めておき、MAHJONG_LAST_USED_FLUSH_SECONDS ごとに
+   まとめて書き込む（分単位に切り捨てた使用時刻ごとに1つの UPDATE 文）
+
+書き込みは、間隔を過ぎた後の使用の記録か、最初に溜めたときに始めるタイマーで行うため、
+その後リクエストが来なくても溜めた使用時刻は書き込まれる。
+最終使用時刻の誤差は最大で「粒度 + 書き込み間隔」程度になるが、
+24時間単位の古い部屋の削除（cleanup_old_rooms）には十分な精度。
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .models import Room
+
+logger = logging.getLogger(__name__)
+
+
+def _granularity():
+    return timedelta(seconds=getattr(settings, 'MAHJONG_LAST_USED_GRANULARITY_SECONDS', 300))
+
+
+def _flush_seconds():
+    return getattr(settings, 'MAHJONG_LAST_USED_FLUSH_SECONDS', 60)
+
+
+class LastUsedTracker:
+    """ワーカー内で部屋の使用を溜めて、まとめて書き込む"""
+
+    def __init__(self):
+        self._pending = {}  # room_id -> 使用時刻
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._timer = None
+
+    def touch(self, room):
+        """部屋が使われたことを記録"""
+        if self._record(room):
+            self.flush()
+
+    async def atouch(self, room):
+        """touchの非同期版"""
+        if self._record(room):
+            await self.aflush()
+
+    def _record(self, room):
+        """使用時刻を溜め、書き込む時期になっていればTrueを返す"""
+        now = timezone.now()
+        if room.last_used_at is not None and now - room.last_used_at < _granularity():
+            return False
+        with self._lock:
+            self._pending[room.pk] = now
+            due = time.monotonic() - self._last_flush >= _flush_seconds()
+            if not due and self._timer is None:
+                self._start_timer()
+            return due
+
+    def _start_timer(self):
+        """書き込み間隔の後に溜めた分を書き込むタイマーを始める（ロックを持って呼ぶ）"""
+        self._timer = threading.Timer(_flush_seconds(), self._flush_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            logger.warning('last_used_at flush failed', exc_info=True)
+        finally:
+            # タイマーのスレッドの接続は、リクエストの終了時に閉じられないため
+            connections.close_all()
+
+    def flush(self):
+        """溜めている使用時刻を書き込み、更新した部屋数を返す"""
+        return sum(query.update(last_used_at=used_at) for query, used_at in self._take_pending())
+
+    async def aflush(self):
+        """flushの非同期版"""
+        updated = 0
+        for query, used_at in self._take_pending():
+            updated += await query.aupdate(last_used_at=used_at)
+        return updated
+
+    def _take_pending(self):
+        """溜めている使用時刻を取り出し、(更新する部屋のクエリセット, 時刻) の列を返す"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        # 部屋ごとの使用時刻を分単位に切り捨て、同じ時刻の部屋を1つのUPDATE文にまとめる
+        # （他のワーカーが書き込んだより新しい値は戻さない）
+        rooms_by_time = defaultdict(list)
+        for room_id, used_at in pending.items():
+            rooms_by_time[used_at.replace(second=0, microsecond=0)].append(room_id)
+        return [
+            (Room.objects.filter(pk__in=room_ids, last_used_at__lt=used_at), used_at)
+            for used_at, room_ids in sorted(rooms_by_time.items())
+        ]
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+
+tracker = LastUsedTracker()
+
+
+@atexit.register
+def _flush_on_exit():
+    """ワーカー終了時に残りを書き込む"""
+    try:
+        tracker.flush()
+    except Exception:
+        logger.warning('last_used_at flush on exit failed', exc_info=True)
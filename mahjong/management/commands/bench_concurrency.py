@@ -0,0 +1,131 @@
+"""
+遅いクライアントが接続を保持している間の、ポーリングのレイテンシを計測する管理コマンド
+
+起動済みのサーバー（--url）に対して、リクエストヘッダーを少しずつしか送らない
+接続を --slow 個保持したまま、部分テンプレートへのポーリングを --polls 回送る。
+同期ワーカー（WSGI）では遅い接続がワーカーを占有するため、ワーカー数以上の
+遅い接続でポーリングがタイムアウトする。ASGIでは影響を受けない。
+
+    # ASGI（本番と同じ設定）
+    gunicorn mahjong_project.asgi:application -c gunicorn.conf.py
+    # WSGI（比較用）
+    MAHJONG_WORKER_CLASS=sync gunicorn mahjong_project.wsgi:application -c gunicorn.conf.py
+
+    python manage.py bench_concurrency --url http://127.0.0.1:8080 --room ABC123 --slow 0,2,8,32
+"""
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from mahjong.bench import format_summary, summarize
+
+
+def _parse_counts(value):
+    try:
+        return [int(count) for count in value.split(',')]
+    except ValueError:
+        raise CommandError(f'--slow はカンマ区切りの整数で指定してください: {value}')
+
+
+class Command(BaseCommand):
+    help = '遅い接続を保持したまま、部分テンプレートへのポーリングのレイテンシを計測します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8080', help='計測するサーバーのURL')
+        parser.add_argument('--room', required=True, help='ポーリングする部屋コード')
+        parser.add_argument('--slow', default='0,2,8,32', help='保持する遅い接続の数（カンマ区切りで複数）')
+        parser.add_argument('--polls', type=int, default=200, help='遅い接続ごとのポーリングの回数')
+        parser.add_argument('--concurrency', type=int, default=4, help='同時に送るポーリングの数')
+        parser.add_argument('--timeout', type=float, default=5.0, help='ポーリング1回のタイムアウト（秒）')
+        parser.add_argument('--drip', type=float, default=1.0, help='遅い接続がヘッダーを1行送る間隔（秒）')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http' or not url.hostname:
+            raise CommandError('--url は http://host:port で指定してください')
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = reverse('mahjong:game_list_partial', args=[options['room']])
+        for slow in _parse_counts(options['slow']):
+            asyncio.run(self._run(slow, options))
+
+    async def _run(self, slow, options):
+        stop = asyncio.Event()
+        holders = [asyncio.create_task(self._hold(stop, options['drip'])) for _ in range(slow)]
+        # 遅い接続がワーカーに割り当てられるのを待つ
+        await asyncio.sleep(min(1.0, options['drip']) if slow else 0)
+
+        samples = []
+        failures = 0
+        remaining = options['polls']
+
+        async def poller():
+            nonlocal failures, remaining
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                try:
+                    status = await asyncio.wait_for(self._poll(), options['timeout'])
+                except (asyncio.TimeoutError, OSError):
+                    failures += 1
+                    continue
+                if status >= 500:
+                    failures += 1
+                else:
+                    samples.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[poller() for _ in range(options['concurrency'])])
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*holders, return_exceptions=True)
+
+        self.stdout.write(format_summary(f'遅い接続 {slow}', summarize(samples)))
+        self.stdout.write(
+            f'  {"":<28} 失敗={failures}  スループット={len(samples) / elapsed:.1f} req/s'
+        )
+
+    def _request_head(self):
+        return (
+            f'GET {self.path} HTTP/1.1\r\n'
+            f'Host: {self.host}:{self.port}\r\n'
+            'HX-Request: true\r\n'
+        )
+
+    async def _poll(self):
+        """ポーリングを1回送り、ステータスコードを返す（応答は最後まで読む）"""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write((self._request_head() + 'Connection: close\r\n\r\n').encode())
+            await writer.drain()
+            status_line = await reader.readline()
+            await reader.read()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+
+    async def _hold(self, stop, drip):
+        """ヘッダーを1行ずつゆっくり送り、stopまで接続を保持する"""
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            return
+        try:
+            writer.write(self._request_head().encode())
+            await writer.drain()
+            line = 0
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), drip)
+                except asyncio.TimeoutError:
+                    line += 1
+                    writer.write(f'X-Slow-{line}: 1\r\n'.encode())
+                    await writer.drain()
+        except OSError:
+            # サーバーが接続を切った（ヘッダーのタイムアウトなど）
+            pass
+        finally:
+            writer.close()
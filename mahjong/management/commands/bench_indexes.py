@@ -0,0 +1,126 @@
+"""
+インデックス（マイグレーション 0015_tuned_indexes）の有無で、クエリの実行計画と
+レイテンシを比較する管理コマンド
+
+一時ファイルのデータベースを 0015 の前までマイグレーションし、--rooms 部屋 × --games 半荘と、
+--large-games 半荘の大きな部屋1つ、スコア記録のない --idle-rooms 部屋（最終使用時刻は
+過去72時間に分散）を入れてから
+
+1. インデックスなしで各クエリの EXPLAIN QUERY PLAN と所要時間（中央値）を計測
+2. 0015 を適用（インデックスの作成時間も出力）して、同じクエリを計測
+
+する。クエリはアプリが発行するものと同じ形（player_totals_from_records など）にしている。
+"""
+import time
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import QuerySet, Sum
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from mahjong.bench import seed_room, summarize, temporary_database, timed_for
+from mahjong.models import Game, Player, Room, ScoreRecord
+from mahjong.services import player_totals_from_records
+
+BEFORE_MIGRATION = '0014_room_rows_version'
+INDEX_MIGRATION = '0015_tuned_indexes'
+
+
+def _cases(room, players):
+    """(ケース名, クエリセット, クエリセットを実行する関数) の列"""
+    totals = player_totals_from_records()
+    player_totals = (
+        Player.objects.filter(room=room)
+        .annotate(points_sum=totals['total_points'], chips_sum=totals['total_chips'])
+        .values_list('points_sum', 'chips_sum')
+    )
+    # プレイヤー1人のスコア記録の合計（ScoreRecord.objects.filter(player=...) の集計）
+    player_records = (
+        ScoreRecord.objects.filter(player=players[0]).order_by().values('player')
+        .annotate(points=Sum('points'), chips=Sum('chip_change')).values('points', 'chips')
+    )
+    cutoff = timezone.now() - timedelta(hours=24)
+    old_rooms = Room.objects.filter(last_used_at__lt=cutoff).order_by().values('pk')
+    active = Room.objects.filter(last_used_at__gte=timezone.now() - timedelta(minutes=10)).order_by()
+    game_page = Game.objects.filter(room=room).order_by('-game_number').values_list('id', 'game_number')[:51]
+    delete_player_records = ScoreRecord.objects.filter(player__in=players).order_by().values_list('pk')
+    return [
+        ('player_totals', player_totals, list),
+        ('player_records_sum', player_records, list),
+        ('old_rooms', old_rooms, QuerySet.count),
+        # mahjong.metrics.active_rooms と同じクエリ
+        ('active_rooms', active, QuerySet.count),
+        ('game_page', game_page, list),
+        # プレイヤーの削除時にカスケード削除するスコア記録の収集
+        ('delete_player_records', delete_player_records, list),
+    ]
+
+
+def query_plan(queryset):
+    """EXPLAIN QUERY PLAN の各行の説明"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+class Command(BaseCommand):
+    help = 'インデックス（0015_tuned_indexes）の有無でクエリの実行計画とレイテンシを比較します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50, help='スコア記録のある部屋の数')
+        parser.add_argument('--games', type=int, default=1000, help='部屋あたりの半荘数')
+        parser.add_argument('--large-games', type=int, default=100000, help='大きな部屋の半荘数（計測の対象）')
+        parser.add_argument('--idle-rooms', type=int, default=20000, help='スコア記録のない部屋の数')
+        parser.add_argument('--min-time', type=float, default=0.5, help='ケースごとの最小の計測時間（秒）')
+        parser.add_argument('--dir', default=None, help='一時データベースを作るディレクトリ')
+
+    def handle(self, *args, **options):
+        with temporary_database(options['dir']):
+            call_command('migrate', 'mahjong', BEFORE_MIGRATION, verbosity=0)
+            started = time.perf_counter()
+            room, players = self._seed(options)
+            self.stdout.write(f'データの作成: {time.perf_counter() - started:.1f}秒')
+
+            before = self._measure('インデックスなし', room, players, options['min_time'])
+
+            started = time.perf_counter()
+            call_command('migrate', 'mahjong', INDEX_MIGRATION, verbosity=0)
+            self.stdout.write(f'{INDEX_MIGRATION} の適用: {time.perf_counter() - started:.1f}秒')
+            after = self._measure('インデックスあり', room, players, options['min_time'])
+
+        self.stdout.write(self.style.MIGRATE_HEADING('比較（p50）'))
+        for name, before_ms in before.items():
+            after_ms = after[name]
+            self.stdout.write(
+                f'  {name:<24} {before_ms:10.3f}ms -> {after_ms:10.3f}ms  ({before_ms / after_ms:6.1f}倍速)'
+            )
+
+    def _seed(self, options):
+        for index in range(options['rooms']):
+            seed_room(options['games'], seed=index)
+        room, players = seed_room(options['large_games'], seed=options['rooms'])
+        Room.objects.bulk_create([Room() for _ in range(options['idle_rooms'])], batch_size=1000)
+        # 最終使用時刻を過去72時間に分散させる（大きな部屋は今使われている）
+        now = timezone.now()
+        idle = Room.objects.exclude(pk=room.pk).annotate(bucket=Mod('id', 72))
+        for hours in range(72):
+            idle.filter(bucket=hours).update(last_used_at=now - timedelta(hours=hours))
+        return room, players
+
+    def _measure(self, label, room, players, min_time):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write(self.style.MIGRATE_HEADING(label))
+        results = {}
+        for name, queryset, run in _cases(room, players):
+            # 毎回 .all() で複製して、クエリセットの結果のキャッシュを使わない
+            summary = summarize(timed_for(lambda: run(queryset.all()), min_time, min_repeat=3))
+            results[name] = summary['p50_ms']
+            self.stdout.write(f'  {name:<24} p50={summary["p50_ms"]:10.3f}ms  n={summary["count"]}')
+            for line in query_plan(queryset):
+                self.stdout.write(f'      {line}')
+        return results
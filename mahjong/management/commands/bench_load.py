@@ -0,0 +1,291 @@
+"""
+複数の卓が同時にポーリング・スコア記録をする負荷を再現する管理コマンド
+
+部屋を --rooms 個作り、各部屋で --clients 台のクライアント（スマートフォン）が
+ダッシュボードを開いて、サーバーが返すポーリング間隔（X-Poll-Interval）どおりに
+部分テンプレートをポーリングする。各部屋の1台は --record-seconds ごとに
+スコア記録（record_score のPOST）も送る。
+
+- --url を指定しない場合: 一時ファイルのデータベースで、アプリをこのプロセス内で
+  動かす（クライアントごとのスレッドとDjangoのテストクライアント）。GILがあるため
+  絶対値は本番より悪いが、SQLiteのロック待ちのエラーや回帰の検出に使える
+- --url を指定した場合: 起動済みのサーバーにHTTPで送る（ワーカー数の見積もりに使う）
+
+--speedup で時間を縮める（ポーリング間隔と記録の間隔を speedup 分の1にする）。
+ビューごとのレイテンシ（p50/p95/p99）・ステータスコード・スループットと、
+SQLiteのロック待ち（database is locked）のエラーの数を出力する。
+"""
+import http.cookiejar
+import logging
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from mahjong.bench import format_summary, summarize, temporary_database
+
+LOCKED_MESSAGE = 'database is locked'
+SCORES = [40000, 30000, 20000, 10000]
+
+_CSRF_RE = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+_SCORE_RE = re.compile(r'name="score_(\d+)"')
+
+
+class _Results:
+    """ビューごとの計測値（スレッド間で共有）"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.lock_errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, view, seconds, status):
+        with self._lock:
+            self.samples[view].append(seconds)
+            self.statuses[view][status] += 1
+
+    def add_lock_error(self):
+        with self._lock:
+            self.lock_errors += 1
+
+
+class _LockErrorHandler(logging.Handler):
+    """アプリのログから、SQLiteのロック待ちで失敗した書き込みを数える（プロセス内のみ）"""
+
+    def __init__(self, results):
+        super().__init__(logging.ERROR)
+        self.results = results
+
+    def emit(self, record):
+        text = record.getMessage()
+        if record.exc_info and record.exc_info[1] is not None:
+            text += str(record.exc_info[1])
+        if LOCKED_MESSAGE in text:
+            self.results.add_lock_error()
+
+
+class _InProcessTransport:
+    """このプロセス内のアプリにテストクライアントで送る"""
+
+    def __init__(self, results):
+        self.client = Client(raise_request_exception=False)
+        self.results = results
+
+    def request(self, method, path, data=None, headers=None):
+        headers = {f'HTTP_{name.upper().replace("-", "_")}': value for name, value in (headers or {}).items()}
+        if method == 'POST':
+            response = self.client.post(path, data or {}, **headers)
+        else:
+            response = self.client.get(path, **headers)
+        exc_info = getattr(response, 'exc_info', None)
+        if exc_info and LOCKED_MESSAGE in str(exc_info[1]):
+            self.results.add_lock_error()
+        return response.status_code, response, response.content.decode()
+
+    def close(self):
+        connections.close_all()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _HttpTransport:
+    """起動済みのサーバーにHTTPで送る（Cookieはクライアントごと）"""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+
+    def request(self, method, path, data=None, headers=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.headers, response.read().decode()
+        except urllib.error.HTTPError as e:
+            # 3xx・304・4xx・5xx
+            return e.code, e.headers, e.read().decode(errors='replace')
+        except OSError:
+            return 0, {}, ''
+
+    def close(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = '複数の卓のポーリングとスコア記録を同時に再現し、ビューごとのレイテンシを計測します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None, help='計測するサーバーのURL（省略時はプロセス内で動かす）')
+        parser.add_argument('--rooms', type=int, default=10, help='同時に使われる部屋（卓）の数')
+        parser.add_argument('--clients', type=int, default=4, help='部屋ごとのクライアントの数')
+        parser.add_argument('--duration', type=float, default=60.0, help='計測する秒数（実時間）')
+        parser.add_argument('--record-seconds', type=float, default=300.0, help='部屋ごとのスコア記録の間隔（秒）')
+        parser.add_argument('--speedup', type=float, default=10.0, help='ポーリング・記録の間隔を縮める倍率')
+        parser.add_argument('--timeout', type=float, default=10.0, help='HTTPのタイムアウト（秒、--url 指定時）')
+        parser.add_argument('--dir', default=None, help='プロセス内で動かす場合の一時データベースのディレクトリ')
+
+    def handle(self, *args, **options):
+        if options['rooms'] < 1 or options['clients'] < 1 or options['speedup'] <= 0:
+            raise CommandError('--rooms・--clients は1以上、--speedup は正の値を指定してください')
+        results = _Results()
+        if options['url']:
+            self._run(lambda: _HttpTransport(options['url'], options['timeout']), results, options)
+        else:
+            handler = _LockErrorHandler(results)
+            logger = logging.getLogger('mahjong')
+            logger.addHandler(handler)
+            try:
+                with temporary_database(options['dir']), override_settings(ALLOWED_HOSTS=['testserver']):
+                    self._run(lambda: _InProcessTransport(results), results, options)
+            finally:
+                logger.removeHandler(handler)
+        self._report(results, options)
+
+    def _run(self, transport_factory, results, options):
+        # 部屋の作成とプレイヤー登録は計測の前に済ませる
+        rooms = [self._create_room(transport_factory(), index) for index in range(options['rooms'])]
+        self.stdout.write(f'{len(rooms)}部屋 × {options["clients"]}クライアントで{options["duration"]:.0f}秒計測します')
+
+        deadline = time.monotonic() + options['duration']
+        threads = []
+        for room in rooms:
+            for index in range(options['clients']):
+                recorder = room if index == 0 else None
+                thread = threading.Thread(
+                    target=self._client,
+                    args=(transport_factory, results, room['code'], recorder, deadline, options),
+                    daemon=True,
+                )
+                threads.append(thread)
+        self.started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.monotonic() - self.started
+
+    def _create_room(self, transport, index):
+        """トップ画面から部屋を作り、プレイヤーを登録して、記録に使う値を返す"""
+        _, _, html = transport.request('GET', reverse('mahjong:index'))
+        status, headers, _ = transport.request('POST', reverse('mahjong:create_room'), {
+            'csrfmiddlewaretoken': self._csrf_token(html),
+        })
+        match = re.search(r'/room/([^/]+)/setup/', headers.get('Location', '')) if status == 302 else None
+        if match is None:
+            raise CommandError(f'部屋を作成できませんでした（status={status}）')
+        code = match.group(1)
+        setup = reverse('mahjong:room_setup', args=[code])
+        _, _, html = transport.request('GET', setup)
+        transport.request('POST', setup, {
+            'csrfmiddlewaretoken': self._csrf_token(html),
+            **{f'player_{i}': f'卓{index + 1}-{i}' for i in range(1, 5)},
+        })
+        _, _, html = transport.request('GET', reverse('mahjong:record_score', args=[code]))
+        player_ids = _SCORE_RE.findall(html)
+        if len(player_ids) != 4:
+            raise CommandError(f'部屋 {code} のプレイヤーを登録できませんでした')
+        transport.close()
+        return {'code': code, 'player_ids': player_ids}
+
+    @staticmethod
+    def _csrf_token(html):
+        match = _CSRF_RE.search(html)
+        return match.group(1) if match else ''
+
+    def _client(self, transport_factory, results, code, recorder, deadline, options):
+        """1台のクライアント: ダッシュボードを開き、ポーリングを続ける（recorderなら記録もする）"""
+        transport = transport_factory()
+        speedup = options['speedup']
+        urls = {
+            'game_list_partial': reverse('mahjong:game_list_partial', args=[code]),
+            'player_stats_partial': reverse('mahjong:player_stats_partial', args=[code]),
+        }
+        etags = {}
+        version = None
+
+        def timed_request(view, method, path, data=None, headers=None):
+            started = time.perf_counter()
+            response = transport.request(method, path, data, headers)
+            results.add(view, time.perf_counter() - started, response[0])
+            return response
+
+        try:
+            timed_request('room_dashboard', 'GET', reverse('mahjong:room_dashboard', args=[code]))
+            interval = settings.MAHJONG_POLL_MIN_SECONDS
+            # 同じ部屋のクライアントが同時にポーリングし始めないようにずらす
+            next_poll = time.monotonic() + random.uniform(0, interval / speedup)
+            next_record = time.monotonic() + options['record_seconds'] / speedup if recorder else None
+            while True:
+                now = time.monotonic()
+                wake = min(t for t in (next_poll, next_record, deadline) if t is not None)
+                if wake > now:
+                    time.sleep(wake - now)
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if next_record is not None and now >= next_record:
+                    self._record(results, transport, code, recorder)
+                    next_record = now + options['record_seconds'] / speedup
+                if next_poll is not None and now >= next_poll:
+                    stop = False
+                    for view, path in urls.items():
+                        headers = {'HX-Request': 'true'}
+                        if view in etags:
+                            headers['If-None-Match'] = etags[view]
+                        if view == 'game_list_partial' and version is not None:
+                            path = f'{path}?since={version}'
+                        status, response_headers, _ = timed_request(view, 'GET', path, headers=headers)
+                        if status == 200:
+                            etags[view] = response_headers.get('ETag')
+                            if view == 'game_list_partial':
+                                version = response_headers.get('X-Room-Version')
+                        interval = int(response_headers.get('X-Poll-Interval') or interval)
+                        stop = stop or status == 286
+                    # 286（ポーリングの停止）を受けたら、このクライアントはポーリングしない
+                    next_poll = None if stop else now + interval / speedup
+        finally:
+            transport.close()
+
+    def _record(self, results, transport, code, recorder):
+        """スコア入力画面を開いてスコアを記録する（保存できたかをステータスに記録）"""
+        path = reverse('mahjong:record_score', args=[code])
+        _, _, html = transport.request('GET', path)
+        data = {'csrfmiddlewaretoken': self._csrf_token(html)}
+        for player_id, score in zip(recorder['player_ids'], random.sample(SCORES, len(SCORES))):
+            data[f'score_{player_id}'] = score
+            data[f'chip_{player_id}'] = 0
+        started = time.perf_counter()
+        status, headers, _ = transport.request('POST', path, data)
+        if status == 302:
+            # 保存に失敗するとスコア入力画面に戻される
+            status = 'failed' if headers.get('Location', '').endswith('/record-score/') else 'saved'
+        results.add('record_score', time.perf_counter() - started, status)
+
+    def _report(self, results, options):
+        total = 0
+        for view in sorted(results.samples):
+            samples = results.samples[view]
+            total += len(samples)
+            self.stdout.write(format_summary(view, summarize(samples)))
+            statuses = ' '.join(f'{status}={count}' for status, count in sorted(results.statuses[view].items(), key=str))
+            self.stdout.write(f'  {"":<26} {statuses}')
+        self.stdout.write(f'スループット: {total / self.elapsed:.1f} req/s（{total}リクエスト / {self.elapsed:.1f}秒）')
+        lock_errors = 'プロセス内でのみ計測' if options['url'] else results.lock_errors
+        self.stdout.write(f'SQLiteのロック待ちのエラー: {lock_errors}')
@@ -0,0 +1,154 @@
+"""
+スコア計算・集計・描画のホットパスのマイクロベンチマーク
+
+部屋あたり --sizes 半荘（既定: 10・1,000・100,000）のデータで、次のケースの
+1回あたりの所要時間（中央値）を計測する。
+
+- score_games: 持ち点行列からの順位・ポイントの一括計算（NumPy）
+- player_totals: スコア記録からのプレイヤーごとの累計成績の集計（SQL）
+- player_stats: ダッシュボードの累計成績の行の組み立て（Playerの累計値から）
+- game_page: 最新ページの games_data の組み立て（スコア記録込み）
+- render_game_list: ゲームリストの部分テンプレートの描画（キャッシュなし）
+- render_player_stats: 累計成績の部分テンプレートの描画
+
+結果は基準値（--baseline、既定は mahjong/bench_baseline.json）と比較し、
+--threshold を超えて遅くなったケースがあれば失敗（終了コード1）にする。
+基準値は計測したマシンに依存するため、マシンを変えたら --save-baseline で取り直す。
+一時ファイルのデータベースで計測するため、本番のデータベースには触れない。
+"""
+import json
+import platform
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import get_template, render_to_string
+
+from mahjong.bench import compare_to_baseline, seed_room, summarize, temporary_database, timed_for
+from mahjong.models import Player
+from mahjong.read_models import RoomReadModel
+from mahjong.scoring import compile_rules, score_games
+from mahjong.services import player_totals_from_records
+
+DEFAULT_BASELINE = Path(__file__).resolve().parents[2] / 'bench_baseline.json'
+DEFAULT_SIZES = '10,1000,100000'
+
+
+def _game_list_context(read_model, page):
+    template = get_template('mahjong/partials/game_row.html')
+    context = read_model.context(player_stats=False)
+    context.update(read_model.page_context(page))
+    context['game_rows_html'] = ''.join(
+        template.render({'room': read_model.room, 'game_data': row}) for row in page.rows
+    )
+    return context
+
+
+def _cases(room, players, games):
+    """(ケース名, 計測する関数) の列"""
+    rules = compile_rules(room)
+    rng = np.random.default_rng(0)
+    scores = rng.integers(0, 1000, size=(games, 4)) * 100
+    read_model = RoomReadModel(room, players)
+    page = read_model.game_page()
+
+    def player_totals():
+        totals = player_totals_from_records()
+        return list(
+            Player.objects.filter(room=room)
+            .annotate(points_sum=totals['total_points'], chips_sum=totals['total_chips'])
+            .values_list('points_sum', 'chips_sum')
+        )
+
+    return [
+        ('score_games', lambda: score_games(rules, scores)),
+        ('player_totals', player_totals),
+        ('player_stats', lambda: RoomReadModel(room, players).player_stats),
+        ('game_page', lambda: RoomReadModel(room, players).game_page()),
+        ('render_game_list', lambda: render_to_string(
+            'mahjong/partials/game_list.html', _game_list_context(read_model, page)
+        )),
+        ('render_player_stats', lambda: render_to_string(
+            'mahjong/partials/player_stats.html', read_model.context()
+        )),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'スコア計算・集計・描画のマイクロベンチマークを実行し、基準値と比較します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=DEFAULT_SIZES, help='部屋あたりの半荘数（カンマ区切り）')
+        parser.add_argument('--cases', default=None, help='計測するケース（カンマ区切り、省略時はすべて）')
+        parser.add_argument('--min-time', type=float, default=0.5, help='ケースごとの最小の計測時間（秒）')
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help='基準値のJSONファイル')
+        parser.add_argument('--save-baseline', action='store_true', help='計測結果を基準値として保存する')
+        parser.add_argument('--threshold', type=float, default=0.25, help='回帰とみなす遅くなった割合（0.25 = 25%%）')
+        parser.add_argument(
+            '--min-delta-ms', type=float, default=0.05,
+            help='回帰とみなす最小の差（ミリ秒、数マイクロ秒のケースの揺らぎを除く）',
+        )
+        parser.add_argument('--dir', default=None, help='一時データベースを作るディレクトリ')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError(f'--sizes はカンマ区切りの整数で指定してください: {options["sizes"]}')
+        selected = set(options['cases'].split(',')) if options['cases'] else None
+
+        results = {}
+        with temporary_database(options['dir']):
+            for games in sizes:
+                self.stdout.write(self.style.MIGRATE_HEADING(f'{games:,}半荘'))
+                room, players = seed_room(games)
+                for name, func in _cases(room, players, games):
+                    if selected is not None and name not in selected:
+                        continue
+                    summary = summarize(timed_for(func, options['min_time'], min_repeat=3))
+                    results.setdefault(name, {})[str(games)] = round(summary['p50_ms'], 4)
+                    self.stdout.write(
+                        f'  {name:<22} p50={summary["p50_ms"]:10.3f}ms  '
+                        f'p95={summary["p95_ms"]:10.3f}ms  n={summary["count"]}'
+                    )
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            self._save_baseline(baseline_path, results)
+            return
+        if not baseline_path.exists():
+            self.stdout.write(f'基準値がありません（{baseline_path}）。--save-baseline で保存してください。')
+            return
+        self._compare(
+            results, json.loads(baseline_path.read_text()), options['threshold'], options['min_delta_ms']
+        )
+
+    def _save_baseline(self, path, results):
+        # 既存の基準値に、今回計測したケース・サイズだけを上書きする
+        baseline = json.loads(path.read_text()) if path.exists() else {}
+        for name, sizes in results.items():
+            baseline.setdefault('results', {}).setdefault(name, {}).update(sizes)
+        baseline['environment'] = {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+        }
+        path.write_text(json.dumps(baseline, indent=2, ensure_ascii=False, sort_keys=True) + '\n')
+        self.stdout.write(self.style.SUCCESS(f'基準値を保存しました: {path}'))
+
+    def _compare(self, results, baseline, threshold, min_delta_ms):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'基準値との比較（許容: +{threshold:.0%}）'))
+        regressions = []
+        for comparison in compare_to_baseline(results, baseline.get('results', {})):
+            regressed = comparison.regressed(threshold, min_delta_ms)
+            line = (
+                f'  {comparison.name:<22} {comparison.size:>7}半荘  '
+                f'{comparison.baseline_ms:10.3f}ms -> {comparison.current_ms:10.3f}ms  ({comparison.ratio:5.2f}倍)'
+            )
+            if regressed:
+                regressions.append(comparison)
+                self.stdout.write(self.style.ERROR(line + '  回帰'))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f'{len(regressions)}件のケースが基準値より{threshold:.0%}を超えて遅くなりました')
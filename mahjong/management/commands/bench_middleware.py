@@ -0,0 +1,69 @@
+"""
+ポーリングのリクエスト1回あたりのミドルウェアのオーバーヘッドを計測する管理コマンド
+
+同じ部分テンプレートへのポーリングを、すべてのミドルウェアを通す場合
+（LeanPathMiddlewareなし）と軽量な経路の場合で比較する。ビューの処理を最小にするため、
+主に変更なし（If-None-Match が一致して304）の応答を計測する。
+軽量な経路の対象外のビュー（トップページ）も計測し、LeanPathMiddleware を置いたことによる
+対象外のリクエストのオーバーヘッドも確認する。
+
+一時ファイルのデータベースで計測するため、本番のデータベースには触れない。
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from mahjong.bench import format_summary, summarize, temporary_database, timed
+from mahjong.models import Player, Room
+from mahjong.services import record_game
+from mahjong.views import room_etag
+
+LEAN_MIDDLEWARE = 'mahjong.middleware.LeanPathMiddleware'
+
+
+class Command(BaseCommand):
+    help = 'ポーリングのリクエスト1回あたりのミドルウェアのオーバーヘッドを比較します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='計測するリクエストの回数')
+
+    def handle(self, *args, **options):
+        full = [path for path in settings.MIDDLEWARE if path != LEAN_MIDDLEWARE]
+        # 軽量な経路の前に置いたミドルウェア（ServerTimingMiddlewareなど）は軽量な経路でも通る
+        before_lean = settings.MIDDLEWARE.index(LEAN_MIDDLEWARE) if LEAN_MIDDLEWARE in settings.MIDDLEWARE else 0
+        lean = full[:before_lean] + [LEAN_MIDDLEWARE] + full[before_lean:]
+        # (見出し, MIDDLEWARE, ポーリングで通るミドルウェアの数)
+        profiles = [
+            ('すべてのミドルウェア', full, len(full)),
+            ('軽量な経路', lean, before_lean + 1 + len(settings.MAHJONG_LEAN_MIDDLEWARE)),
+        ]
+        with temporary_database():
+            room = Room.objects.create()
+            players = [Player.objects.create(room=room, name=f'P{i}', order=i) for i in range(1, 5)]
+            record_game(room, [(player, score, 0) for player, score in zip(players, [40000, 30000, 20000, 10000])])
+            room.refresh_from_db()
+            requests = [
+                ('ゲームリスト（304）', reverse('mahjong:game_list_partial', args=[room.code]),
+                 {'HTTP_IF_NONE_MATCH': room_etag(room, 'game-list')}),
+                ('累計成績（200）', reverse('mahjong:player_stats_partial', args=[room.code]), {}),
+                ('キャッシュの統計（JSON）', reverse('mahjong:cache_stats'), {'HTTP_AUTHORIZATION': 'Bearer bench'}),
+                ('トップページ（対象外）', reverse('mahjong:index'), {}),
+            ]
+            for label, middleware, count in profiles:
+                self.stdout.write(self.style.MIGRATE_HEADING(f'{label}（ミドルウェア{count}個）'))
+                with override_settings(MIDDLEWARE=middleware, ALLOWED_HOSTS=['testserver'], MAHJONG_METRICS_TOKEN='bench'):
+                    self._run(requests, options['requests'])
+
+    def _run(self, requests, repeat):
+        client = Client()
+        # ブラウザと同じく、セッションのCookieを持った状態でポーリングする
+        client.cookies[settings.SESSION_COOKIE_NAME] = 'bench-session'
+        for label, url, headers in requests:
+            client.get(url, **headers)  # キャッシュを温める
+            with CaptureQueriesContext(connection) as queries:
+                client.get(url, **headers)
+            summary = summarize(timed(lambda: client.get(url, **headers), repeat))
+            self.stdout.write('  ' + format_summary(label, summary) + f'  queries={len(queries)}')
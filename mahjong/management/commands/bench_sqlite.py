@@ -0,0 +1,86 @@
+"""
+SQLiteの接続設定（MAHJONG_SQLITE_PRAGMAS）の有無で、スコア記録（書き込み）と
+ダッシュボード表示用データの読み込みのレイテンシを比較する管理コマンド
+
+一時ファイルのデータベースで計測するため、本番のデータベースには触れない。
+tmpfsではfsyncのコストが現れないため、--dirで本番と同じディスクを指定して実行する。
+"""
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mahjong.bench import format_summary, summarize, temporary_database, timed
+from mahjong.models import Player, Room
+from mahjong.read_models import RoomReadModel
+from mahjong.services import record_game
+
+
+class Command(BaseCommand):
+    help = 'SQLiteの接続設定の有無で書き込み・読み取りのレイテンシを比較します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=500, help='記録する半荘数（書き込みの計測回数）')
+        parser.add_argument('--reads', type=int, default=200, help='読み取りの計測回数')
+        parser.add_argument(
+            '--dir',
+            default=None,
+            help='一時データベースを作るディレクトリ（本番のデータベースと同じディスクを指定する）',
+        )
+
+    def handle(self, *args, **options):
+        profiles = [
+            ('PRAGMAなし（SQLite既定値）', {}),
+            ('MAHJONG_SQLITE_PRAGMAS', settings.MAHJONG_SQLITE_PRAGMAS),
+        ]
+        for label, pragmas in profiles:
+            with temporary_database(options['dir'], PRAGMAS=pragmas) as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    journal_mode = cursor.fetchone()[0]
+                    cursor.execute('PRAGMA synchronous')
+                    synchronous = cursor.fetchone()[0]
+                self.stdout.write(self.style.MIGRATE_HEADING(
+                    f'{label} (journal_mode={journal_mode}, synchronous={synchronous})'
+                ))
+                self._run(connection, options['games'], options['reads'])
+
+    def _run(self, connection, games, reads):
+        room = Room.objects.create()
+        players = [Player.objects.create(room=room, name=f'P{i}', order=i) for i in range(1, 5)]
+        entries = [(player, score, 0) for player, score in zip(players, [40000, 30000, 20000, 10000])]
+
+        writes = timed(lambda: record_game(room, entries), games)
+        self.stdout.write('  ' + format_summary('書き込み: record_game', summarize(writes)))
+
+        def read_dashboard():
+            read_model = RoomReadModel.for_room(Room.objects.get(pk=room.pk))
+            return read_model.game_page(), read_model.player_stats
+
+        def read_version():
+            return Room.objects.filter(code=room.code).values_list('version', flat=True).first()
+
+        self.stdout.write('  ' + format_summary(
+            f'読み取り: 最新ページ({games}半荘)', summarize(timed(read_dashboard, reads))
+        ))
+        self.stdout.write('  ' + format_summary(
+            '読み取り: 部屋のバージョン', summarize(timed(read_version, reads))
+        ))
+
+        # CONN_MAX_AGEで接続を使い回さない場合に、リクエストごとにかかる接続のコスト
+        # （journal_mode は最初の接続で適用済みのため、接続ごとのPRAGMAだけ）。
+        # スキーマの読み込みは最初のクエリで行われるため、クエリ1回までを計測する。
+        # WALモードでは最後の接続を閉じるとチェックポイントとWALファイルの削除が走るため、
+        # 他のワーカーの接続の代わりに別の接続を開いたままにする
+        def reconnect():
+            connection.close()
+            read_version()
+
+        other = sqlite3.connect(connection.settings_dict['NAME'])
+        try:
+            other.execute('SELECT 1 FROM sqlite_master').fetchall()
+            self.stdout.write('  ' + format_summary(
+                '接続のオープンと最初のクエリ（PRAGMA適用込み）', summarize(timed(reconnect, reads))
+            ))
+        finally:
+            other.close()
@@ -1,6 +1,9 @@
 """
 24時間使用されていない部屋を削除する管理コマンド
 注意: 現在は無効化されています
+
+last_used_atはワーカー内でまとめて書き込まれるため、最大で
+MAHJONG_LAST_USED_GRANULARITY_SECONDS + MAHJONG_LAST_USED_FLUSH_SECONDS 程度古い値になる
 """
 from django.core.management.base import BaseCommand
 from django.utils import timezone
@@ -0,0 +1,103 @@
+"""
+本番で計測したプロファイル（mahjong/profiling.py）をビューごとに集計する管理コマンド
+
+MAHJONG_PROFILE_DIR の計測結果をビュー（URL名）ごとにまとめ、次を出力する。
+
+- 件数・所要時間（p50・最大）・メモリのピーク（最大）
+- 関数ごとの1リクエストあたりの所要時間（--sort の順に --limit 件、全件の .prof を合算）
+- 1リクエストあたりのメモリの増加の多い行（--limit 件）
+"""
+import pstats
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mahjong.bench import percentile
+from mahjong.profiling import load_records, profile_dir
+
+SORT_KEYS = {
+    # pstatsの (呼び出し回数（再帰除く）, 呼び出し回数, 自身の時間, 累積時間, 呼び出し元) の位置
+    'cumulative': 3,
+    'tottime': 2,
+}
+
+
+def short_location(filename, lineno=None):
+    """site-packages・プロジェクトのディレクトリより前を省いたファイルの場所"""
+    for marker in ('site-packages/', f'{settings.BASE_DIR}/'):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    return filename if lineno is None else f'{filename}:{lineno}'
+
+
+class Command(BaseCommand):
+    help = '本番で計測したプロファイル（cProfile・tracemalloc）をビューごとに集計します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='計測結果のディレクトリ（省略時は MAHJONG_PROFILE_DIR）')
+        parser.add_argument('--view', default=None, help='集計するビュー（URL名の一部）')
+        parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='cumulative', help='関数の並び順')
+        parser.add_argument('--limit', type=int, default=15, help='ビューごとに表示する関数・行の数')
+
+    def handle(self, *args, **options):
+        directory = profile_dir() if options['dir'] is None else Path(options['dir'])
+        if not directory.is_dir():
+            raise CommandError(f'計測結果のディレクトリがありません: {directory}')
+
+        by_view = defaultdict(list)
+        for record in load_records(directory):
+            if options['view'] is None or options['view'] in record['view']:
+                by_view[record['view']].append(record)
+        if not by_view:
+            self.stdout.write('計測結果がありません')
+            return
+
+        for view, records in sorted(by_view.items(), key=lambda item: -len(item[1])):
+            self._summarize(view, records, options)
+
+    def _summarize(self, view, records, options):
+        durations = sorted(record['duration_ms'] for record in records)
+        peak = max(record['peak_memory_bytes'] for record in records)
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'{view}  {len(records)}件  p50={percentile(durations, 0.5):.1f}ms  '
+            f'max={durations[-1]:.1f}ms  peak={peak / 1024 / 1024:.1f}MiB'
+        ))
+
+        stats = self._load_stats(records)
+        if stats is not None:
+            self.stdout.write(f'  {"累積(ms)":>10} {"自身(ms)":>10} {"呼び出し":>8}  関数')
+            key = SORT_KEYS[options['sort']]
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][key], reverse=True)
+            count = len(records)
+            for (filename, lineno, name), (_, calls, tottime, cumtime, _) in rows[:options['limit']]:
+                self.stdout.write(
+                    f'  {cumtime * 1000 / count:10.2f} {tottime * 1000 / count:10.2f} {calls / count:8.1f}  '
+                    f'{name} ({short_location(filename, lineno)})'
+                )
+
+        allocations = defaultdict(int)
+        for record in records:
+            for allocation in record['allocations']:
+                allocations[allocation['location']] += allocation['size_diff']
+        if allocations:
+            self.stdout.write(f'  {"メモリ(KiB)":>10}  行')
+            top = sorted(allocations.items(), key=lambda item: item[1], reverse=True)[:options['limit']]
+            for location, size in top:
+                filename, _, lineno = location.rpartition(':')
+                self.stdout.write(f'  {size / 1024 / len(records):10.1f}  {short_location(filename, lineno)}')
+
+    def _load_stats(self, records):
+        """ビューのすべての .prof を合算（消えたファイルは飛ばす）"""
+        stats = None
+        for record in records:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(str(record['prof_path']))
+                else:
+                    stats.add(str(record['prof_path']))
+            except (OSError, TypeError, EOFError):
+                continue
+        return stats
@@ -0,0 +1,66 @@
+"""
+保存済みスコア記録の順位とポイントを現在の部屋設定で再計算する管理コマンド
+"""
+from django.core.management.base import BaseCommand, CommandError
+from mahjong.models import Room
+from mahjong.services import rescore_room, RESCORE_BATCH_GAMES
+
+
+class Command(BaseCommand):
+    help = '部屋の設定変更後に、保存済みのスコア記録の順位とポイントを再計算します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'room_codes',
+            nargs='*',
+            help='再計算する部屋コード（--allを指定しない場合は必須）',
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='すべての部屋を再計算する',
+        )
+        parser.add_argument(
+            '--batch-games',
+            type=int,
+            default=RESCORE_BATCH_GAMES,
+            help=f'1回の一括計算で扱う半荘数（デフォルト: {RESCORE_BATCH_GAMES}）',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_games'] < 1:
+            raise CommandError('--batch-games には1以上を指定してください。')
+        room_codes = [code.strip().upper() for code in options['room_codes']]
+        if options['all']:
+            # 再計算の書き込みと同じ接続で読むため、カーソルを開いたままにせず先に読み切る
+            rooms = list(Room.objects.order_by('id'))
+        elif room_codes:
+            rooms = list(Room.objects.filter(code__in=room_codes).order_by('id'))
+            missing = set(room_codes) - {room.code for room in rooms}
+            if missing:
+                raise CommandError(f'部屋コードが見つかりません: {", ".join(sorted(missing))}')
+        else:
+            raise CommandError('部屋コードを指定するか、--allを指定してください。')
+
+        total_rooms = total_records = 0
+        total_seconds = 0.0
+        for room in rooms:
+            result = rescore_room(room, batch_games=options['batch_games'])
+            total_rooms += 1
+            total_records += result.records
+            total_seconds += result.seconds
+            message = (
+                f'部屋 {room.code}: {result.games}半荘 / {result.records}件 '
+                f'({result.seconds:.2f}秒, {result.records_per_second:,.0f}件/秒)'
+            )
+            if result.skipped_games:
+                message += f' ※記録が4人分揃っていない{result.skipped_games}半荘をスキップ'
+            self.stdout.write(message)
+
+        throughput = total_records / total_seconds if total_seconds else 0.0
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'合計 {total_rooms} 部屋 / {total_records} 件を再計算しました '
+                f'({total_seconds:.2f}秒, {throughput:,.0f}件/秒)'
+            )
+        )
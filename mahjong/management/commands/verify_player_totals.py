@@ -0,0 +1,76 @@
+"""
+プレイヤーの累計成績（Player.total_points / total_chips）が
+スコア記録の集計と一致しているかを検証する管理コマンド
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mahjong.models import Player
+from mahjong.services import bump_room_version, player_totals_from_records, recalculate_player_totals
+
+# 浮動小数点の加算順序による誤差は許容する
+POINTS_TOLERANCE = 1e-6
+
+
+class Command(BaseCommand):
+    help = 'プレイヤーの累計成績とスコア記録の集計を比較し、ずれを検出・修復します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'room_codes',
+            nargs='*',
+            help='検証する部屋コード（省略時はすべての部屋）',
+        )
+        parser.add_argument(
+            '--repair',
+            action='store_true',
+            help='ずれが見つかったプレイヤーの累計成績を修復する',
+        )
+
+    def handle(self, *args, **options):
+        players = Player.objects.select_related('room').order_by('room_id', 'order')
+        room_codes = [code.strip().upper() for code in options['room_codes']]
+        if room_codes:
+            players = players.filter(room__code__in=room_codes)
+
+        expected = {
+            f'expected_{name}': expression
+            for name, expression in player_totals_from_records().items()
+        }
+        drifted_ids = []
+        drifted_room_ids = set()
+        checked = 0
+        for player in players.annotate(**expected).iterator():
+            checked += 1
+            points_ok = abs(player.total_points - player.expected_total_points) <= POINTS_TOLERANCE
+            chips_ok = player.total_chips == player.expected_total_chips
+            if points_ok and chips_ok:
+                continue
+            drifted_ids.append(player.id)
+            drifted_room_ids.add(player.room_id)
+            self.stdout.write(
+                self.style.WARNING(
+                    f'ずれ: 部屋 {player.room.code} / {player.name} '
+                    f'ポイント {player.total_points} → {player.expected_total_points}, '
+                    f'チップ {player.total_chips} → {player.expected_total_chips}'
+                )
+            )
+
+        if not drifted_ids:
+            self.stdout.write(self.style.SUCCESS(f'{checked} 人の累計成績はすべて一致しています。'))
+            return
+
+        if not options['repair']:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'{checked} 人中 {len(drifted_ids)} 人の累計成績がずれています。'
+                    '--repair を指定すると修復します。'
+                )
+            )
+            return
+
+        with transaction.atomic():
+            repaired = recalculate_player_totals(Player.objects.filter(pk__in=drifted_ids))
+            # 成績表のキャッシュと、ブラウザのETagを使わなくする
+            for room_id in sorted(drifted_room_ids):
+                bump_room_version(room_id)
+        self.stdout.write(self.style.SUCCESS(f'{repaired} 人の累計成績を修復しました。'))
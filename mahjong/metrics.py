@@ -0,0 +1,249 @@
+"""
+Prometheus形式のメトリクス（/metrics）
+
+各プロセス（gunicornのワーカー）はメモリ上でカウンター・ヒストグラムを数え、
+MAHJONG_METRICS_FLUSH_SECONDS ごとに MAHJONG_METRICS_DIR の自分のファイルに書き出す。
+/metrics はディレクトリのすべてのファイルを合計して返すため、どのワーカーが応答しても
+全ワーカーの合計になる。終了したワーカーのファイルも合計に含める（カウンターが
+ワーカーの再起動で減らないようにする）。ディレクトリはgunicornの起動時に空にする。
+
+- mahjong_http_request_duration_seconds{view,method}: URL名ごとのレイテンシのヒストグラム
+- mahjong_http_responses_total{view,status}: ステータスコードごとのレスポンス数
+- mahjong_db_queries_total{view}: 実行したクエリ数
+- mahjong_sqlite_locked_total: SQLiteのロック待ち（busy_timeout）で失敗したクエリ数
+- mahjong_cache_requests_total{kind,result}: キャッシュのヒット・ミス（mahjong/cache.py）
+- mahjong_cache_hit_ratio{kind}: 上の合計から求めたヒット率
+- mahjong_active_rooms: MAHJONG_POLL_ACTIVE_SECONDS 以内に使われた部屋の数（取得時に数える）
+"""
+import atexit
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import OperationalError
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# レイテンシのヒストグラムのバケット（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# メトリクス名 -> (種類, 説明)
+METRICS = {
+    'mahjong_http_request_duration_seconds': ('histogram', 'Request latency by URL name'),
+    'mahjong_http_responses_total': ('counter', 'Responses by URL name and status code'),
+    'mahjong_db_queries_total': ('counter', 'Database queries by URL name'),
+    'mahjong_sqlite_locked_total': ('counter', 'Queries that failed with "database is locked"'),
+    'mahjong_cache_requests_total': ('counter', 'Room cache lookups by kind and result'),
+    'mahjong_cache_hit_ratio': ('gauge', 'Room cache hit ratio by kind'),
+    'mahjong_active_rooms': ('gauge', 'Rooms used within MAHJONG_POLL_ACTIVE_SECONDS'),
+}
+
+_LOCKED_MESSAGES = ('database is locked', 'database table is locked')
+
+
+def metrics_dir():
+    return Path(getattr(settings, 'MAHJONG_METRICS_DIR', None)
+                or os.path.join(tempfile.gettempdir(), 'mahjong_metrics'))
+
+
+def _flush_seconds():
+    return getattr(settings, 'MAHJONG_METRICS_FLUSH_SECONDS', 5)
+
+
+def _labels(**labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class MetricsRegistry:
+    """1プロセスのカウンターとヒストグラム"""
+
+    def __init__(self):
+        self._counters = defaultdict(float)  # (名前, ラベル) -> 値
+        self._histograms = {}  # (名前, ラベル) -> [バケットごとの数..., +Infの数, 合計]
+        self._lock = threading.Lock()
+        self._id = uuid.uuid4().hex[:8]
+        self._last_flush = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, _labels(**labels))] += value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            self._observe((name, _labels(**labels)), value)
+
+    def _observe(self, key, value):
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def observe_request(self, view, method, status, seconds, queries):
+        """1リクエストの計測値を記録"""
+        with self._lock:
+            self._counters[('mahjong_http_responses_total', _labels(view=view, status=status))] += 1
+            self._counters[('mahjong_db_queries_total', _labels(view=view))] += queries
+            self._observe(('mahjong_http_request_duration_seconds', _labels(view=view, method=method)), seconds)
+
+    def snapshot(self):
+        """ファイルに書き出す形式（キャッシュのヒット・ミスを含む）"""
+        from .cache import stats as cache_stats
+
+        with self._lock:
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [
+                [name, dict(labels), list(values)] for (name, labels), values in self._histograms.items()
+            ]
+        for kind, counts in cache_stats.snapshot().items():
+            counters.append(['mahjong_cache_requests_total', {'kind': kind, 'result': 'hit'}, counts['hits']])
+            counters.append(['mahjong_cache_requests_total', {'kind': kind, 'result': 'miss'}, counts['misses']])
+        return {'buckets': list(DURATION_BUCKETS), 'counters': counters, 'histograms': histograms}
+
+    def path(self):
+        # forkしたプロセスが同じファイルに書かないよう、pidを含める
+        return metrics_dir() / f'{os.getpid()}-{self._id}.json'
+
+    def flush(self):
+        """このプロセスの値をファイルに書き出す（一時ファイルからの置き換えで、読み手は常に完全な内容を読む）"""
+        self._last_flush = time.monotonic()
+        path = self.path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.snapshot()))
+        os.replace(tmp, path)
+
+    def maybe_flush(self):
+        """前回の書き出しから MAHJONG_METRICS_FLUSH_SECONDS 経っていれば書き出す"""
+        if time.monotonic() - self._last_flush < _flush_seconds():
+            return
+        try:
+            self.flush()
+        except OSError:
+            logger.warning('metrics flush failed', exc_info=True)
+
+    def has_samples(self):
+        return bool(self._counters or self._histograms)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+registry = MetricsRegistry()
+
+
+@atexit.register
+def _flush_on_exit():
+    """ワーカー終了時に最後の値を書き出す（リクエストを処理しなかったプロセスは書かない）"""
+    if not registry.has_samples():
+        return
+    try:
+        registry.flush()
+    except OSError:
+        pass
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    """connection.execute_wrappers に入れる、SQLiteのロック待ちの失敗の計数"""
+    try:
+        return execute(sql, params, many, context)
+    except OperationalError as e:
+        if any(message in str(e) for message in _LOCKED_MESSAGES):
+            registry.inc('mahjong_sqlite_locked_total')
+        raise
+
+
+def install_execute_wrapper(sender, connection, **kwargs):
+    """新しいSQLite接続に execute_wrapper を入れる（connection_createdのレシーバー）"""
+    if connection.vendor == 'sqlite' and execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+def collect():
+    """ディレクトリのすべてのファイル（全ワーカー）を合計する"""
+    counters = defaultdict(float)
+    histograms = {}
+    for path in metrics_dir().glob('*.json'):
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            # 書き出し中に削除されたファイル（gunicornの再起動）など
+            continue
+        if data.get('buckets') != list(DURATION_BUCKETS):
+            continue
+        for name, labels, value in data['counters']:
+            counters[(name, _labels(**labels))] += value
+        for name, labels, values in data['histograms']:
+            key = (name, _labels(**labels))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = values
+    return counters, histograms
+
+
+def active_rooms():
+    from .models import Room
+
+    since = timezone.now() - timedelta(seconds=getattr(settings, 'MAHJONG_POLL_ACTIVE_SECONDS', 600))
+    return Room.objects.filter(last_used_at__gte=since).count()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(f'{label}="{_escape(text)}"' for label, text in labels) + '}'
+    value = int(value) if float(value).is_integer() else value
+    return f'{name} {value}'
+
+
+def render():
+    """全ワーカーの合計をPrometheusのテキスト形式（0.0.4）で返す"""
+    registry.flush()
+    counters, histograms = collect()
+
+    hits = defaultdict(float)
+    lookups = defaultdict(float)
+    for (name, labels), value in counters.items():
+        if name == 'mahjong_cache_requests_total':
+            kind = dict(labels)['kind']
+            lookups[kind] += value
+            if dict(labels)['result'] == 'hit':
+                hits[kind] += value
+    gauges = {('mahjong_active_rooms', ()): active_rooms()}
+    for kind, total in lookups.items():
+        if total:
+            gauges[('mahjong_cache_hit_ratio', _labels(kind=kind))] = hits[kind] / total
+
+    samples = defaultdict(list)
+    for (name, labels), value in sorted({**counters, **gauges}.items()):
+        samples[name].append(_sample(name, labels, value))
+    for (name, labels), values in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip((*DURATION_BUCKETS, '+Inf'), values[:-1]):
+            cumulative += count
+            samples[name].append(_sample(f'{name}_bucket', (*labels, ('le', str(bound))), cumulative))
+        samples[name].append(_sample(f'{name}_sum', labels, values[-1]))
+        samples[name].append(_sample(f'{name}_count', labels, cumulative))
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(samples.get(name, []))
+    return '\n'.join(lines) + '\n'
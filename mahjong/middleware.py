@@ -0,0 +1,308 @@
+"""
+ミドルウェア
+
+LeanPathMiddleware: ポーリング・SSE・JSONのエンドポイント用の軽量な経路
+
+HTMXのポーリングは数秒〜数十秒ごとに届くが、部分テンプレートはセッション・認証・
+メッセージ・CSRF・クリックジャッキング対策のどれも使わない。LeanPathMiddleware を
+MIDDLEWARE の先頭に置くと、@lean_view を付けたビューへのリクエストだけ、
+MAHJONG_LEAN_MIDDLEWARE に挙げたミドルウェアを通してビューを直接呼び出し、
+残りのミドルウェアを飛ばす。それ以外のリクエストは通常どおり処理する。
+
+ビューの解決・例外から応答への変換（404など）はDjangoのハンドラと同じ処理を使う。
+ビューの解決には @lean_view のURLパターンだけを集めたリゾルバーを使うため、
+対象外のリクエストはDjangoのハンドラでの解決に加えて、数個のパターンとの照合だけで済む。
+
+ServerTimingMiddleware: リクエストごとのSQL・テンプレート・ミドルウェアの所要時間を
+Server-Timingヘッダーで返す（mahjong/timing.py）。MAHJONG_SLOW_REQUEST_MS を超えた
+リクエストは1行のJSONでログに記録する。
+
+MetricsMiddleware: URL名ごとのレイテンシ・ステータスコード・クエリ数を
+Prometheusのメトリクスとして記録する（mahjong/metrics.py）。
+
+ProfilingMiddleware: 管理者のトークンを付けたリクエストと、サンプリングで選んだ
+リクエストを cProfile・tracemalloc で計測する（mahjong/profiling.py）。
+"""
+import functools
+import json
+import logging
+import time
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.urls import Resolver404, URLResolver, get_resolver
+from django.urls.resolvers import RegexPattern
+from django.utils.module_loading import import_string
+
+from . import metrics, profiling, timing
+
+timing_logger = logging.getLogger('mahjong.timing')
+
+
+def lean_view(view):
+    """ビューを軽量な経路で呼び出す（セッション・メッセージ・CSRFなどを使わないビュー用）"""
+    view.lean = True
+    return view
+
+
+def _mark_view_started():
+    timings = timing.current()
+    if timings is not None:
+        timings.mark_view_started()
+
+
+def _lean_middleware():
+    return getattr(settings, 'MAHJONG_LEAN_MIDDLEWARE', [])
+
+
+def _lean_patterns(patterns):
+    """@lean_view のURLパターンだけを残す（include() の名前空間・プレフィックスはそのまま）"""
+    lean = []
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            children = _lean_patterns(pattern.url_patterns)
+            if children:
+                lean.append(URLResolver(
+                    pattern.pattern, children, pattern.default_kwargs, pattern.app_name, pattern.namespace
+                ))
+        elif getattr(pattern.callback, 'lean', False):
+            lean.append(pattern)
+    return lean
+
+
+@functools.lru_cache(maxsize=None)
+def _lean_resolver(resolver):
+    """ルートのリゾルバー（get_resolver()）から @lean_view のビューだけを解決するリゾルバーを作る"""
+    return URLResolver(RegexPattern(r'^/'), _lean_patterns(resolver.url_patterns))
+
+
+class LeanPathMiddleware:
+    """@lean_view のビューだけ、MAHJONG_LEAN_MIDDLEWARE のミドルウェアで処理する"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.lean_response = self._build_chain()
+
+    def _build_chain(self):
+        handler = convert_exception_to_response(self._acall_view if self.async_mode else self._call_view)
+        for path in reversed(_lean_middleware()):
+            handler = convert_exception_to_response(import_string(path)(handler))
+        return handler
+
+    def _match(self, request):
+        """軽量な経路で処理するビューならURLの解決結果を返す"""
+        try:
+            match = _lean_resolver(get_resolver()).resolve(request.path_info)
+        except Resolver404:
+            return None
+        request.resolver_match = match
+        return match
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self._match(request) is None:
+            return self.get_response(request)
+        return self.lean_response(request)
+
+    async def __acall__(self, request):
+        if self._match(request) is None:
+            return await self.get_response(request)
+        return await self.lean_response(request)
+
+    @staticmethod
+    def _call_view(request):
+        _mark_view_started()
+        match = request.resolver_match
+        view = match.func
+        if iscoroutinefunction(view):
+            view = async_to_sync(view)
+        return view(request, *match.args, **match.kwargs)
+
+    @staticmethod
+    async def _acall_view(request):
+        _mark_view_started()
+        match = request.resolver_match
+        view = match.func
+        if not iscoroutinefunction(view):
+            view = sync_to_async(view, thread_sensitive=True)
+        return await view(request, *match.args, **match.kwargs)
+
+
+class ServerTimingMiddleware:
+    """
+    SQL（クエリ数・時間）・テンプレート・ミドルウェアの所要時間をServer-Timingヘッダーで返す
+
+    MIDDLEWARE の先頭に置く（他のミドルウェアの時間も含めて計測する）。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'MAHJONG_SERVER_TIMING', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'MAHJONG_SLOW_REQUEST_MS', 0)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings, token = timing.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            timing.finish(token)
+        return self._finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings, token = timing.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timing.finish(token)
+        return self._finish(request, response, timings)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _mark_view_started()
+
+    def _finish(self, request, response, timings):
+        summary = timings.summary()
+        response['Server-Timing'] = server_timing_header(summary)
+        if self.slow_ms and summary['total_ms'] >= self.slow_ms:
+            timing_logger.warning('slow request %s', json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                **{name: round(value, 2) for name, value in summary.items()},
+            }))
+        return response
+
+
+class MetricsMiddleware:
+    """
+    URL名ごとのレイテンシ・ステータスコード・クエリ数を記録する
+
+    LeanPathMiddleware より前に置く（軽量な経路のリクエストも記録する）。
+    クエリ数は ServerTimingMiddleware の計測値を使い、無効な場合はここで計測する。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'MAHJONG_METRICS', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _start():
+        timings = timing.current()
+        if timings is not None:
+            return timings, None
+        return timing.start()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        timings, token = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                timing.finish(token)
+        self._record(request, response, time.perf_counter() - started, timings)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        timings, token = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                timing.finish(token)
+        self._record(request, response, time.perf_counter() - started, timings)
+        return response
+
+    @staticmethod
+    def _record(request, response, seconds, timings):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unmatched'
+        metrics.registry.observe_request(view, request.method, response.status_code, seconds, timings.queries)
+        metrics.registry.maybe_flush()
+
+
+class ProfilingMiddleware:
+    """
+    指定したリクエストを cProfile・tracemalloc で計測し、MAHJONG_PROFILE_DIR に書き出す
+
+    LeanPathMiddleware より前に置く（軽量な経路のリクエストも計測する）。
+    MAHJONG_PROFILE_TOKEN も MAHJONG_PROFILE_SAMPLE_RATE も設定されていなければ使わない。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not profiling.enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        session = profiling.ProfileSession.begin(request)
+        if session is None:
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            session.stop()
+        session.save(response)
+        response['X-Mahjong-Profile-Id'] = session.id
+        return response
+
+    async def __acall__(self, request):
+        session = profiling.ProfileSession.begin(request)
+        if session is None:
+            return await self.get_response(request)
+        # ASGIではリクエストごとに sync_to_async のスレッドが1つ決まるため、そのスレッドでも計測する
+        await sync_to_async(session.thread_profiler.enable)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(session.thread_profiler.disable)()
+            session.stop()
+        await sync_to_async(session.save)(response)
+        response['X-Mahjong-Profile-Id'] = session.id
+        return response
+
+
+def server_timing_header(summary):
+    """計測値（ミリ秒）をServer-Timingヘッダーの値に整形"""
+    return ', '.join([
+        f'mw;dur={summary["mw_ms"]:.2f};desc="middleware"',
+        f'db;dur={summary["db_ms"]:.2f};desc="{summary["queries"]} queries"',
+        f'tpl;dur={summary["tpl_ms"]:.2f};desc="templates"',
+        f'app;dur={summary["app_ms"]:.2f};desc="view"',
+        f'total;dur={summary["total_ms"]:.2f}',
+    ])
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:31
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_player_totals(apps, schema_editor):
+    """既存のスコア記録から累計成績を計算"""
+    Player = apps.get_model('mahjong', 'Player')
+    ScoreRecord = apps.get_model('mahjong', 'ScoreRecord')
+    per_player = ScoreRecord.objects.filter(player=OuterRef('pk')).order_by().values('player')
+    Player.objects.update(
+        total_points=Coalesce(
+            Subquery(per_player.annotate(total=Sum('points')).values('total')),
+            Value(0.0),
+        ),
+        total_chips=Coalesce(
+            Subquery(per_player.annotate(total=Sum('chip_change')).values('total')),
+            Value(0),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mahjong', '0008_room_last_used_at_alter_room_rate_type_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='total_chips',
+            field=models.IntegerField(default=0, verbose_name='累計チップ'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='total_points',
+            field=models.FloatField(default=0.0, verbose_name='累計ポイント'),
+        ),
+        migrations.RunPython(backfill_player_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mahjong', '0011_room_code_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(verbose_name='変更後のバージョン')),
+                ('kind', models.CharField(choices=[('game_added', 'ゲーム追加'), ('game_deleted', 'ゲーム削除'), ('reset', '全体の変更')], max_length=16, verbose_name='種類')),
+                ('game_id', models.BigIntegerField(blank=True, null=True, verbose_name='ゲームID')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='mahjong.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'version'], name='mahjong_roo_room_id_5e1035_idx')],
+            },
+        ),
+    ]
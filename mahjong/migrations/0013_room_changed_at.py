@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:45
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+
+
+def backfill_changed_at(apps, schema_editor):
+    """最後のゲームの記録時刻を最終変更時刻とする"""
+    Room = apps.get_model('mahjong', 'Room')
+    Game = apps.get_model('mahjong', 'Game')
+    latest = (
+        Game.objects.filter(room=OuterRef('pk')).order_by().values('room')
+        .annotate(latest=Max('created_at')).values('latest')
+    )
+    Room.objects.update(changed_at=Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mahjong', '0012_room_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='changed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='最終変更時刻'),
+        ),
+        migrations.RunPython(backfill_changed_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mahjong', '0013_room_changed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='rows_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='ゲーム行のバージョン'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mahjong', '0014_room_rows_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['last_used_at'], name='mahjong_roo_last_us_adba72_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='scorerecord',
+            index=models.Index(fields=['player', 'points', 'chip_change'], name='mahjong_sco_player__abeb9e_idx'),
+        ),
+        # SQLiteでは AlterField がテーブルを作り直す（全スコア記録をコピーする）ため、
+        # player_id の単独のインデックスだけを削除する
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='scorerecord',
+                    name='player',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='score_records', to='mahjong.player'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    sql='DROP INDEX "mahjong_scorerecord_player_id_e96780a8"',
+                    reverse_sql='CREATE INDEX "mahjong_scorerecord_player_id_e96780a8" ON "mahjong_scorerecord" ("player_id")',
+                ),
+            ],
+        ),
+    ]
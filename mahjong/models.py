@@ -1,23 +1,11 @@
 from django.db import models
-import string
-import random
 
 
 def generate_room_code():
-    """6桁の英数字コードを生成（重複チェック付き）"""
-    characters = string.ascii_uppercase + string.digits
-    max_attempts = 100
-    
-    for _ in range(max_attempts):
-        code = ''.join(random.choice(characters) for _ in range(6))
-        # 重複チェック（Roomモデルがインポート可能な場合のみ）
-        # 注意: この関数はモデル定義時に呼ばれるため、循環インポートを避ける
-        # 実際の重複チェックはcreate_roomビューで行う
-        return code
-    
-    # 最大試行回数に達した場合はランダムなコードを返す
-    # （実際には100回試行しても重複する可能性は極めて低い）
-    return ''.join(random.choice(characters) for _ in range(6))
+    """6桁の英数字コードを生成（連番を難読化した値のため重複しない）"""
+    # 循環インポートを避けるため、呼び出し時にインポートする
+    from .room_codes import allocator
+    return allocator.allocate()
 
 
 class Room(models.Model):
@@ -45,6 +33,8 @@ class Room(models.Model):
     code = models.CharField(max_length=6, unique=True, default=generate_room_code, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     last_used_at = models.DateTimeField(auto_now=True, verbose_name="最終使用時刻")
+    # スコア記録・設定変更などで表示内容が最後に変わった時刻（ポーリング間隔の計算に使う）
+    changed_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="最終変更時刻")
     # サシウマ設定
     sashi_uma_type = models.CharField(max_length=10, choices=SASHI_UMA_CHOICES, default='5-10', verbose_name="サシウマタイプ")
     sashi_uma_1_2 = models.IntegerField(default=5, verbose_name="サシウマ1-2位（カスタム用）")
@@ -60,6 +50,11 @@ class Room(models.Model):
     chip_point_rate = models.FloatField(default=1.0, verbose_name="チップ1枚あたりのポイント")
     # オカ設定（レートから自動計算されるが、互換性のため残す）
     oka = models.IntegerField(default=20, verbose_name="オカ")
+    # 表示内容のバージョン（スコア記録・ゲーム削除・プレイヤー編集・設定変更で加算）
+    # HTMXのポーリングに対するETagとして使用する
+    version = models.PositiveIntegerField(default=0, editable=False, verbose_name="バージョン")
+    # ゲームの行の表示が変わる変更（プレイヤー編集・設定変更・再計算）をしたときのバージョン
+    rows_version = models.PositiveIntegerField(default=0, editable=False, verbose_name="ゲーム行のバージョン")
     
     def _get_sashi_uma_values(self):
         """サシウマの値を取得（タイプに応じて）"""
@@ -122,16 +117,32 @@ class Room(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # 古い部屋の削除（last_used_at__lt）と使用中の部屋の数（/metrics）
+            models.Index(fields=['last_used_at']),
+        ]
 
     def __str__(self):
         return f"Room {self.code}"
 
 
+class RoomCodeSequence(models.Model):
+    """部屋コードの元になる連番（1行だけのテーブル、ワーカーがブロック単位で予約する）"""
+    next_value = models.BigIntegerField(default=0, verbose_name="次の連番")
+
+    def __str__(self):
+        return f"RoomCodeSequence {self.next_value}"
+
+
 class Player(models.Model):
     """プレイヤーモデル"""
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='players')
     name = models.CharField(max_length=50, verbose_name="プレイヤー名")
     order = models.IntegerField(verbose_name="順番")  # 1, 2, 3, 4
+    # 累計成績（ScoreRecordの集計値を非正規化して保持）
+    # スコア記録・ゲーム削除・再計算の各処理で更新し、verify_player_totalsで検証する
+    total_points = models.FloatField(default=0.0, verbose_name="累計ポイント")
+    total_chips = models.IntegerField(default=0, verbose_name="累計チップ")
 
     class Meta:
         unique_together = [['room', 'order']]
@@ -158,7 +169,8 @@ class Game(models.Model):
 class ScoreRecord(models.Model):
     """スコア記録モデル"""
     game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='score_records')
-    player = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='score_records')
+    # player_id の検索には下の複合インデックスを使う（先頭の列が player_id のため単独のインデックスは不要）
+    player = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='score_records', db_index=False)
     score = models.IntegerField(verbose_name="持ち点")
     chip_change = models.IntegerField(default=0, verbose_name="チップ増減")
     rank = models.IntegerField(null=True, blank=True, verbose_name="順位")  # 1, 2, 3, 4
@@ -166,6 +178,38 @@ class ScoreRecord(models.Model):
 
     class Meta:
         ordering = ['rank', 'player__order']
+        indexes = [
+            # プレイヤーごとの累計成績の集計（player_totals_from_records）を、表を読まずに
+            # インデックスだけで行う（カバリングインデックス）
+            models.Index(fields=['player', 'points', 'chip_change']),
+        ]
 
     def __str__(self):
         return f"{self.player.name}: {self.score}点 (Rank: {self.rank}, Points: {self.points})"
+
+
+class RoomChange(models.Model):
+    """部屋の変更履歴（ポーリングで差分だけを返すために使う）"""
+    KIND_GAME_ADDED = 'game_added'
+    KIND_GAME_DELETED = 'game_deleted'
+    # プレイヤー編集・設定変更・再計算など、ゲーム履歴全体の描画し直しが必要な変更
+    KIND_RESET = 'reset'
+    KIND_CHOICES = [
+        (KIND_GAME_ADDED, 'ゲーム追加'),
+        (KIND_GAME_DELETED, 'ゲーム削除'),
+        (KIND_RESET, '全体の変更'),
+    ]
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='changes')
+    version = models.PositiveIntegerField(verbose_name="変更後のバージョン")
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, verbose_name="種類")
+    # 削除されたゲームも指すため外部キーにしない
+    game_id = models.BigIntegerField(null=True, blank=True, verbose_name="ゲームID")
+
+    class Meta:
+        # Roomのインスタンスを古い値のまま save() するとバージョンが戻ることがあるため、
+        # 一意制約にはしない（重複があると差分の件数が合わず、全体の描画にフォールバックする）
+        indexes = [models.Index(fields=['room', 'version'])]
+
+    def __str__(self):
+        return f"{self.kind} v{self.version} (Room: {self.room_id})"
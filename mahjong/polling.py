@@ -0,0 +1,47 @@
+"""
+ダッシュボードのポーリング間隔
+
+部屋の最後の変更（Room.changed_at）からの経過時間で、次のポーリングまでの秒数を決める。
+
+- 経過時間が MAHJONG_POLL_ACTIVE_SECONDS 以内（対局中）: MAHJONG_POLL_MIN_SECONDS
+- それより長い場合: 経過時間が倍になるごとに間隔も倍にし、MAHJONG_POLL_MAX_SECONDS で頭打ち
+- MAHJONG_POLL_STOP_AFTER_SECONDS を超えた場合: ポーリングを止める（None）
+
+部分テンプレートは X-Poll-Interval ヘッダーで間隔を返し、止める場合はHTMXの
+ステータス286を返す。SSEで変更が通知されれば、その応答で再びポーリングが始まる。
+"""
+import math
+
+from django.conf import settings
+from django.utils import timezone
+
+# HTMXがポーリングを止めるステータスコード
+STOP_POLLING_STATUS = 286
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def idle_seconds(room, now=None):
+    """部屋が最後に変更されてからの秒数"""
+    now = now or timezone.now()
+    changed_at = room.changed_at or room.created_at
+    return max(0.0, (now - changed_at).total_seconds())
+
+
+def poll_interval(room, now=None):
+    """次のポーリングまでの秒数（ポーリングを止める場合はNone）"""
+    minimum = _setting('MAHJONG_POLL_MIN_SECONDS', 15)
+    maximum = _setting('MAHJONG_POLL_MAX_SECONDS', 600)
+    active = _setting('MAHJONG_POLL_ACTIVE_SECONDS', 600)
+    stop_after = _setting('MAHJONG_POLL_STOP_AFTER_SECONDS', 12 * 60 * 60)
+
+    idle = idle_seconds(room, now)
+    if idle > stop_after:
+        return None
+    if idle <= active:
+        return minimum
+    # 経過時間が active の 2^n 倍を超えるごとに間隔を倍にする
+    doublings = math.ceil(math.log2(idle / active))
+    return min(maximum, minimum * 2 ** doublings)
@@ -0,0 +1,197 @@
+"""
+本番のリクエストのプロファイル（cProfile・tracemalloc）
+
+ProfilingMiddleware（mahjong/middleware.py）が、次のいずれかに当てはまるリクエストを
+cProfile と tracemalloc で計測し、MAHJONG_PROFILE_DIR に書き出す。
+
+- X-Mahjong-Profile ヘッダーか ?_profile= の値が MAHJONG_PROFILE_TOKEN と一致する（管理者用）
+- MAHJONG_PROFILE_SAMPLE_RATE の確率で選ばれた（0.01 なら100件に1件）
+
+1件ごとに <id>.prof（pstats）と <id>.json（ビュー・所要時間・メモリの増加の多い行）を書き、
+MAHJONG_PROFILE_KEEP 件を超えたら古いものから消す。ビューごとの集計は
+python manage.py profile_summary で行う。
+
+計測は1プロセスで同時に1件だけ（cProfile はスレッドごとに1つしか有効にできず、
+tracemalloc はプロセス全体の設定のため）。計測中に届いたリクエストは計測しない。
+非同期ビューでは、イベントループのスレッドと、そのリクエストの sync_to_async の
+スレッド（ORM・テンプレート）の両方を計測する。イベントループのスレッドの計測には、
+同時に処理中の他のリクエストのコルーチンも含まれる。
+"""
+import cProfile
+import hmac
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Mahjong-Profile'
+QUERY_PARAM = '_profile'
+# 1件ごとに記録するメモリの増加の多い行の数
+TOP_ALLOCATIONS = 25
+
+_lock = threading.Lock()
+
+
+def profile_dir():
+    return Path(getattr(settings, 'MAHJONG_PROFILE_DIR', None)
+                or os.path.join(tempfile.gettempdir(), 'mahjong_profiles'))
+
+
+def _token():
+    return getattr(settings, 'MAHJONG_PROFILE_TOKEN', '')
+
+
+def _sample_rate():
+    return getattr(settings, 'MAHJONG_PROFILE_SAMPLE_RATE', 0.0)
+
+
+def enabled():
+    """トークンもサンプリングも設定されていなければ、ミドルウェアを外す"""
+    return bool(_token()) or _sample_rate() > 0
+
+
+def requested_by(request):
+    """計測する理由（'token'・'sample'）。計測しなければNone"""
+    token = _token()
+    if token:
+        value = request.headers.get(HEADER) or request.GET.get(QUERY_PARAM)
+        if value and hmac.compare_digest(value.encode(), token.encode()):
+            return 'token'
+    rate = _sample_rate()
+    if rate > 0 and random.random() < rate:
+        return 'sample'
+    return None
+
+
+def profile_id():
+    """
+    計測結果のファイル名（名前の順が記録した時刻の順になる）
+
+    秒より細かい時刻（ナノ秒）を乱数より前に置き、同じ秒に書いた計測結果も
+    rotate() で新しいものを消さないようにする。
+    """
+    now = time.time_ns()
+    stamp = datetime.fromtimestamp(now // 10**9, tz=dt_timezone.utc)
+    return f'{stamp:%Y%m%d-%H%M%S}-{now % 10**9:09d}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+
+
+class ProfileSession:
+    """1リクエストの計測（start・stop・save の順に呼ぶ）"""
+
+    def __init__(self, request, reason):
+        self.request = request
+        self.reason = reason
+        self.id = profile_id()
+        self.profiler = cProfile.Profile()
+        # 非同期ビューの sync_to_async のスレッド用
+        self.thread_profiler = cProfile.Profile()
+        self.started = None
+        self.seconds = None
+        self._stop_tracemalloc = False
+        self._baseline = None
+        self._snapshot = None
+        self._peak = None
+
+    @classmethod
+    def begin(cls, request):
+        """計測するリクエストなら計測を始めたセッションを返す（他のリクエストを計測中ならNone）"""
+        reason = requested_by(request)
+        if reason is None or not _lock.acquire(blocking=False):
+            return None
+        session = cls(request, reason)
+        try:
+            session.start()
+        except BaseException:
+            _lock.release()
+            raise
+        return session
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._stop_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._baseline = tracemalloc.take_snapshot()
+        self.started = time.perf_counter()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self.started
+        self._peak = tracemalloc.get_traced_memory()[1]
+        self._snapshot = tracemalloc.take_snapshot()
+        if self._stop_tracemalloc:
+            tracemalloc.stop()
+        _lock.release()
+
+    def save(self, response):
+        """.prof と .json を書き出し、古いものを消す（書き出せなくてもレスポンスは返す）"""
+        try:
+            self._save(response)
+        except OSError:
+            logger.warning('profile save failed: %s', self.id, exc_info=True)
+
+    def _save(self, response):
+        directory = profile_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        stats = pstats.Stats(self.profiler)
+        if self.thread_profiler.getstats():
+            stats.add(self.thread_profiler)
+        stats.dump_stats(directory / f'{self.id}.prof')
+
+        match = getattr(self.request, 'resolver_match', None)
+        allocations = self._snapshot.compare_to(self._baseline, 'lineno')[:TOP_ALLOCATIONS]
+        (directory / f'{self.id}.json').write_text(json.dumps({
+            'id': self.id,
+            'view': match.view_name if match is not None else 'unmatched',
+            'method': self.request.method,
+            'path': self.request.path,
+            'status': response.status_code,
+            'reason': self.reason,
+            'recorded_at': timezone.now().isoformat(),
+            'duration_ms': round(self.seconds * 1000, 3),
+            'peak_memory_bytes': self._peak,
+            'allocations': [
+                {
+                    'location': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                    'size_diff': stat.size_diff,
+                    'count_diff': stat.count_diff,
+                }
+                for stat in allocations
+            ],
+        }, ensure_ascii=False, indent=1))
+        rotate(directory, getattr(settings, 'MAHJONG_PROFILE_KEEP', 200))
+
+
+def rotate(directory, keep):
+    """新しいものから keep 件を残して、古い計測結果を消す"""
+    records = sorted(directory.glob('*.json'), key=lambda path: path.name, reverse=True)
+    for path in records[keep:]:
+        path.unlink(missing_ok=True)
+        path.with_suffix('.prof').unlink(missing_ok=True)
+
+
+def load_records(directory=None):
+    """計測結果（.json の内容）を古い順に返す"""
+    records = []
+    for path in sorted((directory or profile_dir()).glob('*.json')):
+        try:
+            record = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        record['prof_path'] = path.with_suffix('.prof')
+        records.append(record)
+    return records
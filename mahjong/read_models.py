@@ -0,0 +1,233 @@
+"""
+部屋の表示用データ（読み取りモデル）
+
+ダッシュボードとHTMX用の部分テンプレート（ゲーム履歴・累計成績）で共有する。
+ゲームとスコア記録は部屋ごとに2クエリで読み込み、モデルインスタンスではなく
+__slots__ を持つ軽量な行オブジェクトに詰め替えるため、クエリ数はゲーム数に依存しない。
+
+ゲーム履歴は (room, game_number) のキーセットでページ分割し、新しい順に
+GAME_PAGE_SIZE 半荘ずつ読み込む（OFFSETを使わないため古いページも一定のコスト）。
+ポーリングでは、クライアントが表示しているバージョン以降の変更履歴（RoomChange）から
+追加・削除されたゲームだけを返す（agame_delta）。
+"""
+from dataclasses import dataclass
+from functools import cached_property
+
+from .models import Game, Player, RoomChange, ScoreRecord
+
+# ゲーム履歴の1ページあたりの半荘数
+GAME_PAGE_SIZE = 20
+
+
+@dataclass(slots=True)
+class RecordRow:
+    """1人分のスコア記録"""
+    rank: int
+    score: int
+    points: float
+    chip_change: int
+
+
+@dataclass(slots=True)
+class GameRow:
+    """1半荘分の行（recordsはプレイヤー順、記録がない場合はNone。読み込む前はrecords自体がNone）"""
+    id: int
+    game_number: int
+    records: list | None
+
+
+@dataclass(slots=True)
+class GamePage:
+    """ゲーム履歴の1ページ（older_thanは次のページの基準のgame_number、最後のページならNone）"""
+    rows: list
+    older_than: int | None
+
+
+@dataclass(slots=True)
+class GameDelta:
+    """あるバージョン以降に追加されたゲームの行（新しい順）と、削除されたゲームのID"""
+    rows: list
+    deleted_ids: list
+
+
+@dataclass(slots=True)
+class PlayerStatRow:
+    """1人分の累計成績"""
+    player: Player
+    total_points: float
+    total_chips: int
+    chip_points: float
+    total_amount_pt: float
+
+
+class RoomReadModel:
+    """部屋の表示用データをまとめて組み立てる"""
+
+    def __init__(self, room, players):
+        self.room = room
+        self.players = players
+
+    @classmethod
+    def for_room(cls, room):
+        """部屋のプレイヤーを読み込んで作成（1クエリ）"""
+        return cls(room, list(cls.players_query(room)))
+
+    @staticmethod
+    def players_query(room):
+        return Player.objects.filter(room=room).order_by('order')
+
+    @property
+    def is_ready(self):
+        """プレイヤーが4人揃っているか"""
+        return len(self.players) == 4
+
+    @cached_property
+    def player_stats(self):
+        """累計成績（Playerに保持している累計値を使うため追加のクエリなし）"""
+        chip_point_rate = self.room.chip_point_rate
+        player_stats = []
+        for player in self.players:
+            # チップを実際の支払いポイントに換算
+            # chip_point_rateは100で割った値で保存されているので、計算時に100倍する
+            chip_points = player.total_chips * chip_point_rate * 100
+            # 合計（ポイントは100倍、チップも100倍した実際の支払いポイント）
+            total_amount_pt = (player.total_points * 100) + chip_points
+            player_stats.append(PlayerStatRow(
+                player=player,
+                total_points=player.total_points,
+                total_chips=player.total_chips,
+                chip_points=chip_points,
+                total_amount_pt=total_amount_pt,
+            ))
+        return player_stats
+
+    def game_page(self, before=None, limit=GAME_PAGE_SIZE, with_records=True):
+        """
+        game_numberがbeforeより小さいゲームを新しい順にlimit件（2クエリ）
+
+        with_records=False ではスコア記録を読まない（必要な行だけ後から load_records で読む）。
+        """
+        page = self._page(list(self._page_query(before, limit)), limit)
+        if with_records:
+            self.load_records(page.rows)
+        return page
+
+    async def agame_page(self, before=None, limit=GAME_PAGE_SIZE, with_records=True):
+        """game_pageの非同期版"""
+        page = self._page([game_id async for game_id in self._page_query(before, limit)], limit)
+        if with_records:
+            await self.aload_records(page.rows)
+        return page
+
+    def _page_query(self, before, limit):
+        games = Game.objects.filter(room=self.room)
+        if before is not None:
+            games = games.filter(game_number__lt=before)
+        # 1件多く読んで、さらに古いページがあるかを判定する
+        return games.order_by('-game_number').values_list('id', 'game_number')[:limit + 1]
+
+    def _page(self, game_ids, limit):
+        has_older = len(game_ids) > limit
+        rows = self._game_rows(game_ids[:limit])
+        return GamePage(rows=rows, older_than=rows[-1].game_number if has_older else None)
+
+    async def agame_delta(self, since, with_records=True):
+        """
+        バージョンsinceから現在のバージョンまでのゲーム履歴の差分
+
+        差分で表せない場合（全体の変更・履歴の欠落・未来のバージョン）はNone。
+        """
+        if since > self.room.version:
+            return None
+        folded = self._fold_changes(since, [change async for change in self._changes_query(since)])
+        if folded is None:
+            return None
+        added, deleted = folded
+        rows = self._game_rows([game async for game in self._added_games_query(added)]) if added else []
+        if with_records:
+            await self.aload_records(rows)
+        return GameDelta(rows=rows, deleted_ids=deleted)
+
+    def _changes_query(self, since):
+        return (
+            RoomChange.objects.filter(room=self.room, version__gt=since, version__lte=self.room.version)
+            .order_by('version')
+            .values_list('kind', 'game_id')
+        )
+
+    def _added_games_query(self, game_ids):
+        return Game.objects.filter(id__in=game_ids).order_by('-game_number').values_list('id', 'game_number')
+
+    def _fold_changes(self, since, changes):
+        """変更履歴を (追加されたゲームID, 削除されたゲームID) にまとめる（差分で表せなければNone）"""
+        if len(changes) != self.room.version - since:
+            return None
+        added = []
+        deleted = []
+        for kind, game_id in changes:
+            if kind == RoomChange.KIND_GAME_ADDED:
+                added.append(game_id)
+            elif kind == RoomChange.KIND_GAME_DELETED:
+                if game_id in added:
+                    added.remove(game_id)
+                else:
+                    deleted.append(game_id)
+            else:
+                return None
+        return added, deleted
+
+    def _game_rows(self, game_ids):
+        """(id, game_number) の列から、スコア記録を読む前の行を組み立てる"""
+        return [GameRow(id=game_id, game_number=game_number, records=None) for game_id, game_number in game_ids]
+
+    def load_records(self, rows):
+        """スコア記録を読んでいない行に、まとめて読み込む（1クエリ）"""
+        rows = [row for row in rows if row.records is None]
+        if rows:
+            self._attach_records(rows, self._record_values(self._records_query(rows)))
+        return rows
+
+    async def aload_records(self, rows):
+        """load_recordsの非同期版"""
+        rows = [row for row in rows if row.records is None]
+        if rows:
+            records = [record async for record in self._record_values(self._records_query(rows))]
+            self._attach_records(rows, records)
+        return rows
+
+    def _records_query(self, rows):
+        return ScoreRecord.objects.filter(game_id__in=[row.id for row in rows])
+
+    def _record_values(self, records):
+        return records.order_by().values_list('game_id', 'player_id', 'rank', 'score', 'points', 'chip_change')
+
+    def _attach_records(self, game_rows, records):
+        """(game_id, player_id, rank, score, points, chip_change) の列を行に詰める"""
+        for row in game_rows:
+            row.records = [None] * len(self.players)
+        if not game_rows:
+            return
+        rows_by_id = {row.id: row for row in game_rows}
+        column_by_player = {player.id: column for column, player in enumerate(self.players)}
+        for game_id, player_id, rank, score, points, chip_change in records:
+            row = rows_by_id.get(game_id)  # 2つのクエリの間に追加されたゲームは無視
+            column = column_by_player.get(player_id)
+            if row is not None and column is not None:
+                row.records[column] = RecordRow(rank, score, points, chip_change)
+
+    def context(self, player_stats=True):
+        """テンプレート用のコンテキスト（ゲーム履歴は page_context で追加する）"""
+        context = {
+            'room': self.room,
+            'players': self.players,
+        }
+        if player_stats:
+            context['player_stats'] = self.player_stats
+        return context
+
+    def page_context(self, page):
+        """ゲーム履歴の1ページ分のテンプレート用コンテキスト"""
+        return {
+            'games_data': page.rows,
+            'older_games_before': page.older_than,
+        }
@@ -0,0 +1,120 @@
+"""
+部屋コードの割り当て
+
+連番を鍵付きの置換（Feistel構造）で6桁の英数字に変換する。置換は全単射なので、
+連番が重複しない限りコードも重複せず、作成前の存在確認や再試行は要らない。
+連番は見た目には推測しにくい順序のコードになる。
+
+連番は RoomCodeSequence（1行だけのテーブル）からワーカーごとに
+MAHJONG_ROOM_CODE_BLOCK_SIZE 個ずつ予約するため、部屋の作成は通常 INSERT 1回で済む。
+ワーカーの再起動で使い残した連番は欠番になるが、36^6 通りあるので問題にならない。
+
+鍵（MAHJONG_ROOM_CODE_KEY）は運用開始後に変えないこと。変えた場合も、
+旧方式のランダムなコードと同様にまれに既存のコードと衝突するだけで、
+その場合は次の連番で作り直せばよい（create_room を参照）。
+"""
+import hashlib
+import string
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from .models import RoomCodeSequence
+
+ROOM_CODE_ALPHABET = string.ascii_uppercase + string.digits
+ROOM_CODE_LENGTH = 6
+ROOM_CODE_SPACE = len(ROOM_CODE_ALPHABET) ** ROOM_CODE_LENGTH
+
+# 36^6 (約21.8億) < 2^32 なので、32ビットのFeistel置換を範囲内に入るまで繰り返す
+_HALF_BITS = 16
+_HALF_MASK = (1 << _HALF_BITS) - 1
+_ROUNDS = 4
+
+
+# MAHJONG_ROOM_CODE_KEY が未設定の場合（開発・テスト）の鍵。本番では check --deploy がエラーにする
+DEVELOPMENT_KEY = b'insecure-room-code-key-for-development'
+
+
+def _key():
+    return getattr(settings, 'MAHJONG_ROOM_CODE_KEY', '').encode() or DEVELOPMENT_KEY
+
+
+def _round(key, round_index, half):
+    digest = hashlib.blake2b(
+        half.to_bytes(2, 'big'), digest_size=2, key=key[:64], person=bytes([round_index]) * 16
+    ).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def _permute32(value, key):
+    left, right = value >> _HALF_BITS, value & _HALF_MASK
+    for round_index in range(_ROUNDS):
+        left, right = right, left ^ _round(key, round_index, right)
+    return (left << _HALF_BITS) | right
+
+
+def encode_room_code(number, key=None):
+    """連番（0 <= number < ROOM_CODE_SPACE）を6桁の部屋コードに変換（全単射）"""
+    if not 0 <= number < ROOM_CODE_SPACE:
+        raise ValueError(f'room code number out of range: {number}')
+    key = _key() if key is None else key
+    # cycle-walking: 範囲外に出たら範囲内に戻るまで置換を繰り返す（全単射のまま）
+    value = _permute32(number, key)
+    while value >= ROOM_CODE_SPACE:
+        value = _permute32(value, key)
+    chars = []
+    for _ in range(ROOM_CODE_LENGTH):
+        value, index = divmod(value, len(ROOM_CODE_ALPHABET))
+        chars.append(ROOM_CODE_ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+def _block_size():
+    return getattr(settings, 'MAHJONG_ROOM_CODE_BLOCK_SIZE', 100)
+
+
+class RoomCodeAllocator:
+    """ワーカー内で連番のブロックを予約し、部屋コードを払い出す"""
+
+    def __init__(self):
+        self._next = 0
+        self._end = 0
+        # このワーカーが払い出した最大の連番。予約がロールバックされても
+        # （テストのトランザクションなど）同じ連番を再び使わないために使う
+        self._high = 0
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """次の部屋コード"""
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve_block()
+            number = self._next
+            self._next += 1
+            self._high = max(self._high, self._next)
+        return encode_room_code(number)
+
+    def _reserve_block(self):
+        """連番をブロック単位で予約し、(開始, 終了) を返す"""
+        size = _block_size()
+        with transaction.atomic():
+            updated = RoomCodeSequence.objects.filter(pk=1).update(
+                next_value=Greatest(F('next_value'), Value(self._high)) + size
+            )
+            if not updated:
+                try:
+                    with transaction.atomic():
+                        RoomCodeSequence.objects.create(pk=1, next_value=self._high + size)
+                except IntegrityError:
+                    # 他のワーカーが先に作成した
+                    return self._reserve_block()
+            end = RoomCodeSequence.objects.values_list('next_value', flat=True).get(pk=1)
+        if end > ROOM_CODE_SPACE:
+            raise RuntimeError('room code space exhausted')
+        return end - size, end
+
+
+allocator = RoomCodeAllocator()
@@ -0,0 +1,92 @@
+"""
+スコア計算エンジン
+
+順位・ウマ・オカの計算をビューから切り離した純粋な計算モジュール。
+部屋ごとのルールを RuleTable にコンパイルし、(N半荘 × 4人) の持ち点行列を
+NumPyで一括計算する。1半荘だけを計算する場合も同じ経路を通る。
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+PLAYERS_PER_GAME = 4
+
+# 同点時にプレイヤー順を指定しない場合のデフォルト（列順 = プレイヤー順）
+_DEFAULT_ORDERS = np.arange(1, PLAYERS_PER_GAME + 1)
+_RANKS = np.arange(1, PLAYERS_PER_GAME + 1)
+
+
+@dataclass(frozen=True, slots=True)
+class RuleTable:
+    """部屋のルールをコンパイルした計算テーブル"""
+    uma: tuple  # 1位〜4位のウマ
+    oka: int  # トップ取りのオカ（1位のみ）
+    return_points: int  # 返し点
+
+    @classmethod
+    def from_room(cls, room):
+        """Roomからルールテーブルを作成（サシウマの解決は1回だけ行う）"""
+        uma_1_2, uma_3_4 = room._get_sashi_uma_values()
+        return cls(
+            uma=(uma_3_4, uma_1_2, -uma_1_2, -uma_3_4),
+            oka=room.oka,
+            return_points=room.return_points,
+        )
+
+    @property
+    def uma_vector(self):
+        """順位-1 をインデックスとするウマのベクトル"""
+        return np.asarray(self.uma, dtype=np.float64)
+
+
+def compile_rules(room):
+    """部屋のルールテーブルを取得"""
+    return RuleTable.from_room(room)
+
+
+def rank_matrix(scores, orders=None):
+    """
+    順位行列を計算
+
+    持ち点の高い順に1〜4位を割り当てる。同点の場合はプレイヤー順
+    （orderが小さい方）を上位とし、同点でも順位は分ける。
+    """
+    scores = np.asarray(scores, dtype=np.int64).reshape(-1, PLAYERS_PER_GAME)
+    if orders is None:
+        orders = np.broadcast_to(_DEFAULT_ORDERS, scores.shape)
+    else:
+        orders = np.broadcast_to(np.asarray(orders, dtype=np.int64), scores.shape)
+
+    # lexsortは最後のキーが第1キー: 持ち点の降順 → プレイヤー順の昇順
+    positions = np.lexsort((orders, -scores), axis=-1)
+    ranks = np.empty_like(positions)
+    np.put_along_axis(ranks, positions, np.broadcast_to(_RANKS, scores.shape), axis=-1)
+    return ranks
+
+
+def score_games(rules, scores, orders=None):
+    """
+    (N半荘 × 4人) の持ち点行列から順位とポイントを一括計算
+
+    ポイント = 素点 (持ち点 - 返し点) / 1000 + ウマ + オカ（1位のみ）
+    素点の合計が0でなくても調整しない（持ち点の合計が返し点×4でないのは正常）。
+
+    Returns:
+        (ranks, points): どちらも scores と同じ形の (N, 4) 配列
+    """
+    scores = np.asarray(scores, dtype=np.int64).reshape(-1, PLAYERS_PER_GAME)
+    ranks = rank_matrix(scores, orders)
+    base_points = (scores - rules.return_points) / 1000
+    points = base_points + rules.uma_vector[ranks - 1] + np.where(ranks == 1, rules.oka, 0)
+    return ranks, points
+
+
+def score_game(rules, scores, orders=None):
+    """
+    1半荘分の順位とポイントを計算（score_gamesと同じ経路）
+
+    Returns:
+        入力と同じ並びの (順位, ポイント) のリスト
+    """
+    ranks, points = score_games(rules, [scores], None if orders is None else [orders])
+    return [(int(rank), float(point)) for rank, point in zip(ranks[0], points[0])]
@@ -0,0 +1,257 @@
+"""
+スコア記録の書き込み処理
+
+ビューと管理コマンドで共有するデータベース操作をまとめたモジュール。
+計算そのものは mahjong.scoring に任せ、ここでは読み書きだけを扱う。
+"""
+import time
+from dataclasses import dataclass
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Case, F, FloatField, IntegerField, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import cache as room_cache
+from . import scoring
+from .models import Game, Player, Room, RoomChange, ScoreRecord
+
+# 1回のNumPy計算で扱う半荘数
+RESCORE_BATCH_GAMES = 2000
+# 書き戻し1回あたりのレコード数
+BULK_UPDATE_CHUNK = 500
+# 部屋ごとに残す変更履歴の件数（これより古いバージョンからのポーリングは全体を返す）
+ROOM_CHANGE_RETENTION = 100
+
+
+def bump_room_version(room_id, kind=RoomChange.KIND_RESET, game_id=None):
+    """
+    部屋のバージョンを加算し、変更履歴を記録して新しいバージョンを返す
+
+    ダッシュボードの表示内容が変わる書き込み（スコア記録・ゲーム削除・再計算・
+    プレイヤー編集・設定変更）の後に、同じトランザクションの中で呼ぶ。
+    ゲームの追加・削除以外の変更は kind を省略する（ゲーム履歴は全体を描画し直す）。
+    部屋のキャッシュ（mahjong.cache）もここで削除する。
+    """
+    updates = {'version': F('version') + 1, 'changed_at': timezone.now()}
+    if kind == RoomChange.KIND_RESET:
+        # 描画済みのゲームの行（mahjong.cache.game_row_key）を使わなくする
+        updates['rows_version'] = F('version') + 1
+    Room.objects.filter(pk=room_id).update(**updates)
+    version, room_code = Room.objects.filter(pk=room_id).values_list('version', 'code').get()
+    room_cache.invalidate_room(room_code)
+    RoomChange.objects.create(room_id=room_id, version=version, kind=kind, game_id=game_id)
+    # 差分の計算に使うのは直近の履歴だけなので、ときどき古い履歴を削除する
+    if version % ROOM_CHANGE_RETENTION == 0:
+        RoomChange.objects.filter(room_id=room_id, version__lte=version - ROOM_CHANGE_RETENTION).delete()
+    return version
+
+
+def _add_to_player_totals(rows, sign=1):
+    """
+    (player_id, ポイント, チップ増減) の行の分だけ累計成績を加減算
+
+    1半荘分（4人）をCASE式で1つのUPDATE文にまとめる。
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    Player.objects.filter(pk__in=[player_id for player_id, _, _ in rows]).update(
+        total_points=F('total_points') + Case(
+            *[When(pk=player_id, then=Value(sign * (points or 0.0))) for player_id, points, _ in rows],
+            output_field=FloatField(),
+        ),
+        total_chips=F('total_chips') + Case(
+            *[When(pk=player_id, then=Value(sign * chip_change)) for player_id, _, chip_change in rows],
+            output_field=IntegerField(),
+        ),
+    )
+
+
+def player_totals_from_records():
+    """ScoreRecordから集計した累計成績（Playerの各行に対するサブクエリ式）"""
+    per_player = ScoreRecord.objects.filter(player=OuterRef('pk')).order_by().values('player')
+    return {
+        'total_points': Coalesce(
+            Subquery(per_player.annotate(total=Sum('points')).values('total')),
+            Value(0.0),
+        ),
+        'total_chips': Coalesce(
+            Subquery(per_player.annotate(total=Sum('chip_change')).values('total')),
+            Value(0),
+        ),
+    }
+
+
+def recalculate_player_totals(players):
+    """累計成績をScoreRecordから計算し直す（再計算・ずれの修復用）"""
+    return players.update(**player_totals_from_records())
+
+
+def record_game(room, entries):
+    """
+    1半荘分のスコアを記録
+
+    entries は検証済みの (player, 持ち点, チップ増減) のリスト。
+    順位とポイントはトランザクションの外で計算し、ゲームと4人分の記録は
+    1つのトランザクションの中で INSERT 2文（ゲーム + bulk_create）で書き込む。
+    累計成績も同じトランザクションで加算する。
+    """
+    results = scoring.score_game(
+        scoring.compile_rules(room),
+        [score for _, score, _ in entries],
+        [player.order for player, _, _ in entries],
+    )
+    with transaction.atomic():
+        last_number = Game.objects.filter(room=room).aggregate(
+            last=Max('game_number')
+        )['last'] or 0
+        game = Game.objects.create(room=room, game_number=last_number + 1)
+        ScoreRecord.objects.bulk_create([
+            ScoreRecord(
+                game=game,
+                player=player,
+                score=score,
+                chip_change=chip_change,
+                rank=rank,
+                points=points,
+            )
+            for (player, score, chip_change), (rank, points) in zip(entries, results)
+        ])
+        _add_to_player_totals(
+            (player.id, points, chip_change)
+            for (player, _, chip_change), (_, points) in zip(entries, results)
+        )
+        bump_room_version(room.pk, RoomChange.KIND_GAME_ADDED, game.pk)
+    return game
+
+
+def delete_game(game):
+    """ゲームを削除し、その分を累計成績から差し引く"""
+    with transaction.atomic():
+        game_id = game.pk  # delete()でpkはNoneになる
+        rows = list(game.score_records.values_list('player_id', 'points', 'chip_change'))
+        game.delete()
+        _add_to_player_totals(rows, sign=-1)
+        bump_room_version(game.room_id, RoomChange.KIND_GAME_DELETED, game_id)
+
+
+@dataclass(slots=True)
+class RescoreResult:
+    """再計算の結果"""
+    games: int = 0
+    records: int = 0
+    skipped_games: int = 0
+    seconds: float = 0.0
+
+    @property
+    def records_per_second(self):
+        return self.records / self.seconds if self.seconds else 0.0
+
+
+def _iter_games(rows):
+    """(game_id, id, score, order) の行を半荘ごとにまとめる"""
+    for _, group in groupby(rows, key=itemgetter(0)):
+        yield [row[1:] for row in group]
+
+
+def _iter_rescore_pages(room, page_games):
+    """
+    部屋のスコア記録を (game_id, id, score, order) の行のリストで、page_games 半荘分ずつ返す
+
+    書き戻しと同じ接続で読むため、読み込み中のカーソルを開いたまま書き込まないよう
+    ページごとに読み切る。次のページは最後の半荘の game_id の次から読む（キーセット）。
+    """
+    if page_games < 1:
+        raise ValueError(f'page_games must be at least 1: {page_games}')
+    records = (
+        ScoreRecord.objects
+        .filter(game__room=room)
+        .order_by('game_id', 'player__order')
+        .values_list('game_id', 'id', 'score', 'player__order')
+    )
+    limit = page_games * scoring.PLAYERS_PER_GAME
+    last_game_id = 0
+    while True:
+        # 1行多く読み、ページの最後の半荘の記録が次のページに続くかを確かめる
+        rows = list(records.filter(game_id__gt=last_game_id)[:limit + 1])
+        if len(rows) <= limit:
+            if rows:
+                yield rows
+            return
+        page = rows[:limit]
+        if rows[limit][0] == page[-1][0]:
+            # 途中で切れた最後の半荘は、次のページで読み直す
+            complete = [row for row in page if row[0] != page[-1][0]]
+            # 1つの半荘だけでページを超える場合は、その半荘を最後まで読む
+            page = complete or list(records.filter(game_id=page[-1][0]))
+        last_game_id = page[-1][0]
+        yield page
+
+
+def _write_ranks_and_points(rows):
+    """
+    (rank, points, id) の行をチャンクごとの executemany で書き戻す
+
+    Model.objects.bulk_update は CASE WHEN 式の組み立てがレコード数に比例して重く、
+    大量の再計算では処理時間のほとんどを占めるため、主キー指定のUPDATEを直接流す。
+    """
+    meta = ScoreRecord._meta
+    quote = connection.ops.quote_name
+    sql = 'UPDATE {} SET {} = %s, {} = %s WHERE {} = %s'.format(
+        quote(meta.db_table),
+        quote(meta.get_field('rank').column),
+        quote(meta.get_field('points').column),
+        quote(meta.pk.column),
+    )
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), BULK_UPDATE_CHUNK):
+            cursor.executemany(sql, rows[start:start + BULK_UPDATE_CHUNK])
+
+
+def _flush_rescore_batch(rules, batch, result):
+    """溜めた半荘を一括計算して書き戻す"""
+    if not batch:
+        return
+    matrix = np.array(batch, dtype=np.int64)  # (半荘数, 4, [id, 持ち点, order])
+    ranks, points = scoring.score_games(rules, matrix[:, :, 1], matrix[:, :, 2])
+    rows = list(zip(
+        ranks.ravel().tolist(),
+        points.ravel().tolist(),
+        matrix[:, :, 0].ravel().tolist(),
+    ))
+    _write_ranks_and_points(rows)
+    result.games += len(batch)
+    result.records += len(rows)
+
+
+def rescore_room(room, batch_games=RESCORE_BATCH_GAMES):
+    """
+    部屋の全スコア記録の順位とポイントを現在のルールで再計算
+
+    設定変更（返し点・サシウマ・オカ）後に保存済みのポイントを揃えるために使う。
+    記録は batch_games 半荘ずつのページで読み込んでまとめて計算し、部屋ごとに
+    1つのトランザクションで書き戻す（累計成績も同じトランザクションで更新）。
+    4人分の記録が揃っていない半荘は計算できないためスキップする。
+    """
+    started = time.perf_counter()
+    result = RescoreResult()
+    rules = scoring.compile_rules(room)
+
+    with transaction.atomic():
+        for rows in _iter_rescore_pages(room, batch_games):
+            batch = []
+            for game_rows in _iter_games(rows):
+                if len(game_rows) != scoring.PLAYERS_PER_GAME:
+                    result.skipped_games += 1
+                    continue
+                batch.append(game_rows)
+            _flush_rescore_batch(rules, batch, result)
+        recalculate_player_totals(Player.objects.filter(room=room))
+        bump_room_version(room.pk)
+
+    result.seconds = time.perf_counter() - started
+    return result
@@ -0,0 +1,132 @@
+"""
+同じ計算の同時実行をまとめる（single-flight）
+
+同じ卓の4台のスマートフォンがほぼ同時にポーリングすると、同じ部屋・同じバージョンの
+部分テンプレートを4回計算することになる。
+
+- ワーカー内: 同じキーの計算が実行中なら、終わるのを待って結果を共有する（SingleFlight）
+- ワーカー間: キャッシュの add() をロックにして1つのワーカーだけが計算し、
+  他のワーカーはキャッシュに結果が書かれるのを待つ（acompute_once）。
+  ロックは MAHJONG_SINGLE_FLIGHT_LOCK_SECONDS で期限切れになるため、計算中の
+  ワーカーが落ちても待っている側は自分で計算して続ける
+
+ワーカー間のロックは add() がアトミックなバックエンド（redis・locmem）でだけ使う。
+FileBasedCache の add() は存在の確認と書き込みが別の操作で、複数のワーカーが同時に
+ロックを取れてしまうため、file ではワーカー内のまとめだけになる
+（ワーカーの数だけ同じ計算が走ることがある）。
+
+読み取りのビューは非同期なので、どちらもイベントループ上で動くコルーチンとして実装する。
+"""
+import asyncio
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+from django.utils.connection import ConnectionProxy
+
+_MISSING = object()
+
+# add() がアトミックなキャッシュのバックエンド
+ATOMIC_ADD_BACKENDS = (LocMemCache, RedisCache)
+
+
+def _lock_seconds():
+    return getattr(settings, 'MAHJONG_SINGLE_FLIGHT_LOCK_SECONDS', 2.0)
+
+
+def _poll_seconds():
+    return getattr(settings, 'MAHJONG_SINGLE_FLIGHT_POLL_SECONDS', 0.02)
+
+
+def has_atomic_add(cache):
+    """cache の add() をワーカー間のロックに使えるかどうか"""
+    if isinstance(cache, ConnectionProxy):
+        # django.core.cache.cache は既定のバックエンドへのプロキシ
+        cache = cache._connections[cache._alias]
+    return isinstance(cache, ATOMIC_ADD_BACKENDS)
+
+
+class SingleFlight:
+    """
+    ワーカー内で、同じキーの同時の呼び出しを1回の実行にまとめる
+
+    WSGIでは非同期ビューがリクエストごとに別のイベントループで動くため、ループごとに管理する。
+    """
+
+    def __init__(self):
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _calls(self):
+        return self._loops.setdefault(asyncio.get_running_loop(), {})
+
+    async def do(self, key, func):
+        """await func() の結果と、他の呼び出しの結果を共有したかどうかを返す"""
+        calls = self._calls()
+        future = calls.get(key)
+        if future is not None:
+            try:
+                # 待っている側がキャンセルされても、実行中の計算は止めない
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # 計算していたリクエストが切断された場合は、自分で計算する
+                return await self.do(key, func)
+        future = calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 待っている呼び出しがなければ、例外が取り出されなかった警告を出さない
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            del calls[key]
+        return value, False
+
+    @property
+    def in_flight(self):
+        return sum(len(calls) for calls in self._loops.values())
+
+
+async def acompute_once(cache, key, compute, timeout):
+    """
+    ワーカー間で1回だけ await compute() を実行し、結果をキャッシュに保存して返す
+
+    他のワーカーが計算中なら、キャッシュに結果が書かれるまで待つ。
+    結果と、他のワーカーの結果を使ったかどうかを返す。
+    add() がアトミックでないバックエンドでは、ロックを取らずに計算する。
+    """
+    if not has_atomic_add(cache):
+        value = await compute()
+        await cache.aset(key, value, timeout)
+        return value, False
+    lock_key = f'{key}:lock'
+    lock_seconds = _lock_seconds()
+    locked = await cache.aadd(lock_key, 1, lock_seconds)
+    if not locked:
+        deadline = time.monotonic() + lock_seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(_poll_seconds())
+            value = await cache.aget(key, _MISSING)
+            if value is not _MISSING:
+                return value, True
+    # ロックを取れた（または待ち切れなかった）ので自分で計算する
+    try:
+        value = await compute()
+        await cache.aset(key, value, timeout)
+    finally:
+        # 待ち切れずに計算した場合、ロックは他のワーカーのものなので消さない
+        if locked:
+            await cache.adelete(lock_key)
+    return value, False
+
+
+flight = SingleFlight()
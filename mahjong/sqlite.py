@@ -0,0 +1,45 @@
+"""
+SQLiteの接続設定（PRAGMA）
+
+接続が作られたとき（connection_createdシグナル）に適用する。
+CONN_MAX_AGE で接続を使い回す場合（WSGI）は、リクエストごとのコストはかからない。
+ASGIでは接続を使い回さないため、リクエストごとに接続のオープンと合わせて適用する。
+
+journal_mode のようにデータベースファイルに保存されるPRAGMAは、プロセスごとに
+最初の接続で1回だけ適用し、以降の接続では接続ごとのPRAGMAだけを適用する。
+ロック待ちの設定（OPTIONSの timeout と transaction_mode）は DATABASES で指定する。
+
+適用するPRAGMAは settings.MAHJONG_SQLITE_PRAGMAS で指定する。
+DATABASES の各エントリに 'PRAGMAS' キーがあればそちらを優先する（空の辞書で無効化）。
+"""
+from django.conf import settings
+
+# データベースファイルに保存され、接続を開き直しても変わらないPRAGMA
+PERSISTENT_PRAGMAS = frozenset({'journal_mode'})
+
+# 保存されるPRAGMAを適用済みのデータベース（DATABASESのNAME）
+_persistent_applied = set()
+
+
+def sqlite_pragmas(connection):
+    """接続に適用するPRAGMAの辞書"""
+    pragmas = connection.settings_dict.get('PRAGMAS')
+    if pragmas is None:
+        pragmas = getattr(settings, 'MAHJONG_SQLITE_PRAGMAS', {})
+    return pragmas
+
+
+def apply_sqlite_profile(sender, connection, **kwargs):
+    """新しいSQLite接続にPRAGMAを適用（connection_createdのレシーバー）"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(connection)
+    if not pragmas:
+        return
+    database = str(connection.settings_dict['NAME'])
+    if database in _persistent_applied:
+        pragmas = {name: value for name, value in pragmas.items() if name not in PERSISTENT_PRAGMAS}
+    # Djangoのカーソル（クエリの記録・execute_wrappers）を通さず、DB-APIの接続で直接実行する
+    for name, value in pragmas.items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+    _persistent_applied.add(database)
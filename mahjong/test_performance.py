@@ -0,0 +1,285 @@
+"""
+ビューごとのクエリ数・所要時間の上限のテスト
+
+mahjong/urls.py の全URL（POSTを含む）を、1・100・10,000半荘の部屋で呼び出し、
+クエリ数が部屋の半荘数によらない上限以内に収まることを確認する。
+行ごとにクエリを発行する変更（N+1）を入れると、10,000半荘の部屋で失敗する。
+
+キャッシュは毎回空にして、キャッシュがない場合（最も重い場合）を測る。
+所要時間の上限はCIのマシンの揺らぎを見込んだ緩い値で、桁違いの劣化だけを検出する。
+
+集計・検索のクエリが想定したインデックスを使うこと（実行計画）も確認する。
+"""
+import math
+import time
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .bench import seed_room
+from .models import Game, Player, Room, ScoreRecord
+from .services import BULK_UPDATE_CHUNK, RESCORE_BATCH_GAMES, player_totals_from_records
+
+
+# 部屋の半荘数によらないビューごとのクエリ数の上限
+QUERY_BUDGETS = {
+    'index': 0,
+    'create_room': 4,
+    'join_room': 2,
+    # ワーカー内のヒット・ミスの回数を返すだけで、データベースを読まない
+    'cache_stats': 0,
+    'metrics': 1,
+    'room_setup_get': 2,
+    'room_setup_post': 15,
+    'record_score_get': 2,
+    'record_score_post': 11,
+    'room_dashboard': 4,
+    'game_list_partial': 4,
+    'game_list_partial_before': 4,
+    'game_list_partial_since': 5,
+    'game_list_partial_not_modified': 1,
+    'player_stats_partial': 2,
+    # 接続時の部屋のバージョンの読み込み（ASGIで最初のイベントまで）
+    'room_events': 1,
+    'delete_game': 11,
+    'room_settings_get': 1,
+    'room_settings_post': 7,
+    'edit_players_get': 2,
+    'edit_players_post': 11,
+}
+
+# 所要時間の上限（秒）
+DEFAULT_SECONDS = 1.0
+
+
+def rescore_query_budget(games):
+    """
+    再計算のクエリ数の上限
+
+    記録の読み込みはRESCORE_BATCH_GAMES半荘ごとに1回、書き戻しはBULK_UPDATE_CHUNK件ごとに1回のexecutemany。
+    """
+    return 7 + math.ceil(games / RESCORE_BATCH_GAMES) + math.ceil(games * 4 / BULK_UPDATE_CHUNK)
+
+
+def delete_room_query_budget(games):
+    """
+    部屋の削除のクエリ数の上限
+
+    Djangoのカスケード削除は、スコア記録を500半荘ごと、ゲームを100件ごとのDELETE文で削除する。
+    """
+    return 7 + math.ceil(games / 500) + math.ceil(games / 100)
+
+
+class QueryBudgetMixin:
+    """部屋の半荘数（games）ごとに同じ上限を確認するテスト"""
+
+    games = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.room, cls.players = seed_room(cls.games)
+        cls.latest_game = Game.objects.get(room=cls.room, game_number=cls.games)
+
+    def setUp(self):
+        cache.clear()
+        # 最終使用時刻の書き込みがたまたま計測中に起きないようにする
+        self.enterContext(override_settings(MAHJONG_LAST_USED_FLUSH_SECONDS=3600))
+
+    def assertBudget(self, name, method, url, data=None, budget=None, seconds=DEFAULT_SECONDS, **headers):
+        """1回のリクエストのクエリ数と所要時間が上限以内であることを確認"""
+        budget = QUERY_BUDGETS[name] if budget is None else budget
+        cache.clear()
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data or {}, **headers)
+        elapsed = time.perf_counter() - started
+        self.assertLess(response.status_code, 500, name)
+        self.assertLessEqual(
+            len(queries), budget,
+            f'{name}（{self.games}半荘）: {len(queries)}クエリ（上限{budget}）\n'
+            + '\n'.join(query['sql'] for query in queries.captured_queries),
+        )
+        self.assertLess(elapsed, seconds, f'{name}（{self.games}半荘）: {elapsed:.3f}秒（上限{seconds}秒）')
+        return response
+
+    def url(self, name, *args):
+        return reverse(f'mahjong:{name}', args=[self.room.code, *args])
+
+    def scores(self):
+        data = {}
+        for player, score in zip(self.players, [40000, 30000, 20000, 10000]):
+            data[f'score_{player.id}'] = score
+            data[f'chip_{player.id}'] = 0
+        return data
+
+    def player_names(self):
+        return {f'player_{i}': f'新プレイヤー{i}' for i in range(1, 5)}
+
+    def test_index(self):
+        self.assertBudget('index', 'get', reverse('mahjong:index'))
+
+    def test_create_room(self):
+        self.assertBudget('create_room', 'post', reverse('mahjong:create_room'))
+
+    def test_join_room(self):
+        response = self.assertBudget('join_room', 'post', reverse('mahjong:join_room'), {'room_code': self.room.code})
+        self.assertEqual(response.status_code, 302)
+
+    def test_cache_stats(self):
+        # 回数が記録された状態で測る（空の集計を返すだけの場合と区別する）
+        self.client.get(self.url('room_dashboard'))
+        with override_settings(MAHJONG_METRICS_TOKEN='secret'):
+            response = self.assertBudget(
+                'cache_stats', 'get', reverse('mahjong:cache_stats'), HTTP_AUTHORIZATION='Bearer secret'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('room', response.json())
+
+    def test_metrics(self):
+        with override_settings(MAHJONG_METRICS_TOKEN='secret'):
+            response = self.assertBudget(
+                'metrics', 'get', reverse('mahjong:metrics'), HTTP_AUTHORIZATION='Bearer secret'
+            )
+        self.assertEqual(response.status_code, 200)
+
+    def test_room_setup(self):
+        self.assertBudget('room_setup_get', 'get', self.url('room_setup'))
+        self.assertBudget('room_setup_post', 'post', self.url('room_setup'), self.player_names())
+
+    def test_record_score(self):
+        self.assertBudget('record_score_get', 'get', self.url('record_score'))
+        response = self.assertBudget('record_score_post', 'post', self.url('record_score'), self.scores())
+        self.assertRedirects(response, self.url('room_dashboard'), fetch_redirect_response=False)
+
+    def test_room_dashboard(self):
+        response = self.assertBudget('room_dashboard', 'get', self.url('room_dashboard'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_game_list_partial(self):
+        self.assertBudget('game_list_partial', 'get', self.url('game_list_partial'))
+        self.assertBudget(
+            'game_list_partial_before', 'get', self.url('game_list_partial'), {'before': self.games // 2 + 1}
+        )
+        self.assertBudget(
+            'game_list_partial_since', 'get', self.url('game_list_partial'), {'since': self.room.version - 1}
+        )
+        response = self.assertBudget(
+            'game_list_partial_not_modified', 'get', self.url('game_list_partial'),
+            HTTP_IF_NONE_MATCH=f'"game-list-{self.room.code}-{self.room.version}"',
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_player_stats_partial(self):
+        self.assertBudget('player_stats_partial', 'get', self.url('player_stats_partial'))
+
+    @override_settings(MAHJONG_EVENTS_POLL_SECONDS=60)
+    def test_room_events(self):
+        # WSGIでは204を返すだけなので、ASGIで接続して最初のイベントを受け取るまでを測る
+        # （接続前の変更を通知する場合。バージョンの監視のクエリは部屋ごとに共有）
+        async def first_event():
+            response = await self.async_client.get(
+                self.url('room_events'), headers={'Last-Event-ID': str(self.room.version - 1)}
+            )
+            stream = aiter(response.streaming_content)
+            try:
+                await anext(stream)
+                return await anext(stream)
+            finally:
+                await stream.aclose()
+
+        budget = QUERY_BUDGETS['room_events']
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            chunk = async_to_sync(first_event)()
+        elapsed = time.perf_counter() - started
+        self.assertIn(f'data: {self.room.version}'.encode(), chunk)
+        self.assertLessEqual(
+            len(queries), budget,
+            f'room_events（{self.games}半荘）: {len(queries)}クエリ（上限{budget}）\n'
+            + '\n'.join(query['sql'] for query in queries.captured_queries),
+        )
+        self.assertLess(elapsed, DEFAULT_SECONDS, f'room_events（{self.games}半荘）: {elapsed:.3f}秒（上限{DEFAULT_SECONDS}秒）')
+
+    def test_delete_game(self):
+        response = self.assertBudget('delete_game', 'post', self.url('delete_game', self.latest_game.id))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Game.objects.filter(pk=self.latest_game.pk).exists())
+
+    def test_rescore_room(self):
+        self.assertBudget(
+            'rescore_room', 'post', self.url('rescore_room'),
+            budget=rescore_query_budget(self.games), seconds=10.0,
+        )
+
+    def test_delete_room(self):
+        self.assertBudget(
+            'delete_room', 'post', self.url('delete_room'),
+            budget=delete_room_query_budget(self.games), seconds=10.0,
+        )
+        self.assertFalse(Room.objects.filter(pk=self.room.pk).exists())
+
+    def test_edit_players(self):
+        self.assertBudget('edit_players_get', 'get', self.url('edit_players'))
+        self.assertBudget('edit_players_post', 'post', self.url('edit_players'), self.player_names())
+
+    def test_room_settings(self):
+        self.assertBudget('room_settings_get', 'get', self.url('room_settings'))
+        self.assertBudget('room_settings_post', 'post', self.url('room_settings'), {
+            'sashi_uma_type': '10-20', 'rate_type': 'ten5',
+            'starting_points': 25000, 'return_points': 30000, 'chip_point_rate': 100,
+        })
+
+
+class OneGameQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """1半荘の部屋"""
+    games = 1
+
+
+class HundredGamesQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """100半荘の部屋"""
+    games = 100
+
+
+class TenThousandGamesQueryBudgetTest(QueryBudgetMixin, TestCase):
+    """10,000半荘の部屋"""
+    games = 10000
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN はSQLiteのみ')
+class QueryPlanTest(TestCase):
+    """集計・検索のクエリがインデックス（0015_tuned_indexes）を使うことの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.room, cls.players = seed_room(10)
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def test_player_totals_use_covering_index(self):
+        """累計成績の集計は、スコア記録の表を読まずにインデックスだけで行う"""
+        totals = player_totals_from_records()
+        plan = self.query_plan(
+            Player.objects.filter(room=self.room).annotate(points_sum=totals['total_points'])
+        )
+        self.assertIn('USING COVERING INDEX mahjong_sco_player__abeb9e_idx', plan)
+
+    def test_records_by_player_use_composite_index(self):
+        """player_id の単独のインデックスの代わりに複合インデックスを使う"""
+        plan = self.query_plan(ScoreRecord.objects.filter(player=self.players[0]).values('pk'))
+        self.assertIn('mahjong_sco_player__abeb9e_idx', plan)
+
+    def test_rooms_by_last_used_use_index(self):
+        """古い部屋・使用中の部屋の検索は部屋の表を全件読まない"""
+        plan = self.query_plan(Room.objects.filter(last_used_at__lt=timezone.now()).order_by().values('pk'))
+        self.assertIn('mahjong_roo_last_us_adba72_idx', plan)
+        self.assertNotIn('SCAN mahjong_room', plan)
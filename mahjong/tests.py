@@ -1,7 +1,17 @@
-from django.test import TestCase, Client
+import asyncio
+from asgiref.sync import async_to_sync, sync_to_async
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import F
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.messages import get_messages
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from .models import Room, Player, Game, ScoreRecord
+from . import scoring
 
 
 class RoomModelTest(TestCase):
@@ -273,7 +283,7 @@ class ViewTest(TestCase):
             players.append(Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i))
         
         post_data = {}
-        scores = [35000, 30000, 25000, 20000]  # 合計110000点
+        scores = [35000, 30000, 20000, 15000]  # 合計100000点（25000点 × 4人）
         for i, player in enumerate(players):
             post_data[f'score_{player.id}'] = scores[i]
             post_data[f'chip_{player.id}'] = 0
@@ -284,7 +294,50 @@ class ViewTest(TestCase):
         # ゲームが作成されているか確認
         game = Game.objects.filter(room=self.room).first()
         self.assertIsNotNone(game)
+        self.assertEqual(game.game_number, 1)
         self.assertEqual(game.score_records.count(), 4)
+        self.assertEqual(
+            sorted(game.score_records.values_list('rank', flat=True)), [1, 2, 3, 4]
+        )
+    
+    def test_record_score_view_post_invalid_total_creates_no_game(self):
+        """持ち点の合計が不正な場合にゲームが作成されないことを確認"""
+        players = []
+        for i in range(1, 5):
+            players.append(Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i))
+        
+        post_data = {}
+        scores = [35000, 30000, 25000, 20000]  # 合計110000点（不正）
+        for i, player in enumerate(players):
+            post_data[f'score_{player.id}'] = scores[i]
+            post_data[f'chip_{player.id}'] = 0
+        
+        response = self.client.post(reverse('mahjong:record_score', args=[self.room.code]), post_data)
+        self.assertEqual(response.status_code, 302)
+        messages = list(get_messages(response.wsgi_request))
+        self.assertTrue(any('持ち点の合計が正しくありません' in str(m) for m in messages))
+        self.assertFalse(Game.objects.filter(room=self.room).exists())
+    
+    def test_record_score_view_post_game_number_increments(self):
+        """続けて記録するとゲーム番号が連番になることを確認"""
+        players = []
+        for i in range(1, 5):
+            players.append(Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i))
+        
+        post_data = {}
+        for player in players:
+            post_data[f'score_{player.id}'] = 25000
+            post_data[f'chip_{player.id}'] = 0
+        
+        url = reverse('mahjong:record_score', args=[self.room.code])
+        self.client.post(url, post_data)
+        self.client.post(url, post_data)
+        self.assertEqual(
+            list(Game.objects.filter(room=self.room).order_by('game_number')
+                 .values_list('game_number', flat=True)),
+            [1, 2]
+        )
+        self.assertEqual(ScoreRecord.objects.filter(game__room=self.room).count(), 8)
     
     def test_record_score_view_post_invalid_score_range(self):
         """スコアが範囲外の場合のエラーを確認"""
@@ -995,3 +1048,1542 @@ class MahjongCalculationTest(TestCase):
         # 4位: 0 - 20 = -20.0pt
         record_4th = [r for r in records if r.rank == 4][0]
         self.assertEqual(record_4th.points, -20.0)
+
+
+class ScoringEngineTest(TestCase):
+    """スコア計算エンジン（mahjong.scoring）のテスト"""
+    
+    def setUp(self):
+        self.room = Room.objects.create(
+            sashi_uma_type='10-20',
+            starting_points=25000,
+            return_points=30000,
+            oka=20
+        )
+        self.rules = scoring.compile_rules(self.room)
+    
+    def test_compile_rules(self):
+        """部屋の設定からルールテーブルが作成されることを確認"""
+        self.assertEqual(self.rules.uma, (20, 10, -10, -20))
+        self.assertEqual(self.rules.oka, 20)
+        self.assertEqual(self.rules.return_points, 30000)
+    
+    def test_score_game(self):
+        """1半荘の順位とポイントが入力順で返ることを確認"""
+        results = scoring.score_game(self.rules, [25000, 35000, 20000, 30000])
+        self.assertEqual(results, [(3, -15.0), (1, 45.0), (4, -30.0), (2, 10.0)])
+    
+    def test_score_game_tie_uses_player_order(self):
+        """同点の場合はプレイヤー順（orderが小さい方）が上位になることを確認"""
+        results = scoring.score_game(
+            self.rules, [30000, 30000, 30000, 10000], orders=[3, 1, 2, 4]
+        )
+        self.assertEqual([rank for rank, _ in results], [3, 1, 2, 4])
+    
+    def test_score_games_matches_baseline_formula(self):
+        """一括計算の結果が、素点 + ウマ + オカ（1位のみ）で手計算した値と一致することを確認"""
+        matrix = [
+            [35000, 30000, 25000, 10000],
+            [30000, 30000, 30000, 10000],
+            [-5000, 60000, 25000, 20000],
+        ]
+        ranks, points = scoring.score_games(self.rules, matrix)
+        self.assertEqual(ranks.shape, (3, 4))
+        self.assertEqual(ranks.tolist(), [
+            [1, 2, 3, 4],
+            # 同点はプレイヤー順（列順）で上位
+            [1, 2, 3, 4],
+            [4, 1, 2, 3],
+        ])
+        self.assertEqual(points.tolist(), [
+            # 1位: 5 + 20 + 20 = 45、2位: 0 + 10、3位: -5 - 10、4位: -20 - 20
+            [45.0, 10.0, -15.0, -40.0],
+            [40.0, 10.0, -10.0, -40.0],
+            # 4位: -35 - 20 = -55、1位: 30 + 20 + 20 = 70、2位: -5 + 10、3位: -10 - 10
+            [-55.0, 70.0, 5.0, -20.0],
+        ])
+    
+    def test_view_uses_engine(self):
+        """スコア入力ビューの計算結果がエンジンと一致することを確認"""
+        players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+        scores = [40000, 30000, 20000, 10000]
+        post_data = {}
+        for player, score in zip(players, scores):
+            post_data[f'score_{player.id}'] = score
+            post_data[f'chip_{player.id}'] = 0
+        self.client.post(reverse('mahjong:record_score', args=[self.room.code]), post_data)
+        
+        expected = scoring.score_game(self.rules, scores)
+        for player, (rank, points) in zip(players, expected):
+            record = ScoreRecord.objects.get(player=player)
+            self.assertEqual(record.rank, rank)
+            self.assertEqual(record.points, points)
+
+
+class RescoreTest(TestCase):
+    """保存済みスコア記録の再計算のテスト"""
+    
+    def setUp(self):
+        self.room = Room.objects.create(sashi_uma_type='10-20', return_points=30000, oka=20)
+        self.players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+        self.games = []
+        for game_number, scores in enumerate([[35000, 30000, 25000, 10000],
+                                              [10000, 25000, 30000, 35000]], start=1):
+            game = Game.objects.create(room=self.room, game_number=game_number)
+            results = scoring.score_game(scoring.compile_rules(self.room), scores)
+            for player, score, (rank, points) in zip(self.players, scores, results):
+                ScoreRecord.objects.create(
+                    game=game, player=player, score=score, rank=rank, points=points
+                )
+            self.games.append(game)
+    
+    def _change_rules(self):
+        self.room.sashi_uma_type = '5-10'
+        self.room.return_points = 25000
+        self.room.save()
+    
+    def test_rescore_room_applies_new_rules(self):
+        """設定変更後の再計算で新しいルールのポイントになることを確認"""
+        from .services import rescore_room
+        self._change_rules()
+        result = rescore_room(self.room)
+        self.assertEqual(result.games, 2)
+        self.assertEqual(result.records, 8)
+        
+        # 1位: (35000-25000)/1000 + 10(ウマ) + 20(オカ) = 40.0pt
+        record = ScoreRecord.objects.get(game=self.games[0], player=self.players[0])
+        self.assertEqual(record.rank, 1)
+        self.assertEqual(record.points, 40.0)
+        # 4位: (10000-25000)/1000 - 10(ウマ) = -25.0pt
+        record = ScoreRecord.objects.get(game=self.games[1], player=self.players[0])
+        self.assertEqual(record.rank, 4)
+        self.assertEqual(record.points, -25.0)
+    
+    def test_rescore_skips_incomplete_games(self):
+        """4人分の記録が揃っていない半荘はスキップされることを確認"""
+        from .services import rescore_room
+        ScoreRecord.objects.filter(game=self.games[1], player=self.players[3]).delete()
+        result = rescore_room(self.room, batch_games=1)
+        self.assertEqual(result.games, 1)
+        self.assertEqual(result.skipped_games, 1)
+    
+    def test_rescore_pages_do_not_split_games(self):
+        """記録の欠けた半荘でページの境目がずれても、次の半荘を分割せずに計算することを確認"""
+        from .services import rescore_room
+        self._change_rules()
+        ScoreRecord.objects.filter(game=self.games[0], player=self.players[3]).delete()
+        # 1ページ4行のうち、先頭の半荘の3行と次の半荘の1行が同じページに入る
+        result = rescore_room(self.room, batch_games=1)
+        self.assertEqual((result.games, result.skipped_games), (1, 1))
+        record = ScoreRecord.objects.get(game=self.games[1], player=self.players[0])
+        self.assertEqual((record.rank, record.points), (4, -25.0))
+    
+    def test_rescore_reads_whole_game_larger_than_page(self):
+        """1つの半荘の記録が1ページより多くても、途中で切らずに読んで（4人分でないので）スキップすることを確認"""
+        from .services import rescore_room
+        self._change_rules()
+        ScoreRecord.objects.create(game=self.games[0], player=self.players[0], score=1000)
+        result = rescore_room(self.room, batch_games=1)
+        self.assertEqual((result.games, result.skipped_games), (1, 1))
+        record = ScoreRecord.objects.get(game=self.games[1], player=self.players[0])
+        self.assertEqual((record.rank, record.points), (4, -25.0))
+    
+    def test_rescore_command(self):
+        """管理コマンドで部屋を再計算できることを確認"""
+        from io import StringIO
+        from django.core.management import call_command, CommandError
+        self._change_rules()
+        out = StringIO()
+        call_command('rescore_room', self.room.code, stdout=out)
+        self.assertIn('8 件を再計算しました', out.getvalue())
+        self.assertEqual(
+            ScoreRecord.objects.get(game=self.games[0], player=self.players[0]).points, 40.0
+        )
+        with self.assertRaises(CommandError):
+            call_command('rescore_room', stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('rescore_room', 'XXXXXX', stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('rescore_room', self.room.code, '--batch-games', '0', stdout=out)
+    
+    def test_rescore_view(self):
+        """ダッシュボードの再計算ボタン（POST）で再計算されることを確認"""
+        self._change_rules()
+        response = self.client.post(reverse('mahjong:rescore_room', args=[self.room.code]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            ScoreRecord.objects.get(game=self.games[0], player=self.players[0]).points, 40.0
+        )
+
+
+class PlayerTotalsTest(TestCase):
+    """プレイヤーの累計成績（非正規化した集計値）のテスト"""
+    
+    def setUp(self):
+        self.room = Room.objects.create(sashi_uma_type='10-20', return_points=30000, oka=20)
+        self.players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+    
+    def _post_game(self, scores, chips=(0, 0, 0, 0)):
+        post_data = {}
+        for player, score, chip in zip(self.players, scores, chips):
+            post_data[f'score_{player.id}'] = score
+            post_data[f'chip_{player.id}'] = chip
+        self.client.post(reverse('mahjong:record_score', args=[self.room.code]), post_data)
+    
+    def _totals(self):
+        return [
+            (player.total_points, player.total_chips)
+            for player in Player.objects.filter(room=self.room).order_by('order')
+        ]
+    
+    def test_record_and_delete_update_totals(self):
+        """スコア記録とゲーム削除で累計成績が更新されることを確認"""
+        self._post_game([40000, 30000, 20000, 10000], chips=(3, 1, -1, -3))
+        self._post_game([10000, 20000, 30000, 40000])
+        # 1ゲーム目: 50, 10, -20, -40 / 2ゲーム目: -40, -20, 10, 50
+        self.assertEqual(self._totals(), [(10.0, 3), (-10.0, 1), (-10.0, -1), (10.0, -3)])
+        
+        game = Game.objects.get(room=self.room, game_number=2)
+        self.client.post(reverse('mahjong:delete_game', args=[self.room.code, game.id]))
+        self.assertEqual(self._totals(), [(50.0, 3), (10.0, 1), (-20.0, -1), (-40.0, -3)])
+    
+    def test_rescore_updates_totals(self):
+        """再計算後に累計成績も新しいルールに揃うことを確認"""
+        from .services import rescore_room
+        self._post_game([40000, 30000, 20000, 10000])
+        self.room.return_points = 25000
+        self.room.save()
+        rescore_room(self.room)
+        # 55.0, 15.0, -15.0, -35.0
+        self.assertEqual([points for points, _ in self._totals()], [55.0, 15.0, -15.0, -35.0])
+    
+    def test_player_stats_partial_reads_totals(self):
+        """統計の部分テンプレートが累計値を表示し、クエリ数がゲーム数に依存しないことを確認"""
+        self._post_game([40000, 30000, 20000, 10000], chips=(2, 0, 0, -2))
+        url = reverse('mahjong:player_stats_partial', args=[self.room.code])
+        response = self.client.get(url)
+        stats = response.context['player_stats']
+        self.assertEqual(stats[0].total_points, 50.0)
+        self.assertEqual(stats[0].total_amount_pt, 5000.0 + 200.0)
+        
+        # キャッシュなしのクエリ数を比べる
+        cache.clear()
+        with CaptureQueriesContext(connection) as one_game:
+            self.client.get(url)
+        for _ in range(5):
+            self._post_game([25000, 25000, 25000, 25000])
+        cache.clear()
+        with CaptureQueriesContext(connection) as six_games:
+            self.client.get(url)
+        self.assertEqual(len(one_game), len(six_games))
+    
+    def test_verify_player_totals_repairs_drift(self):
+        """verify_player_totalsコマンドでずれを検出・修復できることを確認"""
+        from io import StringIO
+        from django.core.management import call_command
+        self._post_game([40000, 30000, 20000, 10000], chips=(1, 0, 0, -1))
+        Player.objects.filter(pk=self.players[0].pk).update(total_points=0.0, total_chips=99)
+        
+        out = StringIO()
+        call_command('verify_player_totals', self.room.code, stdout=out)
+        self.assertIn('1 人の累計成績がずれています', out.getvalue())
+        self.assertEqual(Player.objects.get(pk=self.players[0].pk).total_chips, 99)
+        
+        out = StringIO()
+        call_command('verify_player_totals', '--repair', stdout=out)
+        self.assertIn('1 人の累計成績を修復しました', out.getvalue())
+        player = Player.objects.get(pk=self.players[0].pk)
+        self.assertEqual((player.total_points, player.total_chips), (50.0, 1))
+        
+        out = StringIO()
+        call_command('verify_player_totals', stdout=out)
+        self.assertIn('すべて一致しています', out.getvalue())
+    
+    def test_verify_player_totals_repair_refreshes_stats(self):
+        """修復すると部屋のバージョンが上がり、キャッシュされた成績表も新しい値になることを確認"""
+        from io import StringIO
+        from django.core.management import call_command
+        cache.clear()
+        self._post_game([40000, 30000, 20000, 10000], chips=(1, 0, 0, -1))
+        Player.objects.filter(pk=self.players[0].pk).update(total_chips=99)
+        url = reverse('mahjong:player_stats_partial', args=[self.room.code])
+        before = self.client.get(url)
+        self.assertContains(before, '99')
+        version = Room.objects.get(pk=self.room.pk).version
+        
+        call_command('verify_player_totals', '--repair', stdout=StringIO())
+        self.assertEqual(Room.objects.get(pk=self.room.pk).version, version + 1)
+        after = self.client.get(url, HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertNotContains(after, '99')
+
+
+class RoomReadModelTest(TestCase):
+    """部屋の読み取りモデル（RoomReadModel）のテスト"""
+    
+    def setUp(self):
+        from .services import record_game
+        self.record_game = record_game
+        self.room = Room.objects.create()
+        self.players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+    
+    def _add_games(self, count):
+        for _ in range(count):
+            self.record_game(self.room, [
+                (player, score, 0)
+                for player, score in zip(self.players, [40000, 30000, 20000, 10000])
+            ])
+    
+    def test_games_are_aligned_to_player_order(self):
+        """ゲーム行が新しい順で、記録がプレイヤー順に並ぶことを確認"""
+        from .read_models import RoomReadModel
+        self._add_games(2)
+        games = RoomReadModel.for_room(self.room).game_page().rows
+        self.assertEqual([row.game_number for row in games], [2, 1])
+        self.assertEqual([record.rank for record in games[0].records], [1, 2, 3, 4])
+        self.assertEqual([record.score for record in games[0].records],
+                         [40000, 30000, 20000, 10000])
+    
+    def test_missing_record_is_none(self):
+        """記録がないプレイヤーの列はNoneになることを確認"""
+        from .read_models import RoomReadModel
+        self._add_games(1)
+        ScoreRecord.objects.filter(player=self.players[2]).delete()
+        games = RoomReadModel.for_room(self.room).game_page().rows
+        self.assertIsNone(games[0].records[2])
+        self.assertIsNotNone(games[0].records[3])
+    
+    def test_game_page_keyset(self):
+        """ゲーム履歴がgame_numberのキーセットで新しい順にページ分割されることを確認"""
+        from .read_models import RoomReadModel
+        self._add_games(5)
+        read_model = RoomReadModel.for_room(self.room)
+        page = read_model.game_page(limit=2)
+        self.assertEqual([row.game_number for row in page.rows], [5, 4])
+        self.assertEqual(page.older_than, 4)
+        page = read_model.game_page(before=page.older_than, limit=2)
+        self.assertEqual([row.game_number for row in page.rows], [3, 2])
+        page = read_model.game_page(before=page.older_than, limit=2)
+        self.assertEqual([row.game_number for row in page.rows], [1])
+        self.assertIsNone(page.older_than)
+        self.assertEqual([record.rank for record in page.rows[0].records], [1, 2, 3, 4])
+    
+    def test_partial_renders_first_page_and_older_rows(self):
+        """部分テンプレートは最新のページだけを返し、古いゲームは?beforeで読み込めることを確認"""
+        from .read_models import GAME_PAGE_SIZE
+        self._add_games(GAME_PAGE_SIZE + 3)
+        url = reverse('mahjong:game_list_partial', args=[self.room.code])
+        response = self.client.get(url)
+        self.assertContains(response, f'#{GAME_PAGE_SIZE + 3}<')
+        self.assertNotContains(response, '#3<')
+        self.assertContains(response, '?before=4')
+        
+        response = self.client.get(url, {'before': 4})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '#3<')
+        self.assertContains(response, '#1<')
+        self.assertNotContains(response, '#4<')
+        self.assertNotContains(response, 'load-older-games')
+        self.assertNotContains(response, '<table')
+    
+    def test_partial_rejects_invalid_cursor(self):
+        """?beforeが数値でない場合は400を返すことを確認"""
+        url = reverse('mahjong:game_list_partial', args=[self.room.code])
+        self.assertEqual(self.client.get(url, {'before': 'x'}).status_code, 400)
+    
+    def test_query_count_independent_of_game_count(self):
+        """ダッシュボードと部分テンプレートのクエリ数がゲーム数に依存しないことを確認"""
+        urls = [
+            reverse('mahjong:room_dashboard', args=[self.room.code]),
+            reverse('mahjong:game_list_partial', args=[self.room.code]),
+            reverse('mahjong:player_stats_partial', args=[self.room.code]),
+        ]
+        self._add_games(1)
+        few = {}
+        for url in urls:
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            few[url] = len(queries)
+        
+        self._add_games(30)
+        for url in urls:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(queries), few[url], url)
+
+
+class RoomVersionETagTest(TestCase):
+    """部屋のバージョンとETag（304 Not Modified）のテスト"""
+    
+    def setUp(self):
+        self.room = Room.objects.create()
+        self.players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+    
+    def _version(self):
+        return Room.objects.get(pk=self.room.pk).version
+    
+    def _post_game(self):
+        post_data = {}
+        for player in self.players:
+            post_data[f'score_{player.id}'] = 25000
+            post_data[f'chip_{player.id}'] = 0
+        self.client.post(reverse('mahjong:record_score', args=[self.room.code]), post_data)
+    
+    def test_version_bumped_by_write_paths(self):
+        """スコア記録・ゲーム削除・プレイヤー編集・設定変更・再計算でバージョンが上がることを確認"""
+        self._post_game()
+        self.assertEqual(self._version(), 1)
+        
+        game = Game.objects.get(room=self.room)
+        self.client.post(reverse('mahjong:delete_game', args=[self.room.code, game.id]))
+        self.assertEqual(self._version(), 2)
+        
+        self.client.post(reverse('mahjong:edit_players', args=[self.room.code]), {
+            f'player_{i}': f'新プレイヤー{i}' for i in range(1, 5)
+        })
+        self.assertEqual(self._version(), 3)
+        
+        self.client.post(reverse('mahjong:room_settings', args=[self.room.code]), {
+            'sashi_uma_type': '10-20',
+            'rate_type': 'ten5',
+            'starting_points': 25000,
+            'return_points': 30000,
+            'chip_point_rate': 100,
+        })
+        self.assertEqual(self._version(), 4)
+        
+        self.client.post(reverse('mahjong:rescore_room', args=[self.room.code]))
+        self.assertEqual(self._version(), 5)
+    
+    def test_settings_save_does_not_overwrite_version(self):
+        """設定変更の保存が他のリクエストで加算されたバージョンを上書きしないことを確認"""
+        Room.objects.filter(pk=self.room.pk).update(version=10)
+        self.client.post(reverse('mahjong:room_settings', args=[self.room.code]), {
+            'sashi_uma_type': '5-10',
+            'rate_type': 'ten5',
+            'starting_points': 25000,
+            'return_points': 30000,
+            'chip_point_rate': 100,
+        })
+        self.assertEqual(self._version(), 11)
+    
+    def test_partials_return_304_when_unchanged(self):
+        """バージョンが変わっていなければ304を返し、スコア記録を読まないことを確認"""
+        self._post_game()
+        for name in ['game_list_partial', 'player_stats_partial']:
+            url = reverse(f'mahjong:{name}', args=[self.room.code])
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            self.assertIn('no-cache', response['Cache-Control'])
+            
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertFalse(any('mahjong_scorerecord' in q['sql'] for q in queries))
+            self.assertFalse(any('mahjong_game' in q['sql'] for q in queries))
+    
+    def test_partials_return_200_after_change(self):
+        """書き込み後は古いETagに対して新しい内容を返すことを確認"""
+        url = reverse('mahjong:game_list_partial', args=[self.room.code])
+        etag = self.client.get(url)['ETag']
+        self._post_game()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+    
+    def test_dashboard_embeds_initial_etags(self):
+        """ダッシュボードが初期表示のETagを埋め込むことを確認"""
+        response = self.client.get(reverse('mahjong:room_dashboard', args=[self.room.code]))
+        partial = self.client.get(reverse('mahjong:game_list_partial', args=[self.room.code]))
+        self.assertEqual(response.context['game_list_etag'], partial['ETag'])
+        self.assertContains(response, 'data-etag=')
+
+
+@override_settings(MAHJONG_EVENTS_POLL_SECONDS=0.01, MAHJONG_EVENTS_KEEPALIVE_SECONDS=5)
+class RoomEventsTest(TestCase):
+    """部屋の変更通知（Server-Sent Events）のテスト"""
+    
+    def test_wsgi_request_gets_204(self):
+        """WSGIでは接続を保持せず204を返すことを確認"""
+        room = Room.objects.create()
+        response = self.client.get(reverse('mahjong:room_events', args=[room.code]))
+        self.assertEqual(response.status_code, 204)
+    
+    async def test_unknown_room_returns_404(self):
+        """存在しない部屋は404になることを確認"""
+        response = await self.async_client.get(reverse('mahjong:room_events', args=['XXXXXX']))
+        self.assertEqual(response.status_code, 404)
+    
+    async def test_stream_pushes_room_changed(self):
+        """部屋のバージョンが変わるとroom-changedイベントが送られることを確認"""
+        room = await Room.objects.acreate()
+        response = await self.async_client.get(
+            reverse('mahjong:room_events', args=[room.code]), {'v': 0}
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        try:
+            self.assertIn(b'retry:', await anext(stream))
+            await Room.objects.filter(pk=room.pk).aupdate(version=F('version') + 1)
+            chunk = await asyncio.wait_for(anext(stream), timeout=5)
+            self.assertEqual(chunk, b'id: 1\nevent: room-changed\ndata: 1\n\n')
+        finally:
+            await stream.aclose()
+    
+    async def test_stale_client_is_notified_immediately(self):
+        """接続前に変更があった場合は接続直後に通知されることを確認"""
+        room = await Room.objects.acreate(version=3)
+        response = await self.async_client.get(
+            reverse('mahjong:room_events', args=[room.code]), headers={'Last-Event-ID': '2'}
+        )
+        stream = aiter(response.streaming_content)
+        try:
+            await anext(stream)
+            chunk = await asyncio.wait_for(anext(stream), timeout=5)
+            self.assertIn(b'data: 3', chunk)
+        finally:
+            await stream.aclose()
+
+
+class LastUsedTrackerTest(TestCase):
+    """部屋の最終使用時刻の記録（LastUsedTracker）のテスト"""
+    
+    def setUp(self):
+        from .last_used import LastUsedTracker
+        self.tracker = LastUsedTracker()
+        self.room = Room.objects.create()
+        self.old = timezone.now() - timedelta(hours=1)
+        Room.objects.filter(pk=self.room.pk).update(last_used_at=self.old)
+        self.room.refresh_from_db()
+    
+    def test_recent_value_is_not_written(self):
+        """保存済みの値が粒度より新しければ何も記録しないことを確認"""
+        self.room.last_used_at = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            self.tracker.touch(self.room)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.tracker.pending_count, 0)
+    
+    @override_settings(MAHJONG_LAST_USED_FLUSH_SECONDS=3600)
+    def test_touches_are_buffered_and_flushed_in_one_update(self):
+        """古い値の部屋は溜めておき、1つのUPDATEでまとめて書き込むことを確認"""
+        from unittest import mock
+        other = Room.objects.create()
+        Room.objects.filter(pk=other.pk).update(last_used_at=self.old)
+        other.refresh_from_db()
+        
+        # 同じ分の中の使用（分単位の時刻ごとに1つのUPDATE文）
+        now = timezone.now().replace(second=10)
+        times = [now, now + timedelta(seconds=20), now + timedelta(seconds=40)]
+        with CaptureQueriesContext(connection) as queries, mock.patch('mahjong.last_used.timezone.now', side_effect=times):
+            self.tracker.touch(self.room)
+            self.tracker.touch(other)
+            self.tracker.touch(self.room)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.tracker.pending_count, 2)
+        
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.tracker.flush(), 2)
+        self.assertEqual(len(queries), 1)
+        for room in [self.room, other]:
+            self.assertGreater(Room.objects.get(pk=room.pk).last_used_at, self.old)
+    
+    @override_settings(MAHJONG_LAST_USED_FLUSH_SECONDS=3600)
+    def test_each_room_keeps_its_own_time(self):
+        """まとめて書き込んでも、部屋ごとに自分の使用時刻（分単位）を書き込むことを確認"""
+        from unittest import mock
+        other = Room.objects.create()
+        Room.objects.filter(pk=other.pk).update(last_used_at=self.old)
+        other.refresh_from_db()
+        
+        earlier = timezone.now().replace(second=30, microsecond=500)
+        later = earlier + timedelta(minutes=3)
+        with mock.patch('mahjong.last_used.timezone.now', side_effect=[earlier, later]):
+            self.tracker.touch(self.room)
+            self.tracker.touch(other)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.tracker.flush(), 2)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(Room.objects.get(pk=self.room.pk).last_used_at, earlier.replace(second=0, microsecond=0))
+        self.assertEqual(Room.objects.get(pk=other.pk).last_used_at, later.replace(second=0, microsecond=0))
+    
+    def test_timer_flushes_without_further_requests(self):
+        """その後使用がなくても、書き込み間隔の後にタイマーで書き込むことを確認"""
+        import threading
+        from unittest import mock
+        flushed = threading.Event()
+        with override_settings(MAHJONG_LAST_USED_FLUSH_SECONDS=0.05), \
+                mock.patch.object(self.tracker, 'flush', side_effect=lambda: flushed.set()):
+            self.tracker.touch(self.room)
+            self.assertEqual(self.tracker.pending_count, 1)
+            self.assertTrue(flushed.wait(5))
+    
+    @override_settings(MAHJONG_LAST_USED_FLUSH_SECONDS=0)
+    def test_flush_when_interval_elapsed(self):
+        """書き込み間隔を過ぎていればその場で書き込むことを確認"""
+        self.tracker.touch(self.room)
+        self.assertEqual(self.tracker.pending_count, 0)
+        self.assertGreater(Room.objects.get(pk=self.room.pk).last_used_at, self.old)
+    
+    @override_settings(MAHJONG_LAST_USED_FLUSH_SECONDS=0)
+    async def test_async_touch_flushes_with_async_orm(self):
+        """非同期ビュー用のatouchでも書き込み間隔を過ぎていれば書き込むことを確認"""
+        await self.tracker.atouch(self.room)
+        self.assertEqual(self.tracker.pending_count, 0)
+        room = await Room.objects.aget(pk=self.room.pk)
+        self.assertGreater(room.last_used_at, self.old)
+    
+    def test_flush_does_not_move_timestamp_backwards(self):
+        """他のワーカーが書き込んだより新しい値を戻さないことを確認"""
+        self.tracker.touch(self.room)
+        newer = timezone.now() + timedelta(minutes=5)
+        Room.objects.filter(pk=self.room.pk).update(last_used_at=newer)
+        self.assertEqual(self.tracker.flush(), 0)
+        self.assertEqual(Room.objects.get(pk=self.room.pk).last_used_at, newer)
+    
+    def test_polling_does_not_write_when_recent(self):
+        """最近使われた部屋へのポーリングでは書き込みが発生しないことを確認"""
+        room = Room.objects.create()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('mahjong:player_stats_partial', args=[room.code]))
+        self.assertFalse(any(q['sql'].startswith('UPDATE') for q in queries))
+
+
+class SQLiteProfileTest(TestCase):
+    """SQLiteの接続設定（mahjong/sqlite.py）のテスト"""
+    
+    def _pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+    
+    @override_settings(MAHJONG_SQLITE_PRAGMAS={'cache_size': -1234, 'temp_store': 'MEMORY'})
+    def test_profile_applied_to_connection(self):
+        """設定したPRAGMAが接続に適用されることを確認"""
+        from .sqlite import apply_sqlite_profile
+        apply_sqlite_profile(sender=None, connection=connection)
+        self.assertEqual(self._pragma('cache_size'), -1234)
+        self.assertEqual(self._pragma('temp_store'), 2)  # MEMORY
+    
+    def test_persistent_pragma_applied_once_per_database(self):
+        """journal_mode はデータベースごとに最初の接続でだけ適用し、接続ごとのPRAGMAは毎回適用することを確認"""
+        from types import SimpleNamespace
+        from unittest import mock
+        from .sqlite import apply_sqlite_profile
+        
+        def connect(name):
+            return SimpleNamespace(
+                vendor='sqlite', connection=mock.Mock(),
+                settings_dict={'NAME': name, 'PRAGMAS': {'journal_mode': 'WAL', 'cache_size': -1234}},
+            )
+        
+        executed = []
+        for name in ['first.sqlite3', 'first.sqlite3', 'second.sqlite3']:
+            fake = connect(name)
+            apply_sqlite_profile(sender=None, connection=fake)
+            executed.append([call.args[0] for call in fake.connection.execute.call_args_list])
+        self.assertEqual(executed, [
+            ['PRAGMA journal_mode = WAL', 'PRAGMA cache_size = -1234'],
+            ['PRAGMA cache_size = -1234'],
+            ['PRAGMA journal_mode = WAL', 'PRAGMA cache_size = -1234'],
+        ])
+    
+    def test_database_entry_overrides_profile(self):
+        """DATABASESのPRAGMASキーが設定より優先されることを確認"""
+        from .sqlite import sqlite_pragmas
+        original = connection.settings_dict.get('PRAGMAS')
+        connection.settings_dict['PRAGMAS'] = {}
+        try:
+            self.assertEqual(sqlite_pragmas(connection), {})
+        finally:
+            if original is None:
+                del connection.settings_dict['PRAGMAS']
+            else:
+                connection.settings_dict['PRAGMAS'] = original
+
+
+class RoomCodeAllocatorTest(TestCase):
+    """部屋コードの割り当て（mahjong/room_codes.py）のテスト"""
+    
+    def test_encoding_is_collision_free(self):
+        """連続した連番から重複のない6桁の英数字コードが作られることを確認"""
+        from .room_codes import ROOM_CODE_ALPHABET, encode_room_code
+        codes = [encode_room_code(number, key=b'test') for number in range(20000)]
+        self.assertEqual(len(set(codes)), len(codes))
+        for code in codes[:100]:
+            self.assertEqual(len(code), 6)
+            self.assertTrue(set(code) <= set(ROOM_CODE_ALPHABET))
+        # 連番の順序はコードから読み取れない
+        self.assertNotEqual(codes[:10], sorted(codes[:10]))
+    
+    def test_encoding_depends_on_key(self):
+        """鍵が変わるとコードも変わることを確認"""
+        from .room_codes import encode_room_code
+        self.assertNotEqual(encode_room_code(1, key=b'a'), encode_room_code(1, key=b'b'))
+        self.assertEqual(encode_room_code(1, key=b'a'), encode_room_code(1, key=b'a'))
+    
+    def test_out_of_range_number(self):
+        """コードの範囲外の連番はエラーになることを確認"""
+        from .room_codes import ROOM_CODE_SPACE, encode_room_code
+        with self.assertRaises(ValueError):
+            encode_room_code(ROOM_CODE_SPACE)
+    
+    @override_settings(MAHJONG_ROOM_CODE_BLOCK_SIZE=3)
+    def test_allocator_reserves_blocks(self):
+        """連番をブロック単位で予約し、使い切ったら次のブロックを予約することを確認"""
+        from .models import RoomCodeSequence
+        from .room_codes import RoomCodeAllocator
+        allocator = RoomCodeAllocator()
+        start = RoomCodeSequence.objects.filter(pk=1).values_list('next_value', flat=True).first() or 0
+        with CaptureQueriesContext(connection) as queries:
+            codes = [allocator.allocate() for _ in range(7)]
+        self.assertEqual(len(set(codes)), 7)
+        self.assertEqual(
+            RoomCodeSequence.objects.get(pk=1).next_value, start + 9
+        )
+        # 7個の払い出しで予約は3回だけ
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 3)
+    
+    @override_settings(MAHJONG_ROOM_CODE_BLOCK_SIZE=5)
+    def test_allocator_never_reuses_numbers_after_rollback(self):
+        """予約がロールバックされても、払い出し済みの連番を再び使わないことを確認"""
+        from .models import RoomCodeSequence
+        from .room_codes import RoomCodeAllocator
+        allocator = RoomCodeAllocator()
+        first = {allocator.allocate() for _ in range(5)}
+        # 予約がロールバックされた状態を再現
+        RoomCodeSequence.objects.filter(pk=1).update(next_value=0)
+        second = {allocator.allocate() for _ in range(5)}
+        self.assertFalse(first & second)
+    
+    def test_key_is_required_by_deploy_check(self):
+        """DEBUG=False で MAHJONG_ROOM_CODE_KEY が未設定なら、check --deploy がエラーになることを確認"""
+        from django.core.checks import run_checks
+        from .room_codes import DEVELOPMENT_KEY, encode_room_code
+        
+        def errors():
+            return [message.id for message in run_checks(include_deployment_checks=True) if message.id.startswith('mahjong.')]
+        
+        with override_settings(MAHJONG_ROOM_CODE_KEY='', DEBUG=False):
+            self.assertEqual(errors(), ['mahjong.E001'])
+            # 開発用の固定の鍵で動く
+            self.assertEqual(encode_room_code(1), encode_room_code(1, key=DEVELOPMENT_KEY))
+        with override_settings(MAHJONG_ROOM_CODE_KEY='', DEBUG=True):
+            self.assertEqual(errors(), [])
+        with override_settings(MAHJONG_ROOM_CODE_KEY='key', DEBUG=False):
+            self.assertEqual(errors(), [])
+    
+    def test_create_room_is_single_insert(self):
+        """部屋の作成が存在確認なしのINSERT1回で済むことを確認"""
+        Room.objects.create()  # 連番のブロックを予約しておく
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('mahjong:create_room'))
+        self.assertEqual(response.status_code, 302)
+        room_queries = [q['sql'] for q in queries.captured_queries if 'mahjong_room' in q['sql']]
+        self.assertEqual(len(room_queries), 1)
+        self.assertTrue(room_queries[0].startswith('INSERT'))
+
+
+class GameListDeltaTest(TestCase):
+    """ゲームリストの差分更新（?since=<バージョン>）のテスト"""
+    
+    def setUp(self):
+        from .services import record_game
+        self.record_game = record_game
+        self.room = Room.objects.create()
+        self.players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+        self.url = reverse('mahjong:game_list_partial', args=[self.room.code])
+    
+    def _add_game(self):
+        return self.record_game(self.room, [
+            (player, score, 0)
+            for player, score in zip(self.players, [40000, 30000, 20000, 10000])
+        ])
+    
+    def _version(self):
+        return Room.objects.values_list('version', flat=True).get(pk=self.room.pk)
+    
+    def test_returns_only_new_games(self):
+        """表示中のバージョン以降に追加されたゲームの行だけを返すことを確認"""
+        old_game = self._add_game()
+        since = self._version()
+        new_game = self._add_game()
+        response = self.client.get(self.url, {'since': since})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['HX-Reswap'], 'afterbegin')
+        self.assertEqual(response['HX-Retarget'], '#game-list-rows')
+        self.assertEqual(response['X-Room-Version'], str(self._version()))
+        self.assertContains(response, f'id="game-row-{new_game.id}"')
+        self.assertNotContains(response, f'id="game-row-{old_game.id}"')
+        self.assertNotContains(response, '<table')
+    
+    def test_deleted_games_are_tombstoned(self):
+        """削除されたゲームはout-of-bandの削除として返すことを確認"""
+        from .services import delete_game
+        game = self._add_game()
+        game_id = game.id
+        since = self._version()
+        delete_game(game)
+        response = self.client.get(self.url, {'since': since})
+        self.assertContains(response, f'<tr id="game-row-{game_id}" hx-swap-oob="delete"></tr>')
+    
+    def test_added_then_deleted_game_is_omitted(self):
+        """差分の間に追加・削除されたゲームは返さないことを確認"""
+        from .services import delete_game
+        since = self._version()
+        game = self._add_game()
+        game_id = game.id
+        delete_game(game)
+        response = self.client.get(self.url, {'since': since})
+        self.assertEqual(response['HX-Reswap'], 'afterbegin')
+        self.assertNotContains(response, f'game-row-{game_id}')
+    
+    def test_full_render_when_delta_not_possible(self):
+        """全体の変更や古すぎるバージョンからは最新のページ全体を返すことを確認"""
+        from .models import RoomChange
+        from .services import bump_room_version
+        self._add_game()
+        since = self._version()
+        bump_room_version(self.room.pk)  # 設定変更など
+        response = self.client.get(self.url, {'since': since})
+        self.assertFalse(response.has_header('HX-Reswap'))
+        self.assertContains(response, '<table')
+        
+        # 変更履歴が残っていない
+        since = self._version()
+        self._add_game()
+        RoomChange.objects.filter(room=self.room).delete()
+        response = self.client.get(self.url, {'since': since})
+        self.assertFalse(response.has_header('HX-Reswap'))
+        
+        # 未来のバージョン
+        response = self.client.get(self.url, {'since': self._version() + 5})
+        self.assertFalse(response.has_header('HX-Reswap'))
+    
+    def test_change_log_is_pruned(self):
+        """変更履歴は部屋ごとに直近の分だけが残ることを確認"""
+        from .models import RoomChange
+        from .services import ROOM_CHANGE_RETENTION, bump_room_version
+        for _ in range(ROOM_CHANGE_RETENTION * 2):
+            version = bump_room_version(self.room.pk)
+        self.assertEqual(version, ROOM_CHANGE_RETENTION * 2)
+        self.assertEqual(RoomChange.objects.filter(room=self.room).count(), ROOM_CHANGE_RETENTION)
+
+
+@override_settings(
+    MAHJONG_POLL_MIN_SECONDS=15,
+    MAHJONG_POLL_MAX_SECONDS=600,
+    MAHJONG_POLL_ACTIVE_SECONDS=600,
+    MAHJONG_POLL_STOP_AFTER_SECONDS=12 * 60 * 60,
+)
+class AdaptivePollingTest(TestCase):
+    """部屋の活動状況に応じたポーリング間隔（mahjong/polling.py）のテスト"""
+    
+    def setUp(self):
+        self.room = Room.objects.create()
+        for i in range(1, 5):
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+    
+    def _set_idle(self, seconds):
+        now = timezone.now()
+        Room.objects.filter(pk=self.room.pk).update(changed_at=now - timedelta(seconds=seconds))
+        self.room.refresh_from_db()
+        return now
+    
+    def test_interval_backs_off_exponentially(self):
+        """最近変更された部屋は短く、長く変更のない部屋ほど間隔が倍々に伸びることを確認"""
+        from .polling import poll_interval
+        expected = [
+            (0, 15), (600, 15), (601, 30), (1200, 30), (2400, 60),
+            (4800, 120), (9600, 240), (19200, 480), (38400, 600),
+        ]
+        for idle, interval in expected:
+            now = self._set_idle(idle)
+            self.assertEqual(poll_interval(self.room, now), interval, idle)
+        now = self._set_idle(12 * 60 * 60 + 1)
+        self.assertIsNone(poll_interval(self.room, now))
+    
+    def test_version_bump_marks_room_active(self):
+        """表示内容が変わる書き込みで最終変更時刻が更新されることを確認"""
+        from .polling import poll_interval
+        from .services import bump_room_version
+        self._set_idle(24 * 60 * 60)
+        bump_room_version(self.room.pk)
+        self.room.refresh_from_db()
+        self.assertEqual(poll_interval(self.room), 15)
+    
+    def test_partials_return_interval_header(self):
+        """部分テンプレートが次のポーリングまでの秒数を返すことを確認"""
+        self._set_idle(2000)
+        for name in ['game_list_partial', 'player_stats_partial']:
+            response = self.client.get(reverse(f'mahjong:{name}', args=[self.room.code]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Poll-Interval'], '60')
+    
+    def test_idle_room_stops_polling(self):
+        """長く変更のない部屋では、変更がなければ286でポーリングを止めることを確認"""
+        self._set_idle(24 * 60 * 60)
+        for name in ['game_list_partial', 'player_stats_partial']:
+            url = reverse(f'mahjong:{name}', args=[self.room.code])
+            etag = self.client.get(url)['ETag']
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 286)
+            self.assertEqual(response['HX-Reswap'], 'none')
+        
+        # 表示が古い場合は停止せずに最新の内容を返す
+        response = self.client.get(
+            reverse('mahjong:game_list_partial', args=[self.room.code]),
+            HTTP_IF_NONE_MATCH='"stale"',
+        )
+        self.assertEqual(response.status_code, 200)
+    
+    def test_dashboard_renders_initial_interval(self):
+        """ダッシュボードに最初のポーリング間隔が埋め込まれることを確認"""
+        self._set_idle(0)
+        response = self.client.get(reverse('mahjong:room_dashboard', args=[self.room.code]))
+        self.assertContains(response, 'data-poll-interval="15"', count=2)
+
+
+class RoomCacheTest(TestCase):
+    """部屋単位のキャッシュ（mahjong/cache.py）のテスト"""
+    
+    def setUp(self):
+        from . import cache as room_cache
+        from .services import record_game
+        self.room_cache = room_cache
+        self.record_game = record_game
+        cache.clear()
+        room_cache.stats.reset()
+        self.room = Room.objects.create()
+        self.players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+    
+    def _add_game(self):
+        return self.record_game(self.room, [
+            (player, score, 0)
+            for player, score in zip(self.players, [40000, 30000, 20000, 10000])
+        ])
+    
+    def test_room_is_cached_and_counted(self):
+        """Roomが2回目からクエリなしで取得でき、ヒット・ミスが数えられることを確認"""
+        aget_room = async_to_sync(self.room_cache.aget_room)
+        aget_room(self.room.code)
+        with self.assertNumQueries(0):
+            room = aget_room(self.room.code)
+        self.assertEqual(room.pk, self.room.pk)
+        self.assertEqual(self.room_cache.stats.snapshot()['room'], {'hits': 1, 'misses': 1})
+        with self.assertRaises(Room.DoesNotExist):
+            aget_room('ZZZZZZ')
+    
+    async def test_writes_invalidate_room(self):
+        """書き込みで部屋のキャッシュが削除され、新しいバージョンが読まれることを確認"""
+        before = await self.room_cache.aget_room(self.room.code)
+        await sync_to_async(self._add_game)()
+        after = await self.room_cache.aget_room(self.room.code)
+        self.assertEqual(after.version, before.version + 1)
+    
+    def test_partials_share_rendered_fragments(self):
+        """ダッシュボードで描画した部分テンプレートを、同じバージョンの間は再利用することを確認"""
+        self._add_game()
+        self.client.get(reverse('mahjong:room_dashboard', args=[self.room.code]))
+        for name in ['game_list_partial', 'player_stats_partial']:
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse(f'mahjong:{name}', args=[self.room.code]))
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'プレイヤー1')
+        
+        # 新しいゲームを記録すると描画し直す
+        self._add_game()
+        response = self.client.get(reverse('mahjong:game_list_partial', args=[self.room.code]))
+        self.assertContains(response, '#2<')
+    
+    def test_player_edit_invalidates_players(self):
+        """プレイヤー編集の後は新しい名前で描画されることを確認"""
+        self.client.get(reverse('mahjong:room_dashboard', args=[self.room.code]))
+        self.client.post(reverse('mahjong:edit_players', args=[self.room.code]), {
+            f'player_{i}': f'新プレイヤー{i}' for i in range(1, 5)
+        })
+        response = self.client.get(reverse('mahjong:player_stats_partial', args=[self.room.code]))
+        self.assertContains(response, '新プレイヤー1')
+    
+    def test_deleted_room_is_not_served_from_cache(self):
+        """部屋を削除するとキャッシュからも消えることを確認"""
+        url = reverse('mahjong:player_stats_partial', args=[self.room.code])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.post(reverse('mahjong:delete_room', args=[self.room.code]))
+        self.assertEqual(self.client.get(url).status_code, 404)
+    
+    def test_cache_stats_endpoint(self):
+        """ヒット・ミスの回数をJSONで返すことを確認"""
+        url = reverse('mahjong:player_stats_partial', args=[self.room.code])
+        self.client.get(url)
+        self.client.get(url)
+        stats_url = reverse('mahjong:cache_stats')
+        with override_settings(MAHJONG_METRICS_TOKEN='secret'):
+            stats = self.client.get(stats_url, HTTP_AUTHORIZATION='Bearer secret').json()
+            self.assertEqual(self.client.get(stats_url).status_code, 401)
+        self.assertEqual(stats['room'], {'hits': 1, 'misses': 1})
+        self.assertEqual(stats['partial:player-stats'], {'hits': 1, 'misses': 1})
+        # トークンが未設定なら公開しない
+        self.assertEqual(self.client.get(stats_url).status_code, 404)
+
+
+class AsyncReadViewTest(TestCase):
+    """読み取り専用のビューがASGI（AsyncClient）で動くことのテスト"""
+    
+    def setUp(self):
+        from .services import record_game
+        cache.clear()
+        self.room = Room.objects.create()
+        players = [Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i) for i in range(1, 5)]
+        record_game(self.room, [(p, s, 0) for p, s in zip(players, [40000, 30000, 20000, 10000])])
+    
+    async def test_read_views_under_asgi(self):
+        """ダッシュボードと部分テンプレートを非同期のORMで返すことを確認"""
+        from . import views
+        for name in ['room_dashboard', 'game_list_partial', 'player_stats_partial']:
+            self.assertTrue(asyncio.iscoroutinefunction(getattr(views, name)), name)
+            response = await self.async_client.get(reverse(f'mahjong:{name}', args=[self.room.code]))
+            self.assertEqual(response.status_code, 200, name)
+            self.assertIn('プレイヤー1', response.content.decode())
+    
+    async def test_missing_room_under_asgi(self):
+        """存在しない部屋の部分テンプレートは404を返すことを確認"""
+        response = await self.async_client.get(reverse('mahjong:game_list_partial', args=['ZZZZZZ']))
+        self.assertEqual(response.status_code, 404)
+
+
+class GameRowFragmentCacheTest(TestCase):
+    """ゲームの行ごとの描画キャッシュのテスト"""
+    
+    def setUp(self):
+        from . import cache as room_cache
+        from .services import record_game
+        self.room_cache = room_cache
+        self.record_game = record_game
+        cache.clear()
+        room_cache.stats.reset()
+        self.room = Room.objects.create()
+        self.players = [
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+            for i in range(1, 5)
+        ]
+        self.url = reverse('mahjong:game_list_partial', args=[self.room.code])
+    
+    def _add_games(self, count, scores=(40000, 30000, 20000, 10000)):
+        for _ in range(count):
+            self.record_game(self.room, [
+                (player, score, 0) for player, score in zip(self.players, scores)
+            ])
+    
+    def _row_counts(self):
+        return self.room_cache.stats.snapshot().get('game-row', {'hits': 0, 'misses': 0})
+    
+    def test_new_game_renders_only_its_row(self):
+        """新しいゲームを記録しても、既存の行は描画し直さずキャッシュを使うことを確認"""
+        self._add_games(5)
+        self.client.get(self.url)
+        self.assertEqual(self._row_counts(), {'hits': 0, 'misses': 5})
+        
+        self._add_games(1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(self._row_counts(), {'hits': 5, 'misses': 6})
+        self.assertContains(response, 'id="game-row-', count=6)
+        # スコア記録は新しいゲームの分だけ読む
+        record_queries = [q['sql'] for q in queries.captured_queries if 'mahjong_scorerecord' in q['sql']]
+        self.assertEqual(len(record_queries), 1)
+        self.assertIn('IN (%d)' % Game.objects.get(room=self.room, game_number=6).id, record_queries[0])
+    
+    def test_player_edit_rerenders_rows(self):
+        """プレイヤー編集の後は行を描画し直すことを確認"""
+        self._add_games(2)
+        self.client.get(self.url)
+        self.client.post(reverse('mahjong:edit_players', args=[self.room.code]), {
+            f'player_{i}': f'新プレイヤー{i}' for i in range(1, 5)
+        })
+        self.room_cache.stats.reset()
+        self.client.get(self.url)
+        self.assertEqual(self._row_counts(), {'hits': 0, 'misses': 2})
+    
+    def test_rescore_rerenders_rows(self):
+        """再計算の後は新しいポイントで行を描画し直すことを確認"""
+        self._add_games(1)
+        self.client.get(self.url)
+        Room.objects.filter(pk=self.room.pk).update(return_points=25000)
+        self.client.post(reverse('mahjong:rescore_room', args=[self.room.code]))
+        response = self.client.get(self.url)
+        # 返し点25000ではオカなし: 1位 15 + 10 = 25.0pt
+        self.assertContains(response, '25.0pt')
+    
+    def test_delta_uses_row_cache(self):
+        """差分の行も同じキャッシュを使うことを確認"""
+        self._add_games(1)
+        since = Room.objects.get(pk=self.room.pk).version
+        self._add_games(1)
+        self.client.get(self.url, {'since': since})
+        self.assertEqual(self._row_counts(), {'hits': 0, 'misses': 1})
+        self.client.get(self.url)
+        self.assertEqual(self._row_counts(), {'hits': 1, 'misses': 2})
+
+
+class SingleFlightTest(TestCase):
+    """同じ計算の同時実行をまとめる処理（mahjong/singleflight.py）のテスト"""
+    
+    def setUp(self):
+        cache.clear()
+    
+    async def test_concurrent_calls_share_one_computation(self):
+        """ワーカー内で同時の呼び出しが1回の計算を共有することを確認"""
+        from .singleflight import SingleFlight
+        flight = SingleFlight()
+        calls = []
+        
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'html'
+        
+        results = await asyncio.gather(*[flight.do('room:v1', compute) for _ in range(4)])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('html', False)] + [('html', True)] * 3)
+        self.assertEqual(flight.in_flight, 0)
+    
+    async def test_errors_are_shared_and_not_cached(self):
+        """計算の失敗は待っている呼び出しにも伝わり、次の呼び出しは計算し直すことを確認"""
+        from .singleflight import SingleFlight
+        flight = SingleFlight()
+        
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('boom')
+        
+        async def one():
+            return 1
+        
+        results = await asyncio.gather(flight.do('key', fail), flight.do('key', fail), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(await flight.do('key', one), (1, False))
+    
+    async def test_cancelled_leader_does_not_cancel_waiters(self):
+        """計算していたリクエストが切断されても、待っている呼び出しは自分で計算することを確認"""
+        from .singleflight import SingleFlight
+        flight = SingleFlight()
+        
+        async def compute():
+            await asyncio.sleep(0.05)
+            return 'html'
+        
+        leader = asyncio.ensure_future(flight.do('key', compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flight.do('key', compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        self.assertEqual(await waiter, ('html', False))
+    
+    @override_settings(MAHJONG_SINGLE_FLIGHT_LOCK_SECONDS=2, MAHJONG_SINGLE_FLIGHT_POLL_SECONDS=0.01)
+    async def test_waits_for_other_worker(self):
+        """他のワーカーがロックを持っていれば、計算せずにその結果を待つことを確認"""
+        from .singleflight import acompute_once
+        await cache.aadd('partial:lock', 1, 2)
+        
+        async def other_worker():
+            await asyncio.sleep(0.05)
+            await cache.aset('partial', 'from-other-worker')
+        
+        async def compute():
+            self.fail('computed')
+        
+        _, (value, shared) = await asyncio.gather(
+            other_worker(), acompute_once(cache, 'partial', compute, 60)
+        )
+        self.assertEqual((value, shared), ('from-other-worker', True))
+    
+    @override_settings(MAHJONG_SINGLE_FLIGHT_LOCK_SECONDS=0.05, MAHJONG_SINGLE_FLIGHT_POLL_SECONDS=0.01)
+    async def test_computes_when_lock_holder_stalls(self):
+        """ロックを持つワーカーが結果を書かなければ、期限後に自分で計算することを確認"""
+        from .singleflight import acompute_once
+        await cache.aadd('partial:lock', 1, 60)
+        
+        async def compute():
+            return 'mine'
+        
+        value, shared = await acompute_once(cache, 'partial', compute, 60)
+        self.assertEqual((value, shared), ('mine', False))
+        self.assertEqual(cache.get('partial'), 'mine')
+        # ロックは計算中の他のワーカーのものなので残す
+        self.assertEqual(cache.get('partial:lock'), 1)
+    
+    async def test_releases_own_lock(self):
+        """ロックを取って計算したワーカーは、計算が失敗してもロックを消すことを確認"""
+        from .singleflight import acompute_once
+        
+        async def compute():
+            raise ValueError('failed')
+        
+        with self.assertRaises(ValueError):
+            await acompute_once(cache, 'partial', compute, 60)
+        self.assertIsNone(cache.get('partial:lock'))
+    
+    async def test_file_cache_skips_cross_worker_lock(self):
+        """add() がアトミックでない FileBasedCache ではロックを取らずに計算することを確認"""
+        import tempfile
+        from django.core.cache.backends.filebased import FileBasedCache
+        from .singleflight import acompute_once, has_atomic_add
+        
+        with tempfile.TemporaryDirectory() as location:
+            file_cache = FileBasedCache(location, {})
+            self.assertFalse(has_atomic_add(file_cache))
+            self.assertTrue(has_atomic_add(cache))
+            # 他のワーカーのロックがあっても待たない
+            await file_cache.aadd('partial:lock', 1, 60)
+            
+            async def compute():
+                return 'mine'
+            
+            self.assertEqual(await acompute_once(file_cache, 'partial', compute, 60), ('mine', False))
+            self.assertEqual(await file_cache.aget('partial'), 'mine')
+
+
+class LeanPathMiddlewareTest(TestCase):
+    """ポーリング用の軽量な経路（mahjong/middleware.py）のテスト"""
+    
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create()
+        for i in range(1, 5):
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+        self.url = reverse('mahjong:player_stats_partial', args=[self.room.code])
+    
+    def test_partial_skips_session_and_messages(self):
+        """部分テンプレートではセッション・メッセージのミドルウェアを通らないことを確認"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertFalse(hasattr(response.wsgi_request, '_messages'))
+        self.assertNotIn('X-Frame-Options', response)
+        # MAHJONG_LEAN_MIDDLEWARE のミドルウェアは通る
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+    
+    def test_other_views_use_full_stack(self):
+        """軽量な経路の対象外のビューは、すべてのミドルウェアを通ることを確認"""
+        response = self.client.get(reverse('mahjong:room_dashboard', args=[self.room.code]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+    
+    def test_lean_resolver_only_matches_lean_views(self):
+        """軽量な経路のリゾルバーが @lean_view のビューだけを、名前空間付きのURL名で解決することを確認"""
+        from django.urls import Resolver404, get_resolver
+        from .middleware import _lean_resolver
+        resolver = _lean_resolver(get_resolver())
+        match = resolver.resolve(self.url)
+        self.assertEqual(match.view_name, 'mahjong:player_stats_partial')
+        self.assertEqual(match.kwargs, {'room_code': self.room.code})
+        for url in [reverse('mahjong:room_dashboard', args=[self.room.code]), reverse('mahjong:index'), '/admin/']:
+            with self.assertRaises(Resolver404):
+                resolver.resolve(url)
+    
+    def test_errors_are_converted_to_responses(self):
+        """ビューの404・405が通常どおり応答になることを確認"""
+        response = self.client.get(reverse('mahjong:player_stats_partial', args=['ZZZZZZ']))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+    
+    async def test_partial_under_asgi(self):
+        """ASGIでも軽量な経路で非同期ビューを呼び出すことを確認"""
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(response.asgi_request, 'session'))
+        self.assertContains(response, 'プレイヤー1')
+
+
+class BenchHelpersTest(TestCase):
+    """ベンチマーク用の共通処理（mahjong/bench.py）のテスト"""
+    
+    def test_seed_room_matches_recorded_games(self):
+        """一括挿入した部屋が、record_gameで記録した場合と同じ状態になることを確認"""
+        from .bench import seed_room
+        room, players = seed_room(7, batch_size=3)
+        self.assertEqual(room.version, 7)
+        game_numbers = Game.objects.filter(room=room).order_by('game_number').values_list('game_number', flat=True)
+        self.assertEqual(list(game_numbers), list(range(1, 8)))
+        for game in Game.objects.filter(room=room):
+            records = list(game.score_records.all())
+            self.assertEqual(sum(record.score for record in records), room.starting_points * 4)
+            self.assertEqual(sorted(record.rank for record in records), [1, 2, 3, 4])
+        for player in players:
+            total = sum(ScoreRecord.objects.filter(player=player).values_list('points', flat=True))
+            self.assertAlmostEqual(player.total_points, total)
+    
+    def test_compare_to_baseline(self):
+        """基準値より閾値を超えて遅くなったケースだけを回帰とすることを確認"""
+        from .bench import compare_to_baseline
+        baseline = {'score_games': {'10': 1.0, '1000': 10.0}, 'player_stats': {'10': 0.005}}
+        results = {
+            'score_games': {'10': 1.2, '1000': 13.0},
+            'player_stats': {'10': 0.01},
+            'new_case': {'10': 5.0},
+        }
+        comparisons = {(c.name, c.size): c for c in compare_to_baseline(results, baseline)}
+        self.assertEqual(set(comparisons), {('score_games', '10'), ('score_games', '1000'), ('player_stats', '10')})
+        self.assertFalse(comparisons['score_games', '10'].regressed(0.25))
+        self.assertTrue(comparisons['score_games', '1000'].regressed(0.25))
+        # 2倍でも差が小さければ揺らぎとみなす
+        self.assertTrue(comparisons['player_stats', '10'].regressed(0.25))
+        self.assertFalse(comparisons['player_stats', '10'].regressed(0.25, min_delta_ms=0.05))
+
+
+class ServerTimingTest(TestCase):
+    """Server-Timingヘッダー（mahjong/timing.py）のテスト"""
+    
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create()
+        for i in range(1, 5):
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+    
+    def _timings(self, response):
+        timings = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            timings[name] = dict(param.split('=', 1) for param in params)
+        return timings
+    
+    def test_header_counts_queries_and_templates(self):
+        """クエリ数・SQL・テンプレートの所要時間がヘッダーに入ることを確認"""
+        url = reverse('mahjong:room_dashboard', args=[self.room.code])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        timings = self._timings(response)
+        self.assertEqual(set(timings), {'mw', 'db', 'tpl', 'app', 'total'})
+        self.assertEqual(timings['db']['desc'], f'"{len(queries)} queries"')
+        self.assertGreater(float(timings['tpl']['dur']), 0)
+        self.assertGreaterEqual(float(timings['total']['dur']), float(timings['db']['dur']))
+    
+    async def test_async_view_queries_are_counted(self):
+        """非同期ビュー（sync_to_asyncのスレッド）で実行したクエリも数えることを確認"""
+        response = await self.async_client.get(reverse('mahjong:player_stats_partial', args=[self.room.code]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(self._timings(response)['db']['desc'], '"0 queries"')
+    
+    def test_no_queries_outside_requests(self):
+        """リクエストの外（管理コマンドなど）では計測しないことを確認"""
+        from . import timing
+        self.assertIsNone(timing.current())
+        Room.objects.count()
+        self.assertIsNone(timing.current())
+    
+    @override_settings(MAHJONG_SLOW_REQUEST_MS=0.001)
+    def test_slow_requests_are_logged(self):
+        """閾値を超えたリクエストを1行のJSONでログに記録することを確認"""
+        import json
+        with self.assertLogs('mahjong.timing', 'WARNING') as logs:
+            self.client.get(reverse('mahjong:player_stats_partial', args=[self.room.code]))
+        record = json.loads(logs.records[0].getMessage().split(' ', 2)[2])
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['path'], reverse('mahjong:player_stats_partial', args=[self.room.code]))
+        self.assertIn('db_ms', record)
+    
+    @override_settings(MAHJONG_SERVER_TIMING=False)
+    def test_can_be_disabled(self):
+        """MAHJONG_SERVER_TIMING=False ではヘッダーを付けないことを確認"""
+        response = self.client.get(reverse('mahjong:index'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class MetricsTest(TestCase):
+    """/metrics（mahjong/metrics.py）のテスト"""
+    
+    def setUp(self):
+        import tempfile
+        from . import cache as room_cache, metrics
+        self.metrics = metrics
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(
+            MAHJONG_METRICS_DIR=directory, MAHJONG_METRICS_TOKEN='secret', MAHJONG_METRICS_FLUSH_SECONDS=3600,
+        ))
+        metrics.registry.reset()
+        room_cache.stats.reset()
+        cache.clear()
+        self.room = Room.objects.create()
+        for i in range(1, 5):
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+    
+    def scrape(self):
+        response = self.client.get(reverse('mahjong:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+    
+    def test_requires_token(self):
+        """トークンがなければ401、トークンが未設定なら404を返すことを確認"""
+        url = reverse('mahjong:metrics')
+        self.assertEqual(url, '/metrics')
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        with override_settings(MAHJONG_METRICS_TOKEN=''):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+    
+    def test_requests_by_view_name(self):
+        """URL名ごとのレイテンシのヒストグラム・ステータスコード・クエリ数を確認"""
+        self.client.get(reverse('mahjong:room_dashboard', args=[self.room.code]))
+        self.client.get(reverse('mahjong:room_dashboard', args=['NOROOM']))
+        # 軽量な経路のビューも記録する
+        self.client.get(reverse('mahjong:player_stats_partial', args=[self.room.code]))
+        samples = self.scrape()
+        dashboard = 'view="mahjong:room_dashboard"'
+        self.assertEqual(samples[f'mahjong_http_request_duration_seconds_count{{method="GET",{dashboard}}}'], 2)
+        self.assertEqual(
+            samples[f'mahjong_http_request_duration_seconds_bucket{{method="GET",{dashboard},le="+Inf"}}'], 2
+        )
+        self.assertEqual(samples[f'mahjong_http_responses_total{{status="200",{dashboard}}}'], 1)
+        self.assertEqual(samples[f'mahjong_http_responses_total{{status="302",{dashboard}}}'], 1)
+        self.assertGreater(samples[f'mahjong_db_queries_total{{{dashboard}}}'], 0)
+        self.assertEqual(
+            samples['mahjong_http_responses_total{status="200",view="mahjong:player_stats_partial"}'], 1
+        )
+    
+    def test_aggregates_worker_files(self):
+        """他のワーカー（プロセス）が書き出した値と合計することを確認"""
+        self.client.get(reverse('mahjong:index'))
+        other = self.metrics.MetricsRegistry()
+        other.observe_request('mahjong:index', 'GET', 200, 0.02, 0)
+        other.inc('mahjong_sqlite_locked_total')
+        other.flush()
+        samples = self.scrape()
+        self.assertEqual(samples['mahjong_http_responses_total{status="200",view="mahjong:index"}'], 2)
+        self.assertEqual(samples['mahjong_sqlite_locked_total'], 1)
+        self.assertEqual(
+            samples['mahjong_http_request_duration_seconds_bucket{method="GET",view="mahjong:index",le="0.025"}'], 2
+        )
+    
+    def test_locked_errors_are_counted(self):
+        """SQLiteのロック待ちで失敗したクエリを数えることを確認"""
+        from django.db import OperationalError
+        
+        def locked(sql, params, many, context):
+            raise OperationalError('database is locked')
+        
+        with self.assertRaises(OperationalError):
+            self.metrics.execute_wrapper(locked, 'UPDATE x', (), False, {})
+        self.assertEqual(self.scrape()['mahjong_sqlite_locked_total'], 1)
+    
+    def test_cache_hit_ratio_and_active_rooms(self):
+        """キャッシュのヒット率と使用中の部屋の数を確認"""
+        url = reverse('mahjong:player_stats_partial', args=[self.room.code])
+        self.client.get(url)
+        self.client.get(url)
+        samples = self.scrape()
+        self.assertEqual(samples['mahjong_active_rooms'], 1)
+        self.assertEqual(samples['mahjong_cache_requests_total{kind="room",result="hit"}'], 1)
+        self.assertEqual(samples['mahjong_cache_requests_total{kind="room",result="miss"}'], 1)
+        self.assertEqual(samples['mahjong_cache_hit_ratio{kind="room"}'], 0.5)
+
+
+class ProfilingTest(TestCase):
+    """リクエストのプロファイル（mahjong/profiling.py）のテスト"""
+    
+    def setUp(self):
+        import tempfile
+        from pathlib import Path
+        self.directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(override_settings(MAHJONG_PROFILE_DIR=str(self.directory), MAHJONG_PROFILE_TOKEN='secret'))
+        cache.clear()
+        self.room = Room.objects.create()
+        for i in range(1, 5):
+            Player.objects.create(room=self.room, name=f'プレイヤー{i}', order=i)
+        self.url = reverse('mahjong:player_stats_partial', args=[self.room.code])
+    
+    def test_token_header_profiles_request(self):
+        """トークンのヘッダーを付けたリクエストだけ計測し、.prof と .json を書き出すことを確認"""
+        import json
+        response = self.client.get(self.url)
+        self.assertNotIn('X-Mahjong-Profile-Id', response)
+        self.assertEqual(self.client.get(self.url, HTTP_X_MAHJONG_PROFILE='wrong').get('X-Mahjong-Profile-Id'), None)
+        
+        response = self.client.get(self.url, HTTP_X_MAHJONG_PROFILE='secret')
+        profile_id = response['X-Mahjong-Profile-Id']
+        self.assertTrue((self.directory / f'{profile_id}.prof').exists())
+        record = json.loads((self.directory / f'{profile_id}.json').read_text())
+        self.assertEqual(record['view'], 'mahjong:player_stats_partial')
+        self.assertEqual(record['reason'], 'token')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['peak_memory_bytes'], 0)
+    
+    def test_query_param_and_async_view(self):
+        """?_profile= でも計測し、非同期ビューがsync_to_asyncで実行したクエリも計測することを確認"""
+        import pstats
+        response = async_to_sync(self.async_client.get)(self.url, {'_profile': 'secret'})
+        stats = pstats.Stats(str(self.directory / f'{response["X-Mahjong-Profile-Id"]}.prof'))
+        functions = {name for _, _, name in stats.stats}
+        # プレイヤー一覧の取得（sync_to_asyncのスレッドで実行）
+        self.assertIn('execute_sql', functions)
+    
+    @override_settings(MAHJONG_PROFILE_TOKEN='', MAHJONG_PROFILE_SAMPLE_RATE=1.0, MAHJONG_PROFILE_KEEP=2)
+    def test_sampling_and_rotation(self):
+        """サンプリングで計測し、同じ秒の計測でも新しいものから MAHJONG_PROFILE_KEEP 件だけ残すことを確認"""
+        import uuid
+        from unittest import mock
+        from mahjong import profiling
+        # 同じ秒の3件で、乱数の部分は新しいものほど小さくする（名前の順が乱数で決まると古いものが残る）
+        second = 1_800_000_000 * 10**9
+        with mock.patch.object(profiling.time, 'time_ns', side_effect=[second + 1, second + 2, second + 3]), \
+                mock.patch.object(profiling.uuid, 'uuid4', side_effect=[uuid.UUID(int=n << 104) for n in (0xff, 0x80, 0x01)]):
+            expected = [profiling.profile_id() for _ in range(3)]
+        self.assertEqual(expected, sorted(expected))
+        
+        with mock.patch.object(profiling, 'profile_id', side_effect=expected):
+            ids = [self.client.get(self.url)['X-Mahjong-Profile-Id'] for _ in range(3)]
+        self.assertEqual(ids, expected)
+        self.assertEqual(sorted(path.stem for path in self.directory.glob('*.json')), sorted(ids[1:]))
+        self.assertEqual(len(list(self.directory.glob('*.prof'))), 2)
+    
+    @override_settings(MAHJONG_PROFILE_TOKEN='')
+    def test_disabled_without_token_or_sampling(self):
+        """トークンもサンプリングも設定されていなければ計測しないことを確認"""
+        response = self.client.get(self.url, HTTP_X_MAHJONG_PROFILE='')
+        self.assertNotIn('X-Mahjong-Profile-Id', response)
+        self.assertEqual(list(self.directory.iterdir()), [])
+    
+    def test_summary_command(self):
+        """profile_summary がビューごとに集計することを確認"""
+        from io import StringIO
+        from django.core.management import call_command
+        for _ in range(2):
+            self.client.get(self.url, HTTP_X_MAHJONG_PROFILE='secret')
+        self.client.get(reverse('mahjong:index'), HTTP_X_MAHJONG_PROFILE='secret')
+        out = StringIO()
+        call_command('profile_summary', '--view', 'player_stats', '--limit', '5', stdout=out)
+        output = out.getvalue()
+        self.assertIn('mahjong:player_stats_partial  2件', output)
+        self.assertNotIn('mahjong:index', output)
@@ -0,0 +1,115 @@
+"""
+リクエストごとのSQL・テンプレートの所要時間の計測（Server-Timing）
+
+ServerTimingMiddleware（mahjong/middleware.py）がリクエストの開始時に RequestTimings を
+作り、コンテキスト変数に入れる。計測中のリクエストがあれば
+
+- SQL: すべての接続に入れた execute_wrapper で、クエリ数と所要時間を足し込む
+  （接続の作成時に入れるため、非同期ビューの sync_to_async のスレッドの接続も対象）
+- テンプレート: render_to_string・render・get_template().render の描画時間を足し込む
+  （include は外側の描画に含まれるため二重には数えない）
+
+計測中のリクエストがない場合（管理コマンドなど）はコンテキスト変数を1回読むだけで、
+本番で常に有効にしておけるコストに抑えている。
+"""
+import contextvars
+import time
+
+_current = contextvars.ContextVar('mahjong_request_timings', default=None)
+
+
+class RequestTimings:
+    """1リクエストの計測値（秒）"""
+
+    __slots__ = ('started', 'view_started', 'queries', 'db', 'templates', 'template_depth')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.queries = 0
+        self.db = 0.0
+        self.templates = 0.0
+        self.template_depth = 0
+
+    def mark_view_started(self):
+        """ビューの呼び出しの直前（ここまでがリクエスト側のミドルウェアの時間）"""
+        if self.view_started is None:
+            self.view_started = time.perf_counter()
+
+    def summary(self):
+        """
+        各区間の所要時間（ミリ秒）
+
+        テンプレートの描画中に実行したクエリは db と tpl の両方に含まれる。
+        """
+        total = time.perf_counter() - self.started
+        middleware = (self.view_started - self.started) if self.view_started is not None else 0.0
+        return {
+            'total_ms': total * 1000,
+            'db_ms': self.db * 1000,
+            'queries': self.queries,
+            'tpl_ms': self.templates * 1000,
+            'mw_ms': middleware * 1000,
+            # ビューのPythonの処理とレスポンス側のミドルウェア
+            'app_ms': max(0.0, total - middleware - self.db - self.templates) * 1000,
+        }
+
+
+def start():
+    """リクエストの計測を始め、(計測値, 終了用のトークン) を返す"""
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def finish(token):
+    _current.reset(token)
+
+
+def current():
+    """計測中のリクエストの計測値（なければNone）"""
+    return _current.get()
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    """connection.execute_wrappers に入れる、クエリ数と所要時間の計測"""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.db += time.perf_counter() - started
+        timings.queries += 1
+
+
+def install_execute_wrapper(sender, connection, **kwargs):
+    """新しい接続に execute_wrapper を入れる（connection_createdのレシーバー）"""
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+def instrument_templates():
+    """Djangoテンプレートの描画時間を計測するようにする（AppConfig.readyで1回だけ呼ぶ）"""
+    from django.template.backends.django import Template
+
+    render = Template.render
+    if getattr(render, 'mahjong_timed', False):
+        return
+
+    def timed_render(self, context=None, request=None):
+        timings = _current.get()
+        if timings is None:
+            return render(self, context, request)
+        # 描画中に別のテンプレートを描画する場合（部分テンプレートの埋め込み）は外側だけ数える
+        timings.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            timings.template_depth -= 1
+            if timings.template_depth == 0:
+                timings.templates += time.perf_counter() - started
+
+    timed_render.mahjong_timed = True
+    Template.render = timed_render
@@ -1,23 +1,159 @@
+import hmac
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, Http404
+from django.template.loader import get_template, render_to_string
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
-from django.db import transaction, IntegrityError, connection
+from django.db import transaction, IntegrityError
 from django.contrib import messages
-from django.utils import timezone
-from .models import Room, Player, Game, ScoreRecord, generate_room_code
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from .models import Room, Player, Game
+from . import cache as room_cache
+from . import metrics as app_metrics
+from .events import fetch_room_version, room_event_stream
+from .last_used import tracker as last_used_tracker
+from .middleware import lean_view
+from .polling import STOP_POLLING_STATUS, poll_interval
+from .read_models import RoomReadModel
+from .services import (
+    bump_room_version,
+    delete_game as delete_game_and_totals,
+    record_game,
+    rescore_room as rescore_room_records,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# 部屋設定画面で変更するフィールド
+ROOM_SETTINGS_FIELDS = [
+    'sashi_uma_type', 'sashi_uma_1_2', 'sashi_uma_3_4', 'rate_type',
+    'starting_points', 'return_points', 'chip_point_rate', 'last_used_at',
+]
+
+
+def room_etag(room, partial):
+    """部分テンプレートのETag（部屋のバージョンが変わるまで同じ値）"""
+    return f'"{partial}-{room.code}-{room.version}"'
+
+
+def not_modified(request, etag):
+    """If-None-Matchが現在のETagと一致すれば304レスポンスを返す"""
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in etags or '*' in etags:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    return None
+
+
+def unchanged_response(request, room, etag):
+    """
+    部屋が変わっていなければ304を返す（Noneなら変更あり）
+
+    長く変更のない部屋では、代わりにポーリングを止める286を返す。
+    """
+    response = not_modified(request, etag)
+    if response is not None and poll_interval(room) is None:
+        response = HttpResponse(status=STOP_POLLING_STATUS)
+        response['HX-Reswap'] = 'none'
+    return response
+
+
+def with_poll_interval(response, room):
+    """次のポーリングまでの秒数をヘッダーで返す"""
+    interval = poll_interval(room)
+    if interval is not None:
+        response['X-Poll-Interval'] = interval
+    return response
+
+
+def with_etag(response, etag):
+    """ETagを付け、ブラウザに毎回再検証させる"""
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 def update_room_last_used(room):
-    """部屋の最終使用時刻を更新"""
+    """部屋の最終使用時刻を更新（毎回は書き込まず、ワーカー内でまとめて書き込む）"""
     try:
-        if hasattr(room, 'last_used_at'):
-            room.last_used_at = timezone.now()
-            room.save(update_fields=['last_used_at'])
+        last_used_tracker.touch(room)
     except Exception:
         # マイグレーションが実行されていない場合など、エラーを無視
         pass
 
 
+async def aupdate_room_last_used(room):
+    """update_room_last_usedの非同期版"""
+    try:
+        await last_used_tracker.atouch(room)
+    except Exception:
+        pass
+
+
+async def aget_cached_room_or_404(room_code):
+    """キャッシュから部屋を取得（読み取り専用のビュー用）"""
+    try:
+        return await room_cache.aget_room(room_code)
+    except Room.DoesNotExist:
+        raise Http404('Room not found')
+
+
+async def acached_read_model(room):
+    """キャッシュしたプレイヤー一覧で読み取りモデルを作成"""
+    return RoomReadModel(room, await room_cache.aget_players(room))
+
+
+async def arender_game_rows(read_model, rows):
+    """
+    ゲームの行のHTML
+
+    行はゲームごとにキャッシュし、キャッシュにない行だけスコア記録を読んで描画する。
+    """
+    room = read_model.room
+    rows_by_key = {room_cache.game_row_key(room, row.id): row for row in rows}
+    
+    async def render_missing(keys):
+        await read_model.aload_records([rows_by_key[key] for key in keys])
+        template = get_template('mahjong/partials/game_row.html')
+        return {key: template.render({'room': room, 'game_data': rows_by_key[key]}) for key in keys}
+    
+    return await room_cache.aget_fragments(list(rows_by_key), render_missing)
+
+
+async def agame_rows_context(read_model, rows, older_than=None):
+    """partials/game_rows.html 用のコンテキスト"""
+    context = read_model.context(player_stats=False)
+    context['games_data'] = rows
+    context['older_games_before'] = older_than
+    context['game_rows_html'] = await arender_game_rows(read_model, rows)
+    return context
+
+
+async def arender_game_list(read_model):
+    """ゲームリスト（最新のページ）のHTML（部屋のバージョンごとにキャッシュ）"""
+    async def render_page():
+        page = await read_model.agame_page(with_records=False)
+        context = await agame_rows_context(read_model, page.rows, page.older_than)
+        return render_to_string('mahjong/partials/game_list.html', context)
+    
+    return await room_cache.aget_rendered(read_model.room, 'game-list', render_page)
+
+
+async def arender_player_stats(read_model):
+    """累計成績のHTML（部屋のバージョンごとにキャッシュ）"""
+    async def render_stats():
+        return render_to_string('mahjong/partials/player_stats.html', read_model.context())
+    
+    return await room_cache.aget_rendered(read_model.room, 'player-stats', render_stats)
+
+
 def index(request):
     """トップ画面"""
     return render(request, 'mahjong/index.html')
@@ -26,61 +162,21 @@ def index(request):
 def create_room(request):
     """部屋を作成"""
     if request.method == 'POST':
-        max_attempts = 10
+        # コードは連番から作るため通常は重複しない。旧方式のランダムなコードと
+        # 衝突した場合（IntegrityError）だけ、次の連番で作り直す
+        max_attempts = 3
         for attempt in range(max_attempts):
             try:
-                # 重複しないコードを生成
-                code = generate_room_code()
-                # 重複チェック
-                if Room.objects.filter(code=code).exists():
-                    continue  # 重複している場合は再試行
-                
-                # トランザクション内で部屋を作成
-                with transaction.atomic():
-                    # 部屋を作成（明示的にcodeを指定）
-                    room = Room.objects.create(code=code)
-                    # 部屋が正しく作成されたことを確認
-                    if not room or not room.code:
-                        continue
-                    
-                    # データベースに確実に保存されているか確認
-                    room.refresh_from_db()
-                    if not room.code:
-                        continue
-                
-                # トランザクション外で部屋の存在を再確認
-                # 本番環境（複数ワーカー）でのSQLiteのマルチプロセス問題に対応するため、
-                # データベース接続を閉じて再オープンしてから確認
-                # データベース接続を確実にコミットし、最新の状態を読み取るため接続を閉じて再オープン
-                # これにより、別のワーカーで処理される可能性のある次のリクエストでも
-                # 最新のデータが確実に読み取れるようになる
-                connection.ensure_connection()
-                # SQLiteのWALモードを有効化（マルチプロセス環境での読み書き競合を減らす）
-                with connection.cursor() as cursor:
-                    cursor.execute("PRAGMA journal_mode=WAL;")
-                connection.close()
-                try:
-                    saved_room = Room.objects.get(code=code)
-                    if saved_room:
-                        # ログに記録
-                        import logging
-                        logger = logging.getLogger(__name__)
-                        logger.info(f'Room created: {code}')
-                        return redirect('mahjong:room_setup', room_code=saved_room.code)
-                except Room.DoesNotExist:
-                    # 部屋が保存されていない場合は再試行
-                    continue
-                    
-            except IntegrityError as e:
-                # 重複エラーの場合は再試行
+                room = Room.objects.create()
+            except IntegrityError:
                 continue
             except Exception as e:
                 # その他のエラーはログに記録
-                import logging
-                logger = logging.getLogger(__name__)
                 logger.error(f'create_room error: {str(e)}', exc_info=True)
                 messages.error(request, f'部屋の作成に失敗しました: {str(e)}')
                 return redirect('mahjong:index')
+            logger.info(f'Room created: {room.code}')
+            return redirect('mahjong:room_setup', room_code=room.code)
         
         # 最大試行回数に達した場合
         messages.error(request, '部屋の作成に失敗しました。しばらく時間をおいて再度お試しください。')
@@ -148,6 +244,7 @@ def room_setup(request, room_code):
             # プレイヤーを登録
             for name, order in player_names:
                 Player.objects.create(room=room, name=name, order=order)
+            bump_room_version(room.pk)
         
         # プレイヤーが4人登録されたらダッシュボードへ
         # トランザクション外で確認（コミット後の状態を確認）
@@ -176,116 +273,55 @@ def record_score(request, room_code):
         return redirect('mahjong:index')
     
     update_room_last_used(room)
-    players = Player.objects.filter(room=room).order_by('order')
+    players = list(Player.objects.filter(room=room).order_by('order'))
     
     # プレイヤーが4人未満の場合はエラー
-    if players.count() < 4:
+    if len(players) < 4:
         messages.error(request, 'プレイヤーが4人登録されていません。')
         return redirect('mahjong:room_setup', room_code=room_code)
     
     if request.method == 'POST':
-        try:
-            with transaction.atomic():
-                # トランザクション内で部屋の存在を再確認
-                try:
-                    room.refresh_from_db()
-                except Room.DoesNotExist:
-                    messages.error(request, '部屋が見つかりませんでした。部屋が削除された可能性があります。')
-                    return redirect('mahjong:index')
+        # 書き込みの前に入力値をすべて検証する（検証失敗時にゲームを作らない）
+        entries = []
+        for player in players:
+            try:
+                score = int(request.POST.get(f'score_{player.id}', 0))
+                chip_change = int(request.POST.get(f'chip_{player.id}', 0))
                 
-                # 次のゲーム番号を取得
-                last_game = Game.objects.filter(room=room).order_by('-game_number').first()
-                game_number = (last_game.game_number + 1) if last_game else 1
+                # スコアとチップの範囲チェック（マイナスも許可）
+                if score < -200000 or score > 200000:
+                    raise ValueError(f'{player.name}の持ち点が範囲外です（-200000〜200000点）')
+                if abs(chip_change) > 10000:
+                    raise ValueError(f'{player.name}のチップ増減が範囲外です（-10000〜10000）')
                 
-                # ゲームを作成
-                game = Game.objects.create(room=room, game_number=game_number)
-            
-            # スコア記録を作成（バリデーション付き）
-            score_records = []
-            for player in players:
-                try:
-                    score = int(request.POST.get(f'score_{player.id}', 0))
-                    chip_change = int(request.POST.get(f'chip_{player.id}', 0))
-                    
-                    # スコアとチップの範囲チェック（マイナスも許可）
-                    if score < -200000 or score > 200000:
-                        raise ValueError(f'{player.name}の持ち点が範囲外です（-200000〜200000点）')
-                    if abs(chip_change) > 10000:
-                        raise ValueError(f'{player.name}のチップ増減が範囲外です（-10000〜10000）')
-                    
-                    score_records.append(ScoreRecord(
-                        game=game,
-                        player=player,
-                        score=score,
-                        chip_change=chip_change,
-                    ))
-                except (ValueError, TypeError) as e:
-                    messages.error(request, f'入力値が無効です: {str(e)}')
-                    return redirect('mahjong:record_score', room_code=room_code)
-            
-            # 持ち点の合計を検証（4人全員の合計がstarting_points * 4になっているか確認）
-            total_score = sum(record.score for record in score_records)
-            expected_total = room.starting_points * 4
-            if total_score != expected_total:
-                messages.error(
-                    request, 
-                    f'持ち点の合計が正しくありません。合計: {total_score:,}点、期待値: {expected_total:,}点（{room.starting_points:,}点 × 4人）'
-                )
+                entries.append((player, score, chip_change))
+            except (ValueError, TypeError) as e:
+                messages.error(request, f'入力値が無効です: {str(e)}')
                 return redirect('mahjong:record_score', room_code=room_code)
-            
-            # 順位を判定（持ち点の高い順、同点の場合はプレイヤー順で決定）
-            # 同点時のウマオカ折半なし：同点でも順位を分ける（プレイヤー順で決定）
-            # ソート: 持ち点の高い順、同点の場合はプレイヤー順（orderが小さい方が上位）
-            score_records.sort(key=lambda x: (x.score, -x.player.order), reverse=True)
-            # 順位を1,2,3,4と割り当て（同点でも順位を分ける）
-            for rank, record in enumerate(score_records, start=1):
-                record.rank = rank
-            
-            # ポイントを計算
-            # 【計算フロー】
-            # 1. 素点計算：返し点30,000を基準に (持ち点 - 返し点) / 1000 で計算
-            # 2. ウマ加算：順位に応じたウマを加算（10-20の場合：1位+20, 2位+10, 3位-10, 4位-20）
-            # 3. オカ加算：1位のみ、トップ取りのオカ（20pt）を加算
-            # 注意：素点の合計が0でなくても調整しない（持ち点の合計が返し点×4でないのは正常）
-            
-            for record in score_records:
-                # 1. 素点計算：返し点30,000を基準に計算
-                base_points = (record.score - room.return_points) / 1000
-                
-                # 2. ウマを取得（サシウマから計算）
-                uma_map = {
-                    1: room.uma_1st,
-                    2: room.uma_2nd,
-                    3: room.uma_3rd,
-                    4: room.uma_4th,
-                }
-                uma = uma_map.get(record.rank, 0)
-                
-                # 3. オカ（1位のみ、トップ取りの固定値を使用）
-                # room.oka_pointsは返し点と持ち点の差（5pt）を返すが、正しくはroom.oka（20pt）を使う
-                oka = room.oka if record.rank == 1 else 0
-                
-                # 最終ポイント計算: 素点 + ウマ + オカ
-                record.points = base_points + uma + oka
-            
-                # 保存
-                for record in score_records:
-                    record.save()
-            
-            # トランザクション成功後、部屋の存在を再確認
-            try:
-                Room.objects.get(code=room_code)
-                return redirect('mahjong:room_dashboard', room_code=room_code)
-            except Room.DoesNotExist:
+        
+        # 持ち点の合計を検証（4人全員の合計がstarting_points * 4になっているか確認）
+        total_score = sum(score for _, score, _ in entries)
+        expected_total = room.starting_points * 4
+        if total_score != expected_total:
+            messages.error(
+                request, 
+                f'持ち点の合計が正しくありません。合計: {total_score:,}点、期待値: {expected_total:,}点（{room.starting_points:,}点 × 4人）'
+            )
+            return redirect('mahjong:record_score', room_code=room_code)
+        
+        try:
+            # ゲームと4人分のスコア記録を1トランザクションで保存
+            record_game(room, entries)
+        except Exception as e:
+            # 保存中に部屋が削除された場合は外部キー制約で失敗する
+            if isinstance(e, IntegrityError) and not Room.objects.filter(pk=room.pk).exists():
                 messages.error(request, '部屋が見つかりませんでした。部屋が削除された可能性があります。')
                 return redirect('mahjong:index')
-        except Exception as e:
             # エラーが発生した場合はログに記録
-            import logging
-            logger = logging.getLogger(__name__)
             logger.error(f'record_score error: {str(e)}', exc_info=True)
             messages.error(request, f'スコアの保存に失敗しました: {str(e)}')
             return redirect('mahjong:record_score', room_code=room_code)
+        return redirect('mahjong:room_dashboard', room_code=room_code)
     
     return render(request, 'mahjong/record_score.html', {
         'room': room,
@@ -293,135 +329,127 @@ def record_score(request, room_code):
     })
 
 
-def room_dashboard(request, room_code):
-    """ダッシュボード画面"""
+async def room_dashboard(request, room_code):
+    """
+    ダッシュボード画面
+
+    読み取り専用のビュー（ダッシュボード・部分テンプレート）は非同期ビューにして、
+    ASGIでは遅いクライアントがワーカーを占有しないようにする。
+    """
     try:
         try:
-            room = Room.objects.get(code=room_code)
+            room = await room_cache.aget_room(room_code)
         except Room.DoesNotExist:
             messages.error(request, f'部屋コード「{room_code}」が見つかりませんでした。部屋が削除された可能性があります。')
             return redirect('mahjong:index')
         
-        update_room_last_used(room)
-        players = Player.objects.filter(room=room).order_by('order')
+        await aupdate_room_last_used(room)
+        read_model = await acached_read_model(room)
         
         # プレイヤーが4人未満の場合はプレイヤー登録画面にリダイレクト
-        if players.count() < 4:
+        if not read_model.is_ready:
             return redirect('mahjong:room_setup', room_code=room_code)
         
-        games = Game.objects.filter(room=room).order_by('-game_number')
-        
-        # 各プレイヤーの累計ポイントとチップを計算
-        player_stats = []
-        for player in players:
-            total_points = sum(
-                sr.points for sr in ScoreRecord.objects.filter(player=player)
-                if sr.points is not None
-            )
-            total_chips = sum(
-                sr.chip_change for sr in ScoreRecord.objects.filter(player=player)
-            )
-            # チップを実際の支払いポイントに換算
-            # chip_point_rateは100で割った値で保存されているので、計算時に100倍する
-            chip_point_rate = getattr(room, 'chip_point_rate', 1.0) or 1.0
-            chip_points = total_chips * chip_point_rate * 100
-            # 合計（ポイントは100倍、チップも100倍した実際の支払いポイント）
-            total_amount_pt = (total_points * 100) + chip_points
-            player_stats.append({
-                'player': player,
-                'total_points': total_points,
-                'total_chips': total_chips,
-                'chip_points': chip_points,
-                'total_amount_pt': total_amount_pt,
-            })
-        
-        # 各ゲームのスコア記録をプレイヤー順に整理（初期表示用）
-        games_data = []
-        for game in games:
-            game_records = {}
-            for record in game.score_records.all():
-                game_records[record.player.id] = record
-            games_data.append({
-                'game': game,
-                'records': [game_records.get(player.id) for player in players]
-            })
-        
-        return render(request, 'mahjong/dashboard.html', {
-            'room': room,
-            'players': players,
-            'games': games,
-            'games_data': games_data,
-            'player_stats': player_stats,
-        })
+        context = read_model.context(player_stats=False)
+        context['game_list_html'] = await arender_game_list(read_model)
+        context['player_stats_html'] = await arender_player_stats(read_model)
+        context['game_list_etag'] = room_etag(room, 'game-list')
+        context['player_stats_etag'] = room_etag(room, 'player-stats')
+        context['poll_interval'] = poll_interval(room) or 0
+        # メッセージの表示でセッションを読むため、テンプレートは同期で描画する
+        return await sync_to_async(render)(request, 'mahjong/dashboard.html', context)
     except Exception as e:
         # エラーが発生した場合はログに記録して、エラーページにリダイレクト
-        import logging
-        logger = logging.getLogger(__name__)
         logger.error(f'room_dashboard error: {str(e)}', exc_info=True)
         messages.error(request, f'ダッシュボードの読み込みに失敗しました: {str(e)}')
         return redirect('mahjong:index')
 
 
+@lean_view
 @require_http_methods(["GET"])
-def game_list_partial(request, room_code):
-    """HTMX用のゲームリスト部分テンプレート"""
-    room = get_object_or_404(Room, code=room_code)
-    update_room_last_used(room)
-    players = Player.objects.filter(room=room).order_by('order')
-    games = Game.objects.filter(room=room).order_by('-game_number')
+async def game_list_partial(request, room_code):
+    """
+    HTMX用のゲームリスト部分テンプレート
     
-    # 各ゲームのスコア記録をプレイヤー順に整理
-    games_data = []
-    for game in games:
-        game_records = {}
-        for record in game.score_records.all():
-            game_records[record.player.id] = record
-        games_data.append({
-            'game': game,
-            'records': [game_records.get(player.id) for player in players]
-        })
+    ?before=<game_number> を指定すると、それより古いゲームの行だけを返す（「古いゲームを表示」）。
+    ポーリングでは ?since=<バージョン> で差分だけを返し、差分で表せない変更の場合は
+    最新のページだけを描画し直す。
+    """
+    room = await aget_cached_room_or_404(room_code)
+    await aupdate_room_last_used(room)
     
-    return render(request, 'mahjong/partials/game_list.html', {
-        'room': room,
-        'players': players,
-        'games_data': games_data,
-    })
+    before = request.GET.get('before')
+    if before is not None:
+        try:
+            before = int(before)
+        except ValueError:
+            return HttpResponseBadRequest('invalid before')
+        read_model = await acached_read_model(room)
+        page = await read_model.agame_page(before=before, with_records=False)
+        context = await agame_rows_context(read_model, page.rows, page.older_than)
+        return HttpResponse(render_to_string('mahjong/partials/game_rows.html', context))
+    
+    # 部屋のバージョンが変わっていなければ、スコア記録を読まずに304を返す
+    etag = room_etag(room, 'game-list')
+    response = unchanged_response(request, room, etag)
+    if response is None:
+        read_model = await acached_read_model(room)
+        # ?since=<バージョン> があれば、それ以降に追加・削除されたゲームだけを返す
+        since = request.GET.get('since', '')
+        delta = await read_model.agame_delta(int(since), with_records=False) if since.isdigit() else None
+        if delta is None:
+            response = HttpResponse(await arender_game_list(read_model))
+        else:
+            context = await agame_rows_context(read_model, delta.rows)
+            context['deleted_game_ids'] = delta.deleted_ids
+            response = HttpResponse(render_to_string('mahjong/partials/game_delta.html', context))
+            response['HX-Retarget'] = '#game-list-rows'
+            response['HX-Reswap'] = 'afterbegin'
+    response['X-Room-Version'] = room.version
+    return with_poll_interval(with_etag(response, etag), room)
 
 
+@lean_view
 @require_http_methods(["GET"])
-def player_stats_partial(request, room_code):
+async def player_stats_partial(request, room_code):
     """HTMX用のプレイヤー統計部分テンプレート"""
-    room = get_object_or_404(Room, code=room_code)
-    update_room_last_used(room)
-    players = Player.objects.filter(room=room).order_by('order')
+    room = await aget_cached_room_or_404(room_code)
+    await aupdate_room_last_used(room)
     
-    # 各プレイヤーの累計ポイントとチップを計算
-    player_stats = []
-    for player in players:
-        total_points = sum(
-            sr.points for sr in ScoreRecord.objects.filter(player=player)
-            if sr.points is not None
-        )
-        total_chips = sum(
-            sr.chip_change for sr in ScoreRecord.objects.filter(player=player)
-        )
-        # チップを実際の支払いポイントに換算
-        chip_points = total_chips * room.chip_point_rate * 100
-        # 合計（ポイントは100倍、チップも100倍した実際の支払いポイント）
-        total_amount_pt = (total_points * 100) + chip_points
-        player_stats.append({
-            'player': player,
-            'total_points': total_points,
-            'total_chips': total_chips,
-            'chip_points': chip_points,
-            'total_amount_pt': total_amount_pt,
-        })
+    # 部屋のバージョンが変わっていなければ、統計を計算せずに304を返す
+    etag = room_etag(room, 'player-stats')
+    response = unchanged_response(request, room, etag)
+    if response is None:
+        response = HttpResponse(await arender_player_stats(await acached_read_model(room)))
+    return with_poll_interval(with_etag(response, etag), room)
+
+
+@lean_view
+@require_http_methods(["GET"])
+async def room_events(request, room_code):
+    """部屋の変更をServer-Sent Eventsで通知（ASGIでのみ接続を保持）"""
+    if not isinstance(request, ASGIRequest):
+        # WSGIでは接続を保持するとワーカーが占有されるため、204で再接続を止める
+        # （クライアントは定期ポーリングだけで更新する）
+        return HttpResponse(status=204)
     
-    return render(request, 'mahjong/partials/player_stats.html', {
-        'room': room,
-        'players': players,
-        'player_stats': player_stats,
-    })
+    version = await fetch_room_version(room_code)
+    if version is None:
+        raise Http404
+    
+    # クライアントが表示しているバージョン（再接続時はLast-Event-ID）
+    try:
+        seen_version = int(request.headers.get('Last-Event-ID') or request.GET.get('v', ''))
+    except ValueError:
+        seen_version = version
+    
+    response = StreamingHttpResponse(
+        room_event_stream(room_code, version, seen_version),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # リバースプロキシでのバッファリングを無効化
+    return response
 
 
 def delete_game(request, room_code, game_id):
@@ -430,13 +458,24 @@ def delete_game(request, room_code, game_id):
     game = get_object_or_404(Game, id=game_id, room=room)
     
     if request.method == 'POST':
-        game.delete()
+        delete_game_and_totals(game)
         messages.success(request, f'ゲーム #{game.game_number} を削除しました。')
         return redirect('mahjong:room_dashboard', room_code=room_code)
     
     return redirect('mahjong:room_dashboard', room_code=room_code)
 
 
+def rescore_room(request, room_code):
+    """保存済みの全ゲームを現在の設定で再計算"""
+    room = get_object_or_404(Room, code=room_code)
+    
+    if request.method == 'POST':
+        result = rescore_room_records(room)
+        messages.success(request, f'{result.games}ゲームのポイントを現在の設定で再計算しました。')
+    
+    return redirect('mahjong:room_dashboard', room_code=room_code)
+
+
 def delete_room(request, room_code):
     """部屋を削除"""
     try:
@@ -447,12 +486,11 @@ def delete_room(request, room_code):
     
     if request.method == 'POST':
         # ログに記録
-        import logging
-        logger = logging.getLogger(__name__)
         logger.info(f'Room deleted: {room_code} by user request')
         
         room_code_for_message = room.code
         room.delete()
+        room_cache.invalidate_room(room_code_for_message)
         messages.success(request, f'部屋「{room_code_for_message}」を削除しました。')
         return redirect('mahjong:index')
     
@@ -496,6 +534,7 @@ def edit_players(request, room_code):
         # プレイヤーを登録
         for name, order in player_names:
             Player.objects.create(room=room, name=name, order=order)
+        bump_room_version(room.pk)
         
         messages.success(request, 'プレイヤー情報を更新しました。')
         return redirect('mahjong:room_dashboard', room_code=room_code)
@@ -560,7 +599,10 @@ def room_settings(request, room_code):
             # 入力値を100で割って保存（データベースには1.0として保存）
             room.chip_point_rate = chip_point_rate_input / 100.0
             
-            room.save()
+            # versionは他のリクエストが加算している可能性があるため保存対象から外す
+            with transaction.atomic():
+                room.save(update_fields=ROOM_SETTINGS_FIELDS)
+                bump_room_version(room.pk)
             messages.success(request, '設定を更新しました。')
         except (ValueError, TypeError) as e:
             messages.error(request, f'入力値が無効です: {str(e)}')
@@ -570,3 +612,40 @@ def room_settings(request, room_code):
     return render(request, 'mahjong/room_settings.html', {
         'room': room,
     })
+
+
+def _metrics_unauthorized(request):
+    """
+    MAHJONG_METRICS_TOKEN のBearerトークンを確認し、認証できなければ401の応答を返す
+
+    トークンが未設定なら404（エンドポイントを公開しない）。
+    """
+    token = getattr(settings, 'MAHJONG_METRICS_TOKEN', '')
+    if not token:
+        raise Http404
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        response = HttpResponse('認証が必要です', status=401, content_type='text/plain; charset=utf-8')
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return None
+
+
+@lean_view
+@require_http_methods(["GET"])
+def cache_stats(request):
+    """このワーカーのキャッシュのヒット・ミスの回数（/metrics と同じBearerトークンが必要）"""
+    unauthorized = _metrics_unauthorized(request)
+    if unauthorized is not None:
+        return unauthorized
+    return JsonResponse(room_cache.stats.snapshot())
+
+
+@lean_view
+@require_http_methods(["GET"])
+def metrics(request):
+    """全ワーカーのメトリクス（Prometheusのテキスト形式、Bearerトークンが必要）"""
+    unauthorized = _metrics_unauthorized(request)
+    if unauthorized is not None:
+        return unauthorized
+    return HttpResponse(app_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
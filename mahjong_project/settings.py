@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import tempfile
 from django.core.management.utils import get_random_secret_key
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -36,6 +37,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # SQL・テンプレート・ミドルウェアの所要時間をServer-Timingヘッダーで返す（mahjong/timing.py）
+    'mahjong.middleware.ServerTimingMiddleware',
+    # URL名ごとのレイテンシ・ステータスコード・クエリ数を記録する（/metrics、mahjong/metrics.py）
+    'mahjong.middleware.MetricsMiddleware',
+    # 管理者のトークン付き・サンプリングで選んだリクエストのプロファイル（mahjong/profiling.py）
+    'mahjong.middleware.ProfilingMiddleware',
+    # @lean_viewのビュー（ポーリング・SSE・JSON）は以降のミドルウェアを飛ばす（mahjong/middleware.py）
+    'mahjong.middleware.LeanPathMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -45,10 +54,15 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# 軽量な経路（LeanPathMiddleware）で通すミドルウェア
+MAHJONG_LEAN_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+]
+
 # WhiteNoiseは本番環境でのみ使用（開発環境では不要）
 if not DEBUG:
     try:
-        MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+        MIDDLEWARE.insert(5, 'whitenoise.middleware.WhiteNoiseMiddleware')
     except ImportError:
         pass  # whitenoiseがインストールされていない場合はスキップ
 
@@ -79,14 +93,41 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # 既定では接続を使い回さない（リクエストの終了時に閉じる）。
+        # ASGIでは同期のORMの処理が sync_to_async のスレッドで動き、接続はスレッドごとに作られるため、
+        # 使い回すと閉じられない接続がスレッドの数だけ溜まる（Djangoのドキュメントも ASGI では 0 を推奨）。
+        # 同期ワーカー（WSGI）では wsgi.py が 600 を既定にする（PRAGMAの適用と接続のオープンを
+        # リクエストごとに行わない）
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '0')),
+        # 使い回す接続がリクエストの開始時に生きているか確認する
+        'CONN_HEALTH_CHECKS': True,
         'OPTIONS': {
-            # WALモードを有効化（マルチプロセス環境での読み書き競合を減らす）
-            # SQLiteのWALモードは、複数のプロセスからの同時読み取りを可能にする
             'timeout': 20,  # ロック待機時間を延長
+            # トランザクションの開始時に書き込みロックを取る（BEGIN IMMEDIATE）。
+            # 既定の DEFERRED では、記録の追加のように読み取り（ゲーム番号の最大値）の後に
+            # 書き込むトランザクションが、他の書き込みと重なると読み取りロックからの昇格で
+            # busy_timeout を待たずに "database is locked" で失敗する
+            'transaction_mode': 'IMMEDIATE',
         },
     }
 }
 
+# SQLiteの接続設定（mahjong/sqlite.py）
+MAHJONG_SQLITE_PRAGMAS = {
+    # WALモード（複数のプロセスからの同時読み取りと、読み取り中の書き込みを可能にする）。
+    # データベースファイルに保存されるため、プロセスごとに最初の接続でだけ適用する
+    'journal_mode': 'WAL',
+    # WALモードではNORMALでも破損しない（コミットごとのfsyncを省略）
+    'synchronous': 'NORMAL',
+    # データベースファイルをメモリマップで読む（256MB）
+    'mmap_size': 256 * 1024 * 1024,
+    # ページキャッシュ（負の値はKiB単位: 約20MB）
+    'cache_size': -20000,
+    # 一時テーブル・ソート用の領域をメモリに置く
+    'temp_store': 'MEMORY',
+    # ロック待機時間は OPTIONS の timeout（接続時に設定される）を使う
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -129,6 +170,94 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 if not DEBUG:
     STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# 部屋の変更通知（Server-Sent Events）
+# 各ワーカーが接続中の部屋のバージョンを確認する間隔と、keepaliveコメントの送信間隔（秒）
+MAHJONG_EVENTS_POLL_SECONDS = float(os.environ.get('MAHJONG_EVENTS_POLL_SECONDS', '2'))
+MAHJONG_EVENTS_KEEPALIVE_SECONDS = float(os.environ.get('MAHJONG_EVENTS_KEEPALIVE_SECONDS', '15'))
+
+# 部屋の最終使用時刻の記録
+# 保存済みの値がGRANULARITYより新しければ更新せず、古い場合もワーカー内に溜めて
+# FLUSH秒ごとにまとめて書き込む（読み取りのリクエストで毎回書き込まないため）
+MAHJONG_LAST_USED_GRANULARITY_SECONDS = int(os.environ.get('MAHJONG_LAST_USED_GRANULARITY_SECONDS', '300'))
+MAHJONG_LAST_USED_FLUSH_SECONDS = int(os.environ.get('MAHJONG_LAST_USED_FLUSH_SECONDS', '60'))
+
+# ダッシュボードのポーリング間隔（秒、mahjong/polling.py）
+# 最後の変更からACTIVE秒以内はMIN秒ごと、それ以降は経過時間に応じて倍々にしてMAXで頭打ち、
+# STOP_AFTER秒を超えて変更のない部屋はポーリングを止める（変更はSSEで通知される）
+MAHJONG_POLL_MIN_SECONDS = int(os.environ.get('MAHJONG_POLL_MIN_SECONDS', '15'))
+MAHJONG_POLL_MAX_SECONDS = int(os.environ.get('MAHJONG_POLL_MAX_SECONDS', '600'))
+MAHJONG_POLL_ACTIVE_SECONDS = int(os.environ.get('MAHJONG_POLL_ACTIVE_SECONDS', '600'))
+MAHJONG_POLL_STOP_AFTER_SECONDS = int(os.environ.get('MAHJONG_POLL_STOP_AFTER_SECONDS', str(12 * 60 * 60)))
+
+# 部屋コードの割り当て（mahjong/room_codes.py）
+# KEYは連番をコードに変換する置換の鍵で、すべてのワーカーで同じ値にし、運用開始後は変えない。
+# SECRET_KEYは未設定だとプロセスごとに乱数になり、ワーカーごとに置換が変わってコードが衝突するため
+# 専用の鍵を使う。未設定なら開発用の固定の鍵を使い、manage.py check --deploy がエラーにする
+# BLOCK_SIZEは各ワーカーがまとめて予約する連番の数
+MAHJONG_ROOM_CODE_KEY = os.environ.get('MAHJONG_ROOM_CODE_KEY', '')
+MAHJONG_ROOM_CODE_BLOCK_SIZE = int(os.environ.get('MAHJONG_ROOM_CODE_BLOCK_SIZE', '100'))
+
+# キャッシュ（mahjong/cache.py）
+# MAHJONG_CACHE_BACKEND:
+#   locmem（既定）: ワーカーごとのメモリ。1プロセスでの運用向け
+#   file: 同じマシンのワーカーで共有（MAHJONG_CACHE_DIR）。add() がアトミックでないため、
+#         同じ値の計算はワーカー内でだけまとめる（mahjong/singleflight.py）
+#   redis: Redis互換のサーバーで共有（MAHJONG_CACHE_URL、redisパッケージが必要）
+MAHJONG_CACHE_BACKEND = os.environ.get('MAHJONG_CACHE_BACKEND', 'locmem')
+if MAHJONG_CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('MAHJONG_CACHE_URL', 'redis://127.0.0.1:6379/1'),
+        }
+    }
+elif MAHJONG_CACHE_BACKEND == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('MAHJONG_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'mahjong_cache')),
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'mahjong',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+# Roomのインスタンスを保持する秒数（locmemでは他のワーカーの書き込みが反映されるまでの最大の遅れ）
+MAHJONG_CACHE_ROOM_SECONDS = int(os.environ.get('MAHJONG_CACHE_ROOM_SECONDS', '5'))
+# 部屋のバージョンごとの値（プレイヤー一覧・描画済みの部分テンプレート）を保持する秒数
+MAHJONG_CACHE_VERSION_SECONDS = int(os.environ.get('MAHJONG_CACHE_VERSION_SECONDS', '3600'))
+# 同じ値の計算をまとめるロックの期限と、他のワーカーの結果を待つ間隔（秒、mahjong/singleflight.py）
+MAHJONG_SINGLE_FLIGHT_LOCK_SECONDS = float(os.environ.get('MAHJONG_SINGLE_FLIGHT_LOCK_SECONDS', '2'))
+MAHJONG_SINGLE_FLIGHT_POLL_SECONDS = float(os.environ.get('MAHJONG_SINGLE_FLIGHT_POLL_SECONDS', '0.02'))
+
+# リクエストごとの所要時間の計測（Server-Timingヘッダー、mahjong/middleware.py）
+MAHJONG_SERVER_TIMING = os.environ.get('MAHJONG_SERVER_TIMING', 'True') == 'True'
+# この時間（ミリ秒）を超えたリクエストを1行のJSONでログに記録する（0で無効）
+MAHJONG_SLOW_REQUEST_MS = int(os.environ.get('MAHJONG_SLOW_REQUEST_MS', '0'))
+
+# Prometheusのメトリクス（/metrics、mahjong/metrics.py）
+# 各ワーカーはFLUSH秒ごとにDIRの自分のファイルに書き出し、/metricsは全ファイルを合計する
+# （DIRは同じマシンのワーカーで共有し、gunicornの起動時に空にする）
+# /metrics と /cache-stats/ は Authorization: Bearer <TOKEN> のリクエストにだけ応答する（未設定なら404）
+MAHJONG_METRICS = os.environ.get('MAHJONG_METRICS', 'True') == 'True'
+MAHJONG_METRICS_DIR = os.environ.get('MAHJONG_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'mahjong_metrics'))
+MAHJONG_METRICS_FLUSH_SECONDS = float(os.environ.get('MAHJONG_METRICS_FLUSH_SECONDS', '5'))
+MAHJONG_METRICS_TOKEN = os.environ.get('MAHJONG_METRICS_TOKEN', '')
+
+# リクエストのプロファイル（cProfile・tracemalloc、mahjong/profiling.py）
+# X-Mahjong-Profile ヘッダーか ?_profile= にTOKENを付けたリクエストと、SAMPLE_RATEの確率で
+# 選んだリクエストを計測し、DIRに新しいものからKEEP件残す（python manage.py profile_summary で集計）
+# TOKENが未設定でSAMPLE_RATEが0なら無効
+MAHJONG_PROFILE_TOKEN = os.environ.get('MAHJONG_PROFILE_TOKEN', '')
+MAHJONG_PROFILE_SAMPLE_RATE = float(os.environ.get('MAHJONG_PROFILE_SAMPLE_RATE', '0'))
+MAHJONG_PROFILE_DIR = os.environ.get('MAHJONG_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'mahjong_profiles'))
+MAHJONG_PROFILE_KEEP = int(os.environ.get('MAHJONG_PROFILE_KEEP', '200'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
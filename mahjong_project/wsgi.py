@@ -12,5 +12,8 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mahjong_project.settings')
+# 同期ワーカーではリクエストを処理するスレッドが決まっているため、接続を使い回す
+# （ASGIでは使い回さない。settings.py の CONN_MAX_AGE を参照）
+os.environ.setdefault('DB_CONN_MAX_AGE', '600')
 
 application = get_wsgi_application()
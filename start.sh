@@ -4,7 +4,5 @@ set -e
 # マイグレーションを実行
 python manage.py migrate --noinput
 
-# Gunicornを起動
-exec gunicorn mahjong_project.wsgi --bind 0.0.0.0:8080 --workers 2 --timeout 120
-
-
+# Gunicorn（Uvicornワーカー、ASGI）を起動。設定は gunicorn.conf.py
+exec gunicorn mahjong_project.asgi:application -c gunicorn.conf.py